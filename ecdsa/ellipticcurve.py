@@ -63,12 +63,21 @@ class CurveFp( object ):
 class Point( object ):
   """A point on an elliptic curve. Altering x and y is forbidding,
      but they can be read by the x() and y() methods."""
-  def __init__( self, curve, x, y, order = None ):
-    """curve, x, y, order; order (optional) is the order of this point."""
+  # wNAF window used for generator points in mul_add(), their table of
+  # odd multiples is cached so a wider window is worthwhile
+  GENERATOR_WINDOW = 7
+
+  def __init__( self, curve, x, y, order = None, generator = False ):
+    """curve, x, y, order; order (optional) is the order of this point.
+    generator (optional) marks a point which will be multiplied many times,
+    such as a curve generator, so a table of its multiples is worth caching."""
     self.__curve = curve
     self.__x = x
     self.__y = y
     self.__order = order
+    self.__generator = generator
+    self.__doubles = None
+    self.__odd = None
     # self.curve is allowed to be None only for INFINITY:
     if self.__curve: assert self.__curve.contains_point( x, y )
     if order: assert self * order == INFINITY
@@ -109,39 +118,46 @@ class Point( object ):
   def __mul__( self, other ):
     """Multiply a point by an integer."""
 
-    def leftmost_bit( x ):
-      assert x > 0
-      result = 1
-      while result <= x: result = 2 * result
-      return result // 2
-
     e = other
     if self.__order: e = e % self.__order
     if e == 0: return INFINITY
     if self == INFINITY: return INFINITY
     assert e > 0
 
-    # From X9.62 D.3.2:
-
-    e3 = 3 * e
-    negative_self = Point( self.__curve, self.__x, -self.__y, self.__order )
-    i = leftmost_bit( e3 ) // 2
-    result = self
-    # print_("Multiplying %s by %d (e3 = %d):" % ( self, other, e3 ))
-    while i > 1:
-      result = result.double()
-      if ( e3 & i ) != 0 and ( e & i ) == 0: result = result + self
-      if ( e3 & i ) == 0 and ( e & i ) != 0: result = result + negative_self
-      # print_(". . . i = %d, result = %s" % ( i, result ))
-      i = i // 2
-
-    return result
+    if self.__generator:
+      if self.__doubles is None:
+        self.__doubles = PointJacobi.from_affine( self ).doubles( self.__order )
+      return PointJacobi.mul_doubles( self.__curve, self.__doubles, e ).to_affine()
+    return ( PointJacobi.from_affine( self ) * e ).to_affine()
 
   def __rmul__( self, other ):
     """Multiply a point by an integer."""
 
     return self * other
 
+  def mul_add( self, self_mul, other, other_mul ):
+    """Return self * self_mul + other * other_mul.
+
+    Faster than doing the two multiplications separately, as the
+    doublings are shared between them and only one modular inversion
+    is needed."""
+
+    if self.__order: self_mul = self_mul % self.__order
+    if other.order(): other_mul = other_mul % other.order()
+    if self == INFINITY or self_mul == 0: return other * other_mul
+    if other == INFINITY or other_mul == 0: return self * self_mul
+    assert self_mul > 0 and other_mul > 0
+
+    if self.__generator:
+      if self.__odd is None:
+        self.__odd = PointJacobi.from_affine( self ).odd_multiples( self.GENERATOR_WINDOW )
+      other = PointJacobi.from_affine( other )
+      coords = _mul_add( self.__curve, [ ( self_mul, self.GENERATOR_WINDOW, self.__odd ),
+                                         ( other_mul, other.WINDOW, other.odd_multiples() ) ] )
+      return PointJacobi( self.__curve, *coords ).to_affine()
+    return PointJacobi.from_affine( self ).mul_add( self_mul, PointJacobi.from_affine( other ),
+                                                    other_mul ).to_affine()
+
   def __str__( self ):
     if self == INFINITY: return "infinity"
     return "(%d,%d)" % ( self.__x, self.__y )
@@ -178,6 +194,247 @@ class Point( object ):
     return self.__order
 
 
+class PointJacobi( object ):
+  """A point on an elliptic curve, in Jacobian coordinates.
+
+  (X, Y, Z) represents the affine point (X/Z^2, Y/Z^3), with Z == 0 for
+  the point at infinity. Adding and doubling points in these coordinates
+  needs no modular inversion, only multiplications, so a scalar
+  multiplication needs just one inversion to convert the result back
+  to an affine Point.
+  """
+  # width of the windowed NAF used for scalar multiplication
+  WINDOW = 4
+
+  def __init__( self, curve, x, y, z ):
+    self.__curve = curve
+    self.__coords = ( x, y, z )
+
+  @classmethod
+  def from_affine( cls, point ):
+    """Return the Jacobian representation of affine Point point."""
+    if point == INFINITY:
+      return cls( None, 0, 1, 0 )
+    return cls( point.curve(), point.x(), point.y(), 1 )
+
+  def to_affine( self ):
+    """Return the affine Point equal to this point."""
+    x, y, z = self.__coords
+    if not z:
+      return INFINITY
+    p = self.__curve.p()
+    z_inv = numbertheory.inverse_mod( z, p )
+    zz_inv = z_inv * z_inv % p
+    return Point( self.__curve, x * zz_inv % p, y * zz_inv * z_inv % p )
+
+  def is_infinity( self ):
+    return not self.__coords[2]
+
+  def coords( self ):
+    return self.__coords
+
+  def curve( self ):
+    return self.__curve
+
+  def __eq__( self, other ):
+    """Return True if both are the same point on the curve."""
+    x1, y1, z1 = self.__coords
+    x2, y2, z2 = other.__coords
+    if not z1 or not z2:
+      return not z1 and not z2
+    p = self.__curve.p()
+    zz1, zz2 = z1 * z1 % p, z2 * z2 % p
+    return ( x1 * zz2 - x2 * zz1 ) % p == 0 and \
+           ( y1 * zz2 * z2 - y2 * zz1 * z1 ) % p == 0
+
+  def __ne__( self, other ):
+    return not self == other
+
+  def __neg__( self ):
+    x, y, z = self.__coords
+    return PointJacobi( self.__curve, x, -y, z )
+
+  def double( self ):
+    """Return a new point that is twice the old."""
+    if self.is_infinity(): return self
+    return PointJacobi( self.__curve, *_double( self.__curve.p(), self.__curve.a(), self.__coords ) )
+
+  def __add__( self, other ):
+    """Add one point to another point."""
+    if self.is_infinity(): return other
+    if other.is_infinity(): return self
+    assert self.__curve == other.__curve
+    return PointJacobi( self.__curve, *_add( self.__curve.p(), self.__curve.a(), self.__coords, other.__coords ) )
+
+  def odd_multiples( self, window = WINDOW ):
+    """Return the coordinates of P, 3P, 5P ... 2^(window-1)-1 P, the
+    multiples of this point needed for each odd windowed NAF digit.
+    These are normalised to Z = 1, so adding them is cheaper."""
+    p, a = self.__curve.p(), self.__curve.a()
+    twice = _double( p, a, self.__coords )
+    odd = [ self.__coords ]
+    for i in range( 1, 1 << ( window - 2 ) ):
+      odd.append( _add( p, a, odd[-1], twice ) )
+    return _normalise( p, odd )
+
+  def __mul__( self, other ):
+    """Multiply a point by a non-negative integer, using a windowed NAF."""
+    if self.is_infinity() or other == 0:
+      return PointJacobi( self.__curve, 0, 1, 0 )
+    return PointJacobi( self.__curve, *_mul_add( self.__curve, [ ( other, self.WINDOW, self.odd_multiples() ) ] ) )
+
+  def mul_add( self, self_mul, other, other_mul ):
+    """Return self * self_mul + other * other_mul, for non-negative integers.
+
+    Uses Shamir's trick: the windowed NAFs of both multipliers are
+    interleaved, so both multiplications share one set of doublings."""
+    if self.is_infinity() or self_mul == 0:
+      return other * other_mul
+    if other.is_infinity() or other_mul == 0:
+      return self * self_mul
+    assert self.__curve == other.__curve
+    return PointJacobi( self.__curve, *_mul_add( self.__curve, [ ( self_mul, self.WINDOW, self.odd_multiples() ),
+                                                                ( other_mul, other.WINDOW, other.odd_multiples() ) ] ) )
+
+  def __rmul__( self, other ):
+    return self * other
+
+  def doubles( self, order ):
+    """Return a table of the affine (x, y) coordinates of this point
+    multiplied by each power of two, up to the bit length of order.
+
+    Using this table, mul_doubles() can compute any multiple of the
+    point with additions only."""
+    p, a = self.__curve.p(), self.__curve.a()
+    jacobian = [ self.__coords ]
+    for i in range( order.bit_length() ):
+      jacobian.append( _double( p, a, jacobian[-1] ) )
+    return [ ( x, y ) for x, y, z in _normalise( p, jacobian ) ]
+
+  @staticmethod
+  def mul_doubles( curve, doubles, e ):
+    """Multiply the point whose doubles() table is 'doubles' by e."""
+    p, a = curve.p(), curve.a()
+    result = ( 0, 1, 0 )
+    for i, digit in enumerate( _wnaf( e, 2 ) ):
+      if digit:
+        x, y = doubles[i]
+        result = _add( p, a, result, ( x, y if digit > 0 else -y, 1 ) )
+    return PointJacobi( curve, *result )
+
+
+def _normalise( p, points ):
+  """Return Jacobian points scaled to Z = 1 (ie affine), using a single
+  modular inversion for all of them (Montgomery's trick).
+  Points at infinity are left as they are."""
+  products = [ 1 ]
+  for x, y, z in points:
+    products.append( products[-1] * z % p if z else products[-1] )
+  inv = numbertheory.inverse_mod( products[-1], p )
+  result = [ None ] * len( points )
+  for i in range( len( points ) - 1, -1, -1 ):
+    x, y, z = points[i]
+    if not z:
+      result[i] = points[i]
+      continue
+    z_inv = inv * products[i] % p
+    inv = inv * z % p
+    zz_inv = z_inv * z_inv % p
+    result[i] = ( x * zz_inv % p, y * zz_inv * z_inv % p, 1 )
+  return result
+
+
+def _mul_add( curve, terms ):
+  """Return the Jacobian coordinates of the sum of multiples of points
+  (Straus-Shamir trick). terms is a list of (multiplier, window, odd),
+  where odd is the odd_multiples( window ) table of each point."""
+  p, a = curve.p(), curve.a()
+  terms = [ ( _wnaf( e, window ), odd ) for e, window, odd in terms ]
+  result = ( 0, 1, 0 )
+  for i in range( max( len( naf ) for naf, odd in terms ) - 1, -1, -1 ):
+    result = _double( p, a, result )
+    for naf, odd in terms:
+      digit = naf[i] if i < len( naf ) else 0
+      if digit > 0:
+        result = _add( p, a, result, odd[digit // 2] )
+      elif digit < 0:
+        x, y, z = odd[-digit // 2]
+        result = _add( p, a, result, ( x, -y, z ) )
+  return result
+
+
+def _wnaf( e, width ):
+  """Return the width-w non-adjacent form of e > 0, least significant digit first.
+
+  Each non-zero digit is odd, with absolute value less than 2^(width-1),
+  and is followed by at least width-1 zeros."""
+  digits = []
+  modulus = 1 << width
+  while e:
+    if e & 1:
+      digit = e % modulus
+      if digit >= modulus >> 1:
+        digit -= modulus
+      e -= digit
+    else:
+      digit = 0
+    digits.append( digit )
+    e >>= 1
+  return digits
+
+
+def _double( p, a, point ):
+  """Double Jacobian point on curve y^2 = x^3 + ax + b mod p
+  (dbl-2007-bl from the Explicit-Formulas Database)."""
+  x1, y1, z1 = point
+  if not y1 or not z1:
+    return ( 0, 1, 0 )
+  xx, yy, zz = x1 * x1 % p, y1 * y1 % p, z1 * z1 % p
+  yyyy = yy * yy % p
+  s = 2 * ( ( x1 + yy ) ** 2 - xx - yyyy ) % p
+  m = ( 3 * xx + a * zz * zz ) % p
+  x3 = ( m * m - 2 * s ) % p
+  y3 = ( m * ( s - x3 ) - 8 * yyyy ) % p
+  z3 = ( ( y1 + z1 ) ** 2 - yy - zz ) % p
+  return ( x3, y3, z3 )
+
+
+def _add( p, a, point1, point2 ):
+  """Add Jacobian points on curve y^2 = x^3 + ax + b mod p
+  (add-2007-bl, or madd-2007-bl when point2 has Z = 1)."""
+  x1, y1, z1 = point1
+  x2, y2, z2 = point2
+  if not z1:
+    return point2
+  if not z2:
+    return point1
+  z1z1 = z1 * z1 % p
+  if z2 == 1:
+    u1, s1 = x1, y1
+  else:
+    z2z2 = z2 * z2 % p
+    u1 = x1 * z2z2 % p
+    s1 = y1 * z2 * z2z2 % p
+  u2 = x2 * z1z1 % p
+  s2 = y2 * z1 * z1z1 % p
+  h = ( u2 - u1 ) % p
+  r = 2 * ( s2 - s1 ) % p
+  if not h:
+    if not r:
+      return _double( p, a, point1 )
+    return ( 0, 1, 0 )
+  i = 4 * h * h % p
+  j = h * i % p
+  v = u1 * i % p
+  x3 = ( r * r - j - 2 * v ) % p
+  y3 = ( r * ( v - x3 ) - 2 * s1 * j ) % p
+  if z2 == 1:
+    z3 = ( ( z1 + h ) ** 2 - z1z1 - h * h ) % p
+  else:
+    z3 = ( ( z1 + z2 ) ** 2 - z1z1 - z2z2 ) * h % p
+  return ( x3, y3, z3 )
+
+
 # This one point is the Point At Infinity for all purposes:
 INFINITY = Point( None, None, None )
 
@@ -289,5 +546,12 @@ def __main__():
   else:
     print_("u1 * p192 + u2 * Q came out right.")
 
+  temp = p192.mul_add( u1, Q, u2 )
+  if temp.x() != 0x885052380FF147B734C330C43D39B2C4A89F29B0F749FEAD \
+     or temp.y() != 0x9CF9FA1CBEFEFB917747A3BB29C072B9289C2547884FD835:
+    raise FailedTest("p192.mul_add( u1, Q, u2 ) came out wrong.")
+  else:
+    print_("p192.mul_add( u1, Q, u2 ) came out right.")
+
 if __name__ == "__main__":
   __main__()
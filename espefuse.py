@@ -18,6 +18,8 @@
 from __future__ import division, print_function
 
 import argparse
+import collections
+import json
 import os
 import struct
 import sys
@@ -75,6 +77,21 @@ BLK3_PART_EFUSES = [
 CUST_MAC_VER_EFUSE = ('CUST_MAC_VER', "identity", 3, 5, 0xFF << 24, None, None, "int",  "Version of Custom MAC Address")
 CUST_MAC_EFUSE     = ('CUST_MAC',     "identity", 3, 0, 0xFFFFFFFF, None, None, "cmac", "Custom MAC Address")
 
+
+def _index_efuses(efuse_tuples):
+    """ Return maps of efuse name -> efuse tuple and category -> list of efuse names, in table order """
+    by_name = collections.OrderedDict()
+    categories = collections.OrderedDict()
+    for efuse in efuse_tuples:
+        by_name[efuse[0]] = efuse
+        categories.setdefault(efuse[1], []).append(efuse[0])
+    return by_name, categories
+
+
+EFUSES_BY_NAME, EFUSE_CATEGORIES = _index_efuses(EFUSES)
+# used instead if BLK3_PART_RESERVE is set
+BLK3_PART_EFUSES_BY_NAME, BLK3_PART_EFUSE_CATEGORIES = _index_efuses(EFUSES + BLK3_PART_EFUSES)
+
 # Offsets and lengths of each of the 4 efuse blocks in register space
 #
 # These offsets/lens are for esptool.read_efuse(X) which takes
@@ -83,6 +100,7 @@ EFUSE_BLOCK_OFFS = [0, 14, 22, 30]
 EFUSE_BLOCK_LEN  = [7, 8, 8, 8]
 
 # EFUSE registers & command/conf values
+EFUSE_REG_BASE = 0x3FF5A000  # read registers, see esptool.read_efuse()
 EFUSE_REG_CONF = 0x3FF5A0FC
 EFUSE_CONF_WRITE = 0x5A5A
 EFUSE_CONF_READ = 0x5AA5
@@ -128,22 +146,36 @@ def efuse_write_reg_addr(block, word):
 class EspEfuses(object):
     """
     Wrapper object to manage the efuse fields in a connected ESP bootloader
+
+    The efuse blocks are read once, in a single batch, into a snapshot which
+    the efuse fields are decoded from. The snapshot is invalidated (and re-read
+    on next access) whenever efuses are written by write_efuses().
     """
     def __init__(self, esp):
         self._esp = esp
-        self._efuses = [EfuseField.from_tuple(self, efuse) for efuse in EFUSES]
+        self._snapshot = None
+        self._staged = None  # while staging a transaction, dict of write register address -> value
+        self._bind_efuses(EFUSES_BY_NAME, EFUSE_CATEGORIES)
         if self["BLK3_PART_RESERVE"].get():
-            # add these BLK3 efuses, if the BLK3_PART_RESERVE flag is set...
-            self._efuses += [EfuseField.from_tuple(self, efuse) for efuse in BLK3_PART_EFUSES]
+            # add the BLK3 efuses, if the BLK3_PART_RESERVE flag is set...
+            self._bind_efuses(BLK3_PART_EFUSES_BY_NAME, BLK3_PART_EFUSE_CATEGORIES)
 
         self.coding_scheme = self["CODING_SCHEME"].get()
 
+    def _bind_efuses(self, efuses_by_name, efuse_categories):
+        """ Create the efuse fields for one of the module level efuse name & category maps """
+        self._by_name = dict((name, EfuseField.from_tuple(self, efuse)) for name, efuse in efuses_by_name.items())
+        self._efuses = [self._by_name[name] for name in efuses_by_name]
+        # category name -> list of efuse fields
+        self.categories = collections.OrderedDict((category, [self._by_name[name] for name in names])
+                                                  for category, names in efuse_categories.items())
+
     def __getitem__(self, efuse_name):
         """ Return the efuse field with the given name """
-        for e in self._efuses:
-            if efuse_name == e.register_name:
-                return e
-        raise KeyError
+        try:
+            return self._by_name[efuse_name]
+        except KeyError:
+            raise KeyError(efuse_name)
 
     def __iter__(self):
         return self._efuses.__iter__()
@@ -151,7 +183,11 @@ class EspEfuses(object):
     def write_efuses(self):
         """ Write the values in the efuse write registers to
         the efuse hardware, then refresh the efuse read registers.
+
+        Does nothing while staging a transaction, see EfuseTransaction.
         """
+        if self._staged is not None:
+            return
         self._esp.write_reg(EFUSE_REG_CONF, EFUSE_CONF_WRITE)
         self._esp.write_reg(EFUSE_REG_CMD, EFUSE_CMD_WRITE)
 
@@ -165,16 +201,41 @@ class EspEfuses(object):
         self._esp.write_reg(EFUSE_REG_CONF, EFUSE_CONF_READ)
         self._esp.write_reg(EFUSE_REG_CMD, EFUSE_CMD_READ)
         wait_idle()
+        self.invalidate()
+        self._esp.invalidate_identity()
+
+    def refresh(self):
+        """ Read all efuse blocks from the chip into the snapshot """
+        words = [EFUSE_BLOCK_OFFS[block] + word for block in range(len(EFUSE_BLOCK_OFFS)) for word in range(EFUSE_BLOCK_LEN[block])]
+        self._snapshot = dict(zip(words, self._esp.read_efuses(words)))
+
+    def invalidate(self):
+        """ Discard the snapshot, efuses will be read from the chip again on next access """
+        self._snapshot = None
 
     def read_efuse(self, addr):
-        return self._esp.read_efuse(addr)
+        """ Return efuse word 'addr' (a word offset in register space) from the snapshot """
+        if self._snapshot is None:
+            self.refresh()
+        try:
+            return self._snapshot[addr]
+        except KeyError:  # not part of an efuse block
+            return self._esp.read_efuse(addr)
 
     def read_reg(self, addr):
         return self._esp.read_reg(addr)
 
     def write_reg(self, addr, value):
+        if self._staged is not None:
+            # efuse bits can only be set, so staged writes to the same register combine
+            self._staged[addr] = self._staged.get(addr, 0) | value
+            return
         return self._esp.write_reg(addr, value)
 
+    def transaction(self, force_write_always=False):
+        """ Return a new EfuseTransaction, to burn several efuses together """
+        return EfuseTransaction(self, force_write_always)
+
     def get_coding_scheme_warnings(self):
         """ Check if the coding scheme has detected any errors.
         Meaningless for default coding scheme (0)
@@ -186,6 +247,332 @@ class EspEfuses(object):
         return 24 if self.coding_scheme == CODING_SCHEME_34 else 32
 
 
+class EfuseTransaction(object):
+    """
+    Stages a set of efuse burns and read/write protections, checks them for
+    conflicts up front, then burns them all together.
+
+    The values to write are worked out by the efuse fields' own burn methods,
+    with EspEfuses staging the register writes instead of burning them.
+
+    Burning takes one program cycle, or two if protection bits (WR_DIS/RD_DIS) are
+    staged along with other efuses, so that protection is only applied after the
+    data is burned. Everything is verified from a single reread afterwards.
+    """
+    PROTECTION_MASK = 0x000FFFFF  # WR_DIS & RD_DIS bits in block 0 word 0
+
+    def __init__(self, efuses, force_write_always=False):
+        self._efuses = efuses
+        self._force = force_write_always
+        self._ops = []  # (description, efuse, kind, staged registers, raw bytes value or None)
+        self._warnings = []
+
+    def _stage(self, description, efuse, kind, raw_value, burn_func, *args):
+        self._efuses._staged = {}
+        try:
+            burn_func(*args)
+            registers = self._efuses._staged
+        finally:
+            self._efuses._staged = None
+        self._ops.append((description, efuse, kind, registers, raw_value))
+
+    def burn(self, efuse_name, value):
+        """ Stage burning an efuse (integer value, or bytes for MAC & key block efuses) """
+        efuse = self._efuses[efuse_name]
+        raw_value = None
+        if not isinstance(value, bytes):
+            if value & (efuse.mask >> efuse.shift) != value:
+                raise esptool.FatalError("Value mask for efuse %s is 0x%x. Value 0x%x is too large." % (efuse_name, efuse.mask >> efuse.shift, value))
+            if value | efuse.get_raw() != value:
+                self._warnings.append("New value for efuse %s contains some bits that cannot be cleared (value will be 0x%x)"
+                                      % (efuse_name, value | efuse.get_raw()))
+            description = "Burn efuse %s (%s) 0x%x -> 0x%x" % (efuse_name, efuse.description, efuse.get_raw(), efuse.get_raw() | value)
+        else:
+            description = "Burn efuse %s (%s) with %d bytes of data" % (efuse_name, efuse.description, len(value))
+            raw_value = value
+        self._stage(description, efuse, "burn", raw_value, efuse.burn, value)
+
+    def burn_key(self, block_name, key):
+        """ Stage burning a key (bytes) to a key block efuse """
+        efuse = self._efuses[block_name]
+        if len(key) != self._efuses.get_block_len():
+            raise esptool.FatalError("Incorrect key length %d for %s. Key must be %d bytes." % (len(key), block_name, self._efuses.get_block_len()))
+        # burn_key stores keys reversed
+        self._stage("Write key in efuse block %s" % block_name, efuse, "burn", key[::-1], efuse.burn_key, key)
+
+    def disable_write(self, efuse_name):
+        efuse = self._efuses[efuse_name]
+        if efuse.write_disable_bit is None:
+            raise esptool.FatalError("Efuse %s cannot be write-disabled" % efuse_name)
+        self._stage("Write-disable efuse %s" % efuse_name, efuse, "write_protect", None, efuse.disable_write)
+
+    def disable_read(self, efuse_name):
+        efuse = self._efuses[efuse_name]
+        if efuse.read_disable_bit is None:
+            raise esptool.FatalError("Efuse %s cannot be read-disabled" % efuse_name)
+        self._stage("Read-disable efuse %s" % efuse_name, efuse, "read_protect", None, efuse.disable_read)
+
+    def describe(self):
+        """ Return a list of descriptions of the staged operations """
+        return [op[0] for op in self._ops]
+
+    def check(self):
+        """ Check the staged operations can all be burned, raises FatalError if not. Returns a list of warnings. """
+        warnings = list(self._warnings)
+        efuses = self._efuses
+        burned = {}
+        coding_groups = {}
+        wr_dis_efuse = efuses["WR_DIS"]
+        rd_dis_efuse = efuses["RD_DIS"]
+        for (description, efuse, kind, registers, _) in self._ops:
+            if kind == "burn":
+                if efuse.register_name in burned:
+                    raise esptool.FatalError("Efuse %s is burned more than once in this batch" % efuse.register_name)
+                burned[efuse.register_name] = True
+                target = efuse
+            else:
+                target = wr_dis_efuse if kind == "write_protect" else rd_dis_efuse
+            if not target.is_writeable():
+                msg = "Can't %s: efuse %s is write protected" % (description[0].lower() + description[1:], target.register_name)
+                if not self._force:
+                    raise esptool.FatalError(msg)
+                warnings.append(msg + ", trying anyhow due to --force-write-always")
+            for addr, value in registers.items():
+                block, word = self._locate(addr)
+                if block > 0 and efuses.coding_scheme == CODING_SCHEME_34 and value != 0:
+                    # 3/4 encoded data is burned in groups of 2 words, including check bytes
+                    group = (block, word // 2)
+                    if group in coding_groups and coding_groups[group] != description:
+                        raise esptool.FatalError("%s and %s both write the same 3/4 coding scheme word group of BLK%d"
+                                                 % (coding_groups[group], description, block))
+                    coding_groups[group] = description
+                    # the read registers hold the decoded block, 6 data bytes per group
+                    old = self._read_34_data(block)[group[1] * 6:group[1] * 6 + 6]
+                    if old != b"\x00" * 6 and efuse.is_readable():
+                        msg = "%s: BLK%d already has data in this 3/4 coding scheme word group, result will be corrupt" % (description, block)
+                        if not self._force:
+                            raise esptool.FatalError(msg)
+                        warnings.append(msg)
+        return warnings
+
+    def _read_34_data(self, block):
+        """ Return the 24 bytes of decoded data in a 3/4 coding scheme block """
+        offs = EFUSE_BLOCK_OFFS[block]
+        return struct.pack("<6I", *[self._efuses.read_efuse(offs + word) for word in range(6)])
+
+    @staticmethod
+    def _locate(addr):
+        for block, base in enumerate(EFUSE_REG_WRITE):
+            word = (addr - base) // 4
+            if 0 <= word < EFUSE_BLOCK_LEN[block]:
+                return block, word
+        raise esptool.FatalError("Register 0x%08x is not an efuse write register" % addr)
+
+    def _program_cycles(self):
+        """ Return the register writes of each program cycle """
+        data = {}
+        protection = {}
+        wr_dis_reg = efuse_write_reg_addr(0, 0)
+        for (_, _, _, registers, _) in self._ops:
+            for addr, value in registers.items():
+                if addr == wr_dis_reg:
+                    if value & self.PROTECTION_MASK:
+                        protection[addr] = protection.get(addr, 0) | (value & self.PROTECTION_MASK)
+                    value &= ~self.PROTECTION_MASK
+                if value:
+                    data[addr] = data.get(addr, 0) | value
+        return [cycle for cycle in [data, protection] if cycle]
+
+    def commit(self):
+        """ Burn all staged operations. Returns a list of problems found verifying the result (empty on success). """
+        self.check()
+        efuses = self._efuses
+        warnings_before = efuses.get_coding_scheme_warnings()
+        cycles = self._program_cycles()
+        for i, cycle in enumerate(cycles):
+            for addr, value in sorted(cycle.items()):
+                efuses.write_reg(addr, value)
+            efuses.write_efuses()
+            if i + 1 < len(cycles):
+                for addr in cycle.keys():
+                    efuses.write_reg(addr, 0)  # don't burn these again in the next cycle
+        efuses.refresh()
+
+        problems = []
+        for (description, efuse, kind, registers, raw_value) in self._ops:
+            if kind == "write_protect":
+                ok = not efuse.is_writeable()
+            elif kind == "read_protect":
+                ok = not efuse.is_readable()
+            elif not efuse.is_readable():
+                continue  # can't verify data which is now read protected
+            elif efuse.block > 0 and efuses.coding_scheme == CODING_SCHEME_34 and raw_value is not None:
+                # the write registers were 3/4 encoded, but the block reads back decoded
+                raw = bytearray(efuse.get_raw())
+                ok = all(a & b == b for a, b in zip(raw, bytearray(raw_value)))
+            else:
+                ok = True
+                for addr, value in registers.items():
+                    block, word = self._locate(addr)
+                    if block == 0 and word == 0:
+                        value &= ~self.PROTECTION_MASK
+                    if efuses.read_efuse(EFUSE_BLOCK_OFFS[block] + word) & value != value:
+                        ok = False
+            if not ok:
+                problems.append("%s failed. Protected?" % description)
+        warnings_after = efuses.get_coding_scheme_warnings()
+        if warnings_after & ~warnings_before != 0:
+            problems.append("Burning efuses added coding scheme warnings 0x%x -> 0x%x. Encoding bug?" % (warnings_before, warnings_after))
+        return problems
+
+
+class VirtualEfuseController(object):
+    """
+    Offline stand-in for a connected ESP32, which emulates the efuse controller
+    registers used by EspEfuses. Allows espefuse operations to run without a device.
+
+    Writing EFUSE_CMD_WRITE to EFUSE_REG_CMD (with EFUSE_CONF_WRITE in EFUSE_REG_CONF)
+    ORs the efuse write registers into the efuses, like burning does, except for
+    bits which are write-disabled in WR_DIS. Bits which are read-disabled in RD_DIS
+    read back as zero.
+
+    With the 3/4 coding scheme set in CODING_SCHEME, the write registers of BLK1-3
+    are decoded on burn: the 6 data bytes of each 8 byte group are ORed into the
+    24 byte block value which is read back, and the check bytes are discarded.
+    Coding errors are not emulated.
+
+    The efuses can be loaded from and saved to the text format printed by
+    'espefuse.py dump', or a JSON file with a list of words for each block.
+    """
+    CHIP_NAME = "ESP32 (virtual efuses)"
+
+    def __init__(self, blocks=None):
+        if blocks is None:
+            blocks = [[0] * length for length in EFUSE_BLOCK_LEN]
+        if [len(words) for words in blocks] != EFUSE_BLOCK_LEN:
+            raise esptool.FatalError("Virtual efuses need %s words in each block" % EFUSE_BLOCK_LEN)
+        self.blocks = [list(words) for words in blocks]
+        self._write_regs = {}
+        self._conf = 0
+        # (block, word) -> list of (mask, write disable bit, read disable bit) of the efuses in that word
+        self._protection = collections.defaultdict(list)
+        for (_, _, block, word, mask, write_disable_bit, read_disable_bit, efuse_type, _) in EFUSES:
+            words = range(EFUSE_BLOCK_LEN[block]) if efuse_type == "keyblock" else [word]
+            for w in words:
+                self._protection[(block, w)].append((mask, write_disable_bit, read_disable_bit))
+
+    @classmethod
+    def load(cls, filename):
+        """ Load efuses from a JSON or 'espefuse.py dump' file """
+        with open(filename, 'r') as f:
+            contents = f.read()
+        try:
+            return cls(json.loads(contents)["blocks"])
+        except ValueError:
+            pass  # not JSON
+        except (KeyError, TypeError):
+            raise esptool.FatalError("%s is not a virtual efuse file, expected a 'blocks' list" % filename)
+        blocks = []
+        words = None
+        for line in contents.splitlines():
+            if line.startswith("EFUSE block "):
+                words = []
+                blocks.append(words)
+            elif words is not None and line.strip():
+                try:
+                    words += [int(w, 16) for w in line.split()]
+                except ValueError:
+                    raise esptool.FatalError("%s is not an espefuse.py dump or virtual efuse file" % filename)
+        return cls(blocks)
+
+    def save(self, filename):
+        """ Save efuses, as JSON if filename ends with .json, otherwise in 'espefuse.py dump' format """
+        with open(filename, 'w') as f:
+            if filename.endswith(".json"):
+                json.dump({"blocks": self.blocks}, f, indent=1)
+            else:
+                for block, words in enumerate(self.blocks):
+                    f.write("EFUSE block %d:\n" % block)
+                    f.write(" ".join("%08x" % w for w in words) + "\n")
+
+    def _disabled_mask(self, block, word, disable_bit_index, disable_bits):
+        """ Return the mask of bits in a block word which are protected by any of the set disable_bits """
+        mask = 0
+        for protection in self._protection[(block, word)]:
+            bit = protection[disable_bit_index]
+            if bit is not None and disable_bits & (1 << bit):
+                mask |= protection[0]
+        return mask
+
+    def _locate(self, addr, block_regs):
+        """ Return (block, word) for the efuse register address, if it's in one of block_regs """
+        for block, base in enumerate(block_regs):
+            word = (addr - base) // 4
+            if addr % 4 == 0 and 0 <= word < EFUSE_BLOCK_LEN[block]:
+                return (block, word)
+        return None
+
+    def read_efuse(self, n):
+        for block, offs in enumerate(EFUSE_BLOCK_OFFS):
+            if offs <= n < offs + EFUSE_BLOCK_LEN[block]:
+                word = n - offs
+                rd_dis = (self.blocks[0][0] >> 16) & 0xF
+                return self.blocks[block][word] & ~self._disabled_mask(block, word, 2, rd_dis) & 0xFFFFFFFF
+        raise esptool.FatalError("Efuse word %d is not emulated" % n)
+
+    def read_efuses(self, words):
+        return [self.read_efuse(n) for n in words]
+
+    def invalidate_identity(self):
+        pass  # nothing is cached
+
+    def read_reg(self, addr):
+        if addr == EFUSE_REG_CMD:
+            return 0  # commands complete immediately
+        elif addr == EFUSE_REG_CONF:
+            return self._conf
+        elif addr == EFUSE_REG_DEC_STATUS:
+            return 0
+        location = self._locate(addr, [EFUSE_REG_BASE + 4 * offs for offs in EFUSE_BLOCK_OFFS])
+        if location is not None:
+            return self.read_efuse(EFUSE_BLOCK_OFFS[location[0]] + location[1])
+        location = self._locate(addr, EFUSE_REG_WRITE)
+        if location is not None:
+            return self._write_regs.get(location, 0)
+        raise esptool.FatalError("Register 0x%08x is not emulated" % addr)
+
+    def write_reg(self, addr, value, mask=0xFFFFFFFF, delay_us=0):
+        value &= mask
+        if addr == EFUSE_REG_CONF:
+            self._conf = value
+        elif addr == EFUSE_REG_CMD:
+            if value == EFUSE_CMD_WRITE and self._conf == EFUSE_CONF_WRITE:
+                self._burn()
+        else:
+            location = self._locate(addr, EFUSE_REG_WRITE)
+            if location is None:
+                raise esptool.FatalError("Register 0x%08x is not emulated" % addr)
+            self._write_regs[location] = value
+
+    def _burn(self):
+        # as they were before this burn
+        wr_dis = self.blocks[0][0] & 0xFFFF
+        coding_scheme = self.blocks[0][6] & 0x3
+        burned = {}
+        for (block, word), value in self._write_regs.items():
+            if block > 0 and coding_scheme == CODING_SCHEME_34:
+                continue
+            burned[(block, word)] = value
+        if coding_scheme == CODING_SCHEME_34:
+            for block in range(1, len(EFUSE_BLOCK_LEN)):
+                encoded = struct.pack("<8I", *[self._write_regs.get((block, word), 0) for word in range(8)])
+                data = b"".join(encoded[group:group + 6] for group in range(0, 32, 8))
+                for word, value in enumerate(struct.unpack("<6I", data)):
+                    burned[(block, word)] = value
+        for (block, word), value in burned.items():
+            self.blocks[block][word] |= value & ~self._disabled_mask(block, word, 1, wr_dis) & 0xFFFFFFFF
+
+
 class EfuseField(object):
     @staticmethod
     def from_tuple(parent, efuse_tuple):
@@ -206,11 +593,8 @@ class EfuseField(object):
         self.word = word
         self.data_reg_offs = EFUSE_BLOCK_OFFS[self.block] + self.word
         self.mask = mask
-        self.shift = 0
         # self.shift is the number of the least significant bit in the mask
-        while mask & 0x1 == 0:
-            self.shift += 1
-            mask >>= 1
+        self.shift = (mask & -mask).bit_length() - 1
         self.write_disable_bit = write_disable_bit
         self.read_disable_bit = read_disable_bit
         self.register_name = register_name
@@ -460,12 +844,12 @@ class EfuseAdcPointCalibration(EfuseField):
         return offset + (delta * self.STEP_SIZE)
 
 
-def dump(esp, _efuses, args):
+def dump(esp, efuses, args):
     """ Dump raw efuse data registers """
     for block in range(len(EFUSE_BLOCK_OFFS)):
         print("EFUSE block %d:" % block)
         offsets = [x + EFUSE_BLOCK_OFFS[block] for x in range(EFUSE_BLOCK_LEN[block])]
-        print(" ".join(["%08x" % esp.read_efuse(offs) for offs in offsets]))
+        print(" ".join(["%08x" % efuses.read_efuse(offs) for offs in offsets]))
 
 
 def summary(esp, efuses, args):
@@ -473,9 +857,9 @@ def summary(esp, efuses, args):
     ROW_FORMAT = "%-22s %-50s%s= %s %s %s"
     print(ROW_FORMAT.replace("-50", "-12") % ("EFUSE_NAME", "Description", "", "[Meaningful Value]", "[Readable/Writeable]", "(Hex Value)"))
     print("-" * 88)
-    for category in set(e.category for e in efuses):
+    for category, category_efuses in efuses.categories.items():
         print("%s fuses:" % category.title())
-        for e in (e for e in efuses if e.category == category):
+        for e in category_efuses:
             raw = e.get_raw()
             try:
                 raw = "(0x%x)" % raw
@@ -593,7 +977,7 @@ def burn_key(esp, efuses, args):
                                  (size, num_bytes, num_bytes * 8))
 
     # check existing data
-    efuse = [e for e in efuses if e.register_name == "BLK%d" % block_num][0]
+    efuse = efuses["BLK%d" % block_num]
     original = efuse.get_raw()
     EMPTY_KEY = b'\x00' * num_bytes
     if original != EMPTY_KEY:
@@ -643,7 +1027,7 @@ def burn_block_data(esp, efuses, args):
         if len(data) % 6 != 0:
             raise RuntimeError("Device has 3/4 Coding Scheme. Can only write data lengths which are a multiple of 6 (data is %d bytes)" % len(data))
 
-    efuse = [e for e in efuses if e.register_name == args.block.upper()][0]
+    efuse = efuses[args.block.upper()]
 
     if not args.force_write_always and \
        efuse.get_raw() != b'\x00' * num_bytes:
@@ -667,6 +1051,47 @@ def burn_block_data(esp, efuses, args):
     efuse.burn_words(words, word_offset)
 
 
+def burn_batch(esp, efuses, args):
+    """ Burn several efuses, keys and protection bits together, as listed in a JSON manifest """
+    try:
+        manifest = json.load(args.manifest)
+    except ValueError as e:
+        raise esptool.FatalError("Invalid manifest %s: %s" % (args.manifest.name, e))
+    unknown = set(manifest.keys()) - set(["burn", "keys", "write_protect", "read_protect"])
+    if unknown:
+        raise esptool.FatalError("Unknown manifest section(s): %s" % ", ".join(sorted(unknown)))
+    manifest_dir = os.path.dirname(os.path.abspath(args.manifest.name))
+    key_blocks = {"flash_encryption": "BLK1", "secure_boot": "BLK2"}
+
+    try:
+        transaction = efuses.transaction(args.force_write_always)
+        for (name, value) in sorted(manifest.get("burn", {}).items()):
+            if efuses[name].efuse_type not in ["int", "flag", "bitcount", "spipin"]:
+                raise esptool.FatalError("Efuse %s can't be burned from a manifest, use the keys section for key blocks" % name)
+            transaction.burn(name, value)
+        protect = []
+        for (block, keyfile) in sorted(manifest.get("keys", {}).items()):
+            block = key_blocks.get(block, block)
+            with open(os.path.join(manifest_dir, keyfile), 'rb') as f:
+                transaction.burn_key(block, f.read())
+            if not args.no_protect_key:
+                protect.append(block)
+        for name in manifest.get("write_protect", []) + protect:
+            transaction.disable_write(name)
+        for name in manifest.get("read_protect", []) + protect:
+            transaction.disable_read(name)
+    except KeyError as e:
+        raise esptool.FatalError("Unknown efuse %s in manifest" % e)
+
+    for warning in transaction.check():
+        print("WARNING: %s" % warning)
+    confirm("\n".join(transaction.describe()) + "\n", args)
+    problems = transaction.commit()
+    if problems:
+        raise esptool.FatalError("\n".join(problems))
+    print("Burned %d efuse operations." % len(transaction.describe()))
+
+
 def set_flash_voltage(esp, efuses, args):
     sdio_force = efuses["XPD_SDIO_FORCE"]
     sdio_tieh = efuses["XPD_SDIO_TIEH"]
@@ -799,6 +1224,12 @@ def main():
         choices=['default_reset', 'no_reset', 'esp32r1', 'no_reset_no_sync'],
         default='default_reset')
 
+    parser.add_argument(
+        '--virtual',
+        help='Instead of connecting to a chip, use virtual efuses loaded from this file (JSON, or the output of the "dump" command), '
+        'and save any changes back to it. If the file does not exist, all efuses start blank.',
+        metavar='FILENAME')
+
     parser.add_argument('--do-not-confirm',
                         help='Do not pause for confirmation before permanently writing efuses. Use with caution.', action='store_true')
 
@@ -848,6 +1279,15 @@ def main():
     p.add_argument('block', help='Efuse block to burn.', choices=["BLK1","BLK2","BLK3"])
     p.add_argument('datafile', help='File containing data to burn into the efuse block', type=argparse.FileType('rb'))
 
+    p = subparsers.add_parser('burn_batch',
+                              help='Burn the efuses, keys and read/write protections listed in a JSON manifest, checking them all first ' +
+                              'and burning them together.')
+    p.add_argument('--no-protect-key', help='Disable default read- and write-protecting of keys in the manifest.', action='store_true')
+    add_force_write_always(p)
+    p.add_argument('manifest', help='JSON manifest: {"burn": {EFUSE_NAME: value}, "keys": {block: keyfile}, '
+                   '"write_protect": [EFUSE_NAME], "read_protect": [EFUSE_NAME]}. Key file paths are relative to the manifest.',
+                   type=argparse.FileType('r'))
+
     p = subparsers.add_parser('set_flash_voltage',
                               help='Permanently set the internal flash voltage regulator to either 1.8V, 3.3V or OFF. ' +
                               'This means GPIO12 can be high or low at reset without changing the flash voltage.')
@@ -874,13 +1314,22 @@ def main():
     # each 'operation' is a module-level function of the same name
     operation_func = globals()[args.operation]
 
-    esp = esptool.ESP32ROM(args.port, baud=args.baud)
-    esp.connect(args.before)
+    if args.virtual is not None:
+        if os.path.exists(args.virtual):
+            esp = VirtualEfuseController.load(args.virtual)
+        else:
+            esp = VirtualEfuseController()
+    else:
+        esp = esptool.ESP32ROM(args.port, baud=args.baud)
+        esp.connect(args.before)
 
     # dict mapping register name to its efuse object
     efuses = EspEfuses(esp)
     operation_func(esp, efuses, args)
 
+    if args.virtual is not None:
+        esp.save(args.virtual)
+
 
 def _main():
     try:
@@ -18,8 +18,14 @@
 from __future__ import division, print_function
 
 import argparse
+import binascii
 import hashlib
+import io
+import json
+import mmap
+import multiprocessing
 import os
+import stat
 import struct
 import sys
 
@@ -27,6 +33,21 @@ import ecdsa
 import esptool
 import pyaes
 
+# Optional accelerated AES implementations, pyaes is used if neither is installed
+try:
+    from cryptography.hazmat.backends import default_backend as cryptography_default_backend
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
+try:
+    from Cryptodome.Cipher import AES as CryptodomeAES
+except ImportError:
+    try:
+        from Crypto.Cipher import AES as CryptodomeAES
+    except ImportError:
+        CryptodomeAES = None
+
 
 def get_chunks(source, chunk_len):
     """ Returns an iterator over 'chunk_len' chunks of 'source' """
@@ -47,6 +68,100 @@ def swap_word_order(source):
     return struct.pack(words, *reversed(struct.unpack(words, source)))
 
 
+def reverse_blocks(source, block_len=16):
+    """ Reverse the byte order within each 'block_len' block of 'source' bitstring
+
+    Reversing the whole of 'source' reverses the bytes in every block but also
+    reverses the order of the blocks, so the blocks are then put back in order.
+    """
+    assert len(source) % block_len == 0
+    count = len(source) // block_len
+    return b"".join(reversed(struct.unpack(("%ds" % block_len) * count, source[::-1])))
+
+
+class PyaesBackend(object):
+    """ AES-256 ECB using the pure Python pyaes module, always available """
+    NAME = "pyaes"
+
+    @staticmethod
+    def is_available():
+        return True
+
+    def encrypt(self, key, data):
+        return pyaes.AESModeOfOperationECB(key).encrypt_blocks(data)
+
+    def decrypt(self, key, data):
+        return pyaes.AESModeOfOperationECB(key).decrypt_blocks(data)
+
+
+class CryptographyBackend(object):
+    """ AES-256 ECB using the 'cryptography' package (OpenSSL) """
+    NAME = "cryptography"
+
+    @staticmethod
+    def is_available():
+        return Cipher is not None
+
+    def __init__(self):
+        self._backend = cryptography_default_backend()
+
+    def _cipher(self, key):
+        return Cipher(algorithms.AES(key), modes.ECB(), backend=self._backend)
+
+    def encrypt(self, key, data):
+        encryptor = self._cipher(key).encryptor()
+        return encryptor.update(data) + encryptor.finalize()
+
+    def decrypt(self, key, data):
+        decryptor = self._cipher(key).decryptor()
+        return decryptor.update(data) + decryptor.finalize()
+
+
+class CryptodomeBackend(object):
+    """ AES-256 ECB using the 'pycryptodome' or 'pycryptodomex' package """
+    NAME = "pycryptodome"
+
+    @staticmethod
+    def is_available():
+        return CryptodomeAES is not None
+
+    def encrypt(self, key, data):
+        return CryptodomeAES.new(key, CryptodomeAES.MODE_ECB).encrypt(data)
+
+    def decrypt(self, key, data):
+        return CryptodomeAES.new(key, CryptodomeAES.MODE_ECB).decrypt(data)
+
+
+# AES backends in order of preference
+AES_BACKENDS = [CryptographyBackend, CryptodomeBackend, PyaesBackend]
+
+_aes_backend = None
+
+
+def select_aes_backend(name=None):
+    """ Select the AES implementation used for all AES operations, by NAME.
+
+    If name is None, the first available backend in AES_BACKENDS is used.
+    Returns the selected backend.
+    """
+    global _aes_backend
+    for backend in AES_BACKENDS:
+        if name is None or backend.NAME == name:
+            if backend.is_available():
+                _aes_backend = backend()
+                return _aes_backend
+            elif name is not None:
+                raise esptool.FatalError("AES backend '%s' is not installed" % name)
+    raise esptool.FatalError("Unknown AES backend '%s'" % name)
+
+
+def aes_backend():
+    """ Return the selected AES backend, selecting the default backend if none has been selected """
+    if _aes_backend is None:
+        select_aes_backend()
+    return _aes_backend
+
+
 def _load_hardware_key(keyfile):
     """ Load a 256-bit key, similar to stored in efuse, from a file
 
@@ -66,6 +181,10 @@ def _load_hardware_key(keyfile):
     return key
 
 
+# Secure boot digest processes the bootloader image in buffers of this size
+SECURE_BOOT_DIGEST_BUFFER_SIZE = 0x10000
+
+
 def digest_secure_bootloader(args):
     """ Calculate the digest of a bootloader image, in the same way the hardware
     secure boot engine would do so. Can be used with a pre-loaded key to update a
@@ -101,26 +220,20 @@ def digest_secure_bootloader(args):
     # (due to hardware quirks not for security.)
 
     key = _load_hardware_key(args.keyfile)
-    aes = pyaes.AESModeOfOperationECB(key)
+    aes = aes_backend()
     digest = hashlib.sha512()
 
-    for block in get_chunks(plaintext, 16):
-        block = block[::-1]  # reverse each input block
-
-        cipher_block = aes.encrypt(block)
-        # reverse and then byte swap each word in the output block
-        cipher_block = cipher_block[::-1]
-        for block in get_chunks(cipher_block, 4):
-            # Python hashlib can build each SHA block internally
-            digest.update(block[::-1])
+    # ECB blocks are independent, so this is done in large buffers
+    for chunk in get_chunks(plaintext, SECURE_BOOT_DIGEST_BUFFER_SIZE):
+        cipher = aes.encrypt(key, reverse_blocks(chunk))  # reverse each input block
+        # reverse and then byte swap each word in the output blocks
+        digest.update(endian_swap_words(reverse_blocks(cipher)))
 
     if args.output is None:
         args.output = os.path.splitext(args.image.name)[0] + "-digest-0x0000.bin"
     with open(args.output, "wb") as f:
         f.write(iv)
-        digest = digest.digest()
-        for word in get_chunks(digest, 4):
-            f.write(word[::-1])  # swap word order in the result
+        f.write(endian_swap_words(digest.digest()))  # byte swap each word in the result
         f.write(b'\xFF' * (0x1000 - f.tell()))  # pad to 0x1000
         f.write(plaintext_image)
     print("digest+image written to %s" % args.output)
@@ -137,39 +250,70 @@ def generate_signing_key(args):
 
 
 def _load_ecdsa_signing_key(args):
-    sk = ecdsa.SigningKey.from_pem(args.keyfile.read())
+    return _ecdsa_signing_key_from_pem(args.keyfile.read())
+
+
+def _ecdsa_signing_key_from_pem(key_data):
+    sk = ecdsa.SigningKey.from_pem(key_data)
     if sk.curve != ecdsa.NIST256p:
         raise esptool.FatalError("Signing key uses incorrect curve. ESP32 Secure Boot only supports NIST256p (openssl calls this curve 'prime256v1")
     return sk
 
 
-def sign_data(args):
-    """ Sign a data file with a ECDSA private key, append binary signature to file contents """
-    sk = _load_ecdsa_signing_key(args)
+# Data files are hashed (and copied, if needed) in chunks of this size when signing
+SIGNING_BUFFER_SIZE = 0x10000
 
-    # calculate signature of binary data
-    binary_content = args.datafile.read()
-    signature = sk.sign_deterministic(binary_content, hashlib.sha256)
 
-    # back-verify signature
-    vk = sk.get_verifying_key()
-    vk.verify(signature, binary_content, hashlib.sha256)  # throws exception on failure
+def _sign_file(sk, datafile, output):
+    """ Sign the contents of open file 'datafile' with signing key 'sk'.
 
-    if args.output is None or os.path.abspath(args.output) == os.path.abspath(args.datafile.name):  # append signature to input file
-        args.datafile.close()
-        outfile = open(args.datafile.name, "ab")
-    else:  # write file & signature to new file
-        outfile = open(args.output, "wb")
-        outfile.write(binary_content)
-    outfile.write(struct.pack("I", 0))  # Version indicator, allow for different curves/formats later
-    outfile.write(signature)
-    outfile.close()
-    print("Signed %d bytes of data from %s with key %s" % (len(binary_content), args.datafile.name, args.keyfile.name))
+    If 'output' is None or the same file as 'datafile', the signature block is appended
+    to 'datafile'. Otherwise the data and signature are written to the 'output' file.
+    The data is read once, in chunks, and never held in memory as a whole.
+    Returns the length of the data signed.
+    """
+    # samefile() catches symlinks & hard links to the data file, which mustn't be truncated before they're read
+    append = output is None or (os.path.exists(output) and os.path.samefile(output, datafile.name))
+    outfile = None if append else open(output, "wb")
+    try:
+        # calculate digest of binary data, copying it to the output file at the same time
+        digest = hashlib.sha256()
+        length = 0
+        while True:
+            chunk = datafile.read(SIGNING_BUFFER_SIZE)
+            if len(chunk) == 0:
+                break
+            digest.update(chunk)
+            length += len(chunk)
+            if outfile is not None:
+                outfile.write(chunk)
+        digest = digest.digest()
+        signature = sk.sign_digest_deterministic(digest, hashlib.sha256)
 
+        # back-verify signature
+        vk = sk.get_verifying_key()
+        vk.verify_digest(signature, digest)  # throws exception on failure
 
-def verify_signature(args):
-    """ Verify a previously signed binary image, using the ECDSA public key """
-    key_data = args.keyfile.read()
+        if append:  # append signature to input file
+            datafile.close()
+            outfile = open(datafile.name, "ab")
+        outfile.write(struct.pack("I", 0))  # Version indicator, allow for different curves/formats later
+        outfile.write(signature)
+    finally:
+        if outfile is not None:
+            outfile.close()
+    return length
+
+
+def sign_data(args):
+    """ Sign a data file with a ECDSA private key, append binary signature to file contents """
+    sk = _load_ecdsa_signing_key(args)
+    length = _sign_file(sk, args.datafile, args.output)
+    print("Signed %d bytes of data from %s with key %s" % (length, args.datafile.name, args.keyfile.name))
+
+
+def _load_verifying_key(key_data):
+    """ Return the ECDSA verifying key from a private key or public key file's contents """
     if b"-BEGIN EC PRIVATE KEY" in key_data:
         sk = ecdsa.SigningKey.from_pem(key_data)
         vk = sk.get_verifying_key()
@@ -183,22 +327,154 @@ def verify_signature(args):
 
     if vk.curve != ecdsa.NIST256p:
         raise esptool.FatalError("Public key uses incorrect curve. ESP32 Secure Boot only supports NIST256p (openssl calls this curve 'prime256v1")
+    return vk
 
-    binary_content = args.datafile.read()
+
+def _verify_signed_data(vk, binary_content):
+    """ Verify signed data (data followed by a signature block), raise FatalError if it's not valid """
     data = binary_content[0:-68]
     sig_version, signature = struct.unpack("I64s", binary_content[-68:])
     if sig_version != 0:
         raise esptool.FatalError("Signature block has version %d. This version  of espsecure only supports version 0." % sig_version)
-    print("Verifying %d bytes of data" % len(data))
     try:
-        if vk.verify(signature, data, hashlib.sha256):
-            print("Signature is valid")
-        else:
+        if not vk.verify(signature, data, hashlib.sha256):
             raise esptool.FatalError("Signature is not valid")
     except ecdsa.keys.BadSignatureError:
         raise esptool.FatalError("Signature is not valid")
 
 
+def verify_signature(args):
+    """ Verify a previously signed binary image, using the ECDSA public key """
+    vk = _load_verifying_key(args.keyfile.read())
+    binary_content = args.datafile.read()
+    print("Verifying %d bytes of data" % (len(binary_content) - 68))
+    _verify_signed_data(vk, binary_content)
+    print("Signature is valid")
+
+
+def _batch_file_list(args):
+    """ Return the list of (datafile, output) filenames for a batch command,
+    from the command line and/or a JSON manifest.
+
+    The manifest is a list where each entry is a data filename, or an object
+    {"datafile": filename, "output": filename}. Paths are relative to the manifest.
+    """
+    files = [(f, None) for f in args.datafiles]
+    if args.manifest is not None:
+        manifest_dir = os.path.dirname(os.path.abspath(args.manifest.name))
+        try:
+            manifest = json.load(args.manifest)
+            if not isinstance(manifest, list):
+                raise ValueError("expected a list of files")
+            for entry in manifest:
+                if not isinstance(entry, dict):
+                    entry = {"datafile": entry}
+                output = entry.get("output", None)
+                files.append((os.path.join(manifest_dir, entry["datafile"]),
+                              None if output is None else os.path.join(manifest_dir, output)))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            raise esptool.FatalError("Invalid manifest %s: %s" % (args.manifest.name, e))
+    if len(files) == 0:
+        raise esptool.FatalError("No data files to process, supply some filenames and/or a --manifest")
+
+    output_dir = getattr(args, "output_dir", None)
+    if output_dir is not None:
+        files = [(datafile, output or os.path.join(output_dir, os.path.basename(datafile))) for (datafile, output) in files]
+    outputs = [os.path.abspath(output or datafile) for (datafile, output) in files]
+    if len(set(outputs)) != len(outputs):
+        raise esptool.FatalError("Two or more data files in the batch have the same output file")
+    return files
+
+
+_batch_key = None
+
+
+def _batch_worker_init(key_loader, key_data):
+    global _batch_key
+    _batch_key = key_loader(key_data)
+
+
+def _sign_worker(files):
+    (datafile, output) = files
+    result = {"datafile": datafile, "output": output or datafile}
+    try:
+        with open(datafile, "rb") as f:
+            result["size"] = _sign_file(_batch_key, f, output)
+        result["status"] = "signed"
+    except (esptool.FatalError, IOError, OSError, ecdsa.keys.BadSignatureError) as e:
+        result.update({"status": "error", "error": str(e)})
+    return result
+
+
+def _verify_worker(files):
+    (datafile, _) = files
+    result = {"datafile": datafile}
+    try:
+        with open(datafile, "rb") as f:
+            binary_content = f.read()
+        result["size"] = len(binary_content) - 68
+        _verify_signed_data(_batch_key, binary_content)
+        result["status"] = "valid"
+    except esptool.FatalError as e:
+        result.update({"status": "invalid", "error": str(e)})
+    except (IOError, OSError, struct.error) as e:
+        result.update({"status": "error", "error": str(e)})
+    return result
+
+
+def _run_batch(args, worker, key_loader):
+    """ Run 'worker' for each file in the batch, using a process pool.
+
+    Each worker process loads the key once, using 'key_loader' on the
+    key file contents. Prints and optionally saves the results, which are returned.
+    """
+    files = _batch_file_list(args)
+    key_data = args.keyfile.read()
+    key_loader(key_data)  # check the key before starting any workers
+
+    jobs = args.jobs or multiprocessing.cpu_count()
+    jobs = min(jobs, len(files))
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, _batch_worker_init, (key_loader, key_data))
+        try:
+            results = pool.map(worker, files)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        _batch_worker_init(key_loader, key_data)
+        results = [worker(f) for f in files]
+
+    for r in results:
+        print("%-8s %s%s" % (r["status"], r["datafile"], (": " + r["error"]) if "error" in r else ""))
+    if args.results is not None:
+        json.dump(results, args.results, indent=2, sort_keys=True)
+        args.results.write("\n")
+        print("Results written to %s" % args.results.name)
+    return results
+
+
+def sign_data_batch(args):
+    """ Sign many data files with the same ECDSA private key """
+    results = _run_batch(args, _sign_worker, _ecdsa_signing_key_from_pem)
+    errors = len([r for r in results if r["status"] != "signed"])
+    print("Signed %d of %d files with key %s" % (len(results) - errors, len(results), args.keyfile.name))
+    if errors:
+        raise esptool.FatalError("%d files could not be signed" % errors)
+
+
+def verify_signature_batch(args):
+    """ Verify the signatures of many signed data files with the same ECDSA public key """
+    results = _run_batch(args, _verify_worker, _load_verifying_key)
+    failed = len([r for r in results if r["status"] != "valid"])
+    print("%d of %d signatures are valid" % (len(results) - failed, len(results)))
+    if failed:
+        raise esptool.FatalError("%d files do not have a valid signature" % failed)
+
+
 def extract_public_key(args):
     """ Load an ECDSA private key and extract the embedded public key as raw binary data. """
     sk = _load_ecdsa_signing_key(args)
@@ -262,6 +538,58 @@ def _flash_encryption_tweak_range(flash_crypt_config=0xF):
     return tweak_range
 
 
+class FlashEncryptionTweak(object):
+    """ Derives the per-block AES keys used by ESP32 flash encryption.
+
+    Each offset bit k (5-23) flips a fixed set of key bits, so for a
+    given FLASH_CRYPT_CONFIG the key bits flipped by k are precomputed as
+    a 256-bit XOR mask. These are combined into two tables, indexed by
+    the low and high halves of the offset bits, so deriving the key for
+    any offset is two XORs.
+    """
+    LOW_BITS = 9  # offset bits 5-13 index the low table, bits 14-23 the high table
+
+    def __init__(self, key, flash_crypt_config=0xF):
+        assert len(key) == 32
+        self.key = esptool.bytes_to_int(key)
+        masks = _flash_encryption_tweak_masks(_flash_encryption_tweak_range(flash_crypt_config))
+        self._low = self._mask_table(masks[5:5 + self.LOW_BITS])
+        self._high = self._mask_table(masks[5 + self.LOW_BITS:24])
+
+    @staticmethod
+    def _mask_table(masks):
+        """ Return a table of the combined XOR mask for each combination of 'masks' """
+        table = [0]
+        for mask in masks:
+            table += [t ^ mask for t in table]
+        return table
+
+    def block_key(self, offset):
+        """ Return the tweaked key for the 32 byte block of flash at 'offset' """
+        offset >>= 5
+        tweaked = self.key ^ self._low[offset & ((1 << self.LOW_BITS) - 1)] ^ self._high[(offset >> self.LOW_BITS) & 0x3FF]
+        return _int_to_bytes(tweaked, 32)
+
+
+def _int_to_bytes(value, length):
+    """ Convert an integer to a big-endian bitstring of 'length' bytes """
+    return binascii.unhexlify("%0*x" % (length * 2, value))
+
+
+def _flash_encryption_tweak_masks(tweak_range):
+    """ Return a list of 24 XOR masks, the nth of which has every key bit
+    flipped when bit n of the flash offset is set (as a big-endian integer,
+    to match esptool.bytes_to_int())
+    """
+    masks = [0] * 24
+    for bit in tweak_range:
+        # note that each byte has a backwards bit order, compared
+        # to how it is looked up in the tweak pattern table - so key
+        # bit 0 is the most significant bit of the integer
+        masks[_FLASH_ENCRYPTION_TWEAK_PATTERN[bit]] |= 1 << (255 - bit)
+    return masks
+
+
 def _flash_encryption_tweak_key(key, offset, tweak_range):
     """Apply XOR "tweak" values to the key, derived from flash offset
     'offset'. This matches the ESP32 hardware flash encryption.
@@ -270,33 +598,128 @@ def _flash_encryption_tweak_key(key, offset, tweak_range):
     generated by _flash_encryption_tweak_range() from the
     FLASH_CRYPT_CONFIG efuse value.
 
-    Return tweaked key
+    Return tweaked key. To tweak many blocks with the same key, use
+    FlashEncryptionTweak which does the mask calculations only once.
     """
-    if esptool.PYTHON2:
-        key = [ord(k) for k in key]
-    else:
-        key = list(key)
     assert len(key) == 32
+    tweaked = esptool.bytes_to_int(key)
+    for (bit, mask) in enumerate(_flash_encryption_tweak_masks(tweak_range)):
+        if offset & (1 << bit):
+            tweaked ^= mask
+    return _int_to_bytes(tweaked, 32)
 
-    offset_bits = [(offset & (1 << x)) != 0 for x in range(24)]
 
-    for bit in tweak_range:
-        if offset_bits[_FLASH_ENCRYPTION_TWEAK_PATTERN[bit]]:
-            # note that each byte has a backwards bit order, compared
-            # to how it is looked up in the tweak pattern table
-            key[bit // 8] ^= 1 << (7 - (bit % 8))
+def generate_flash_encryption_key(args):
+    args.key_file.write(os.urandom(32))
 
-    if esptool.PYTHON2:
-        return b"".join(chr(k) for k in key)
-    else:
-        return bytes(key)
 
+def _flash_encryption_blocks(tweak, data, flash_offs, do_decrypt):
+    """ Encrypt or decrypt 'data', a multiple of 16 bytes long, which is at
+    offset 'flash_offs' in flash. Returns the result.
+    """
+    # note AES is used inverted for flash encryption, so
+    # "decrypting" flash uses AES encrypt algorithm and vice
+    # versa. (This does not weaken AES.)
+    backend = aes_backend()
+    aes_operation = backend.encrypt if do_decrypt else backend.decrypt
 
-def generate_flash_encryption_key(args):
-    args.key_file.write(os.urandom(32))
+    data = reverse_blocks(data)  # reverse input block byte order
+    result = []
+    offs = 0
+    while offs < len(data):
+        # each bit of the flash encryption key is XORed with tweak bits derived from the offset of 32 byte block of flash
+        block_offs = flash_offs + offs
+        end = offs + 32 - (block_offs % 32)
+        result.append(aes_operation(tweak.block_key(block_offs), data[offs:end]))
+        offs = end
+
+    return reverse_blocks(b"".join(result))  # reverse output block byte order
 
 
-def _flash_encryption_operation(output_file, input_file, flash_address, keyfile, flash_crypt_conf, do_decrypt):
+# Flash encryption reads and writes data in buffers of this size
+FLASH_ENCRYPTION_BUFFER_SIZE = 0x10000
+
+# Parallel flash encryption splits the input into chunks of this size,
+# each chunk is encrypted or decrypted by a worker process
+PARALLEL_CHUNK_SIZE = 0x40000
+
+_worker_state = None
+
+
+def _flash_encryption_worker_init(key, flash_crypt_conf, do_decrypt, input_name, output_name, backend_name):
+    global _worker_state
+    select_aes_backend(backend_name)
+    _worker_state = (FlashEncryptionTweak(key, flash_crypt_conf), do_decrypt, input_name, output_name)
+
+
+def _flash_encryption_worker(chunk):
+    """ Encrypt or decrypt one chunk of the input file into the output file,
+    both files are memory-mapped and the chunk is at the same position in each.
+    """
+    (tweak, do_decrypt, input_name, output_name) = _worker_state
+    (file_offs, length, flash_offs) = chunk
+    with open(input_name, "rb") as f:
+        input_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            data = _flash_encryption_blocks(tweak, input_map[file_offs:file_offs + length], flash_offs, do_decrypt)
+        finally:
+            input_map.close()
+    with open(output_name, "r+b") as f:
+        output_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE)
+        try:
+            output_map[file_offs:file_offs + length] = data
+        finally:
+            output_map.close()
+
+
+def _is_regular_file(f):
+    """ Return True if file object 'f' is a regular file which can be reopened by name """
+    try:
+        return stat.S_ISREG(os.fstat(f.fileno()).st_mode) and os.path.isfile(f.name)
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        return False
+
+
+def _flash_encryption_parallel(output_file, input_file, flash_address, key, flash_crypt_conf, do_decrypt, jobs):
+    """ Encrypt or decrypt all complete 16 byte blocks from the current position of
+    'input_file' to the same position in 'output_file', using a pool of 'jobs' processes.
+
+    Both files have to be regular files, as they are memory-mapped by the workers.
+    Leaves both files positioned after the data that was processed, any final partial
+    block is left for the caller. Returns the number of bytes processed.
+    """
+    chunk_size = PARALLEL_CHUNK_SIZE
+    assert chunk_size % 32 == 0
+    start = input_file.tell()
+    length = os.fstat(input_file.fileno()).st_size - start
+    length -= length % 16
+    if length <= 0:
+        return 0
+
+    output_file.seek(start)
+    output_file.truncate(start + length)
+    output_file.flush()
+
+    chunks = [(offs, min(chunk_size, start + length - offs), flash_address + offs)
+              for offs in range(start, start + length, chunk_size)]
+    pool = multiprocessing.Pool(jobs, _flash_encryption_worker_init,
+                                (key, flash_crypt_conf, do_decrypt, input_file.name, output_file.name, aes_backend().NAME))
+    try:
+        for _ in pool.imap_unordered(_flash_encryption_worker, chunks):
+            pass
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    input_file.seek(start + length)
+    output_file.seek(start + length)
+    return length
+
+
+def _flash_encryption_operation(output_file, input_file, flash_address, keyfile, flash_crypt_conf, do_decrypt, jobs=1):
     key = _load_hardware_key(keyfile)
 
     if flash_address % 16 != 0:
@@ -304,55 +727,68 @@ def _flash_encryption_operation(output_file, input_file, flash_address, keyfile,
 
     if flash_crypt_conf == 0:
         print("WARNING: Setting FLASH_CRYPT_CONF to zero is not recommended")
-    tweak_range = _flash_encryption_tweak_range(flash_crypt_conf)
+    tweak = FlashEncryptionTweak(key, flash_crypt_conf)
+
+    # use the underlying binary stream if reading or writing Python 3 stdin/stdout
+    input_file = getattr(input_file, "buffer", input_file)
+    output_file = getattr(output_file, "buffer", output_file)
 
-    aes = None
+    if jobs == 0:
+        jobs = multiprocessing.cpu_count()
+    if jobs > 1:
+        if _is_regular_file(input_file) and _is_regular_file(output_file):
+            _flash_encryption_parallel(output_file, input_file, flash_address, key, flash_crypt_conf, do_decrypt, jobs)
+        else:
+            print("Note: Input and output must both be regular files to use --jobs, processing serially")
+
+    try:
+        offs = input_file.tell()
+    except (IOError, OSError):
+        offs = 0  # reading from a pipe
     while True:
-        block_offs = flash_address + input_file.tell()
-        block = input_file.read(16)
-        if len(block) == 0:
+        data = input_file.read(FLASH_ENCRYPTION_BUFFER_SIZE)
+        if len(data) == 0:
             break
-        elif len(block) < 16:
+        if len(data) % 16 != 0:  # only at the end of the input
             if do_decrypt:
                 raise esptool.FatalError("Data length is not a multiple of 16 bytes")
-            pad = 16 - len(block)
-            block = block + os.urandom(pad)
+            pad = 16 - (len(data) % 16)
+            data += os.urandom(pad)
             print("Note: Padding with %d bytes of random data (encrypted data must be multiple of 16 bytes long)" % pad)
 
-        if (block_offs % 32 == 0) or aes is None:
-            # each bit of the flash encryption key is XORed with tweak bits derived from the offset of 32 byte block of flash
-            block_key = _flash_encryption_tweak_key(key, block_offs, tweak_range)
-            aes = pyaes.AESModeOfOperationECB(block_key)
-
-        block = block[::-1]  # reverse input block byte order
-
-        # note AES is used inverted for flash encryption, so
-        # "decrypting" flash uses AES encrypt algorithm and vice
-        # versa. (This does not weaken AES.)
-        if do_decrypt:
-            block = aes.encrypt(block)
-        else:
-            block = aes.decrypt(block)
-
-        block = block[::-1]  # reverse output block byte order
-        output_file.write(block)
+        output_file.write(_flash_encryption_blocks(tweak, data, flash_address + offs, do_decrypt))
+        offs += len(data)
+    output_file.flush()
 
 
 def decrypt_flash_data(args):
-    return _flash_encryption_operation(args.output, args.encrypted_file, args.address, args.keyfile, args.flash_crypt_conf, True)
+    return _flash_encryption_operation(args.output, args.encrypted_file, args.address, args.keyfile, args.flash_crypt_conf, True,
+                                       getattr(args, 'jobs', 1))
 
 
 def encrypt_flash_data(args):
-    return _flash_encryption_operation(args.output, args.plaintext_file, args.address, args.keyfile, args.flash_crypt_conf, False)
+    return _flash_encryption_operation(args.output, args.plaintext_file, args.address, args.keyfile, args.flash_crypt_conf, False,
+                                       getattr(args, 'jobs', 1))
 
 
 def main():
     parser = argparse.ArgumentParser(description='espsecure.py v%s - ESP32 Secure Boot & Flash Encryption tool' % esptool.__version__, prog='espsecure')
 
+    parser.add_argument('--aes-backend', help='AES implementation to use. Default is the fastest one installed.',
+                        choices=[b.NAME for b in AES_BACKENDS], default=os.environ.get('ESPSECURE_AES_BACKEND', None))
+
     subparsers = parser.add_subparsers(
         dest='operation',
         help='Run espsecure.py {command} -h for additional help')
 
+    def add_batch_arguments(parent):
+        parent.add_argument('--manifest', '-m', help='JSON manifest listing the data files: [filename, {"datafile": filename, "output": filename}, ...]',
+                            type=argparse.FileType('r'))
+        parent.add_argument('--jobs', '-j', help="Number of worker processes, default 0 uses all CPUs.", type=int, default=0)
+        parent.add_argument('--results', '-r', help="Write a JSON table of the results for each file to this file.",
+                            type=argparse.FileType('w'))
+        parent.add_argument('datafiles', help="Data files (in addition to any in the manifest)", nargs='*')
+
     p = subparsers.add_parser('digest_secure_bootloader',
                               help='Take a bootloader binary image and a secure boot key, and output a combined digest+binary ' +
                               'suitable for flashing along with the precalculated secure boot key.')
@@ -381,6 +817,20 @@ def main():
                    type=argparse.FileType('rb'), required=True)
     p.add_argument('datafile', help="Signed data file to verify signature.", type=argparse.FileType('rb'))
 
+    p = subparsers.add_parser('sign_data_batch',
+                              help='Sign many data files with the same key, like sign_data, using all CPU cores.')
+    p.add_argument('--keyfile', '-k', help="Private key file for signing. Key is in PEM format, ECDSA NIST256p curve.",
+                   type=argparse.FileType('rb'), required=True)
+    p.add_argument('--output-dir', '-d', help="Directory to write signed files into. Default is to append signatures to existing files.")
+    add_batch_arguments(p)
+
+    p = subparsers.add_parser('verify_signature_batch',
+                              help='Verify many data files previously signed by "sign_data", using the same key.')
+    p.add_argument('--keyfile', '-k', help="Public key file for verification. Can be private or public key in PEM format, " +
+                   "or a binary public key produced by extract_public_key command.",
+                   type=argparse.FileType('rb'), required=True)
+    add_batch_arguments(p)
+
     p = subparsers.add_parser('extract_public_key',
                               help='Extract the public verification key for signatures, save it as a raw binary file.')
     p.add_argument('--keyfile', '-k', help="Private key file (PEM format) to extract the public verification key from.", type=argparse.FileType('rb'),
@@ -399,29 +849,37 @@ def main():
     p.add_argument('key_file', help="File to write 32 byte digest into", type=argparse.FileType('wb'))
 
     p = subparsers.add_parser('decrypt_flash_data', help='Decrypt some data read from encrypted flash (using known key)')
-    p.add_argument('encrypted_file', help="File with encrypted flash contents", type=argparse.FileType('rb'))
+    p.add_argument('encrypted_file', help="File with encrypted flash contents, or - to read from stdin", type=argparse.FileType('rb'))
     p.add_argument('--keyfile', '-k', help="File with flash encryption key", type=argparse.FileType('rb'),
                    required=True)
-    p.add_argument('--output', '-o', help="Output file for plaintext data.", type=argparse.FileType('wb'),
+    p.add_argument('--output', '-o', help="Output file for plaintext data, or - to write to stdout.", type=argparse.FileType('wb'),
                    required=True)
     p.add_argument('--address', '-a', help="Address offset in flash that file was read from.", required=True, type=esptool.arg_auto_int)
     p.add_argument('--flash_crypt_conf', help="Override FLASH_CRYPT_CONF efuse value (default is 0XF).", required=False, default=0xF, type=esptool.arg_auto_int)
+    p.add_argument('--jobs', '-j', help="Number of worker processes to use for large files, 0 to use all CPUs (default is 1).",
+                   type=int, default=1)
 
     p = subparsers.add_parser('encrypt_flash_data', help='Encrypt some data suitable for encrypted flash (using known key)')
     p.add_argument('--keyfile', '-k', help="File with flash encryption key", type=argparse.FileType('rb'),
                    required=True)
-    p.add_argument('--output', '-o', help="Output file for encrypted data.", type=argparse.FileType('wb'),
+    p.add_argument('--output', '-o', help="Output file for encrypted data, or - to write to stdout.", type=argparse.FileType('wb'),
                    required=True)
     p.add_argument('--address', '-a', help="Address offset in flash where file will be flashed.", required=True, type=esptool.arg_auto_int)
     p.add_argument('--flash_crypt_conf', help="Override FLASH_CRYPT_CONF efuse value (default is 0XF).", required=False, default=0xF, type=esptool.arg_auto_int)
-    p.add_argument('plaintext_file', help="File with plaintext content for encrypting", type=argparse.FileType('rb'))
+    p.add_argument('--jobs', '-j', help="Number of worker processes to use for large files, 0 to use all CPUs (default is 1).",
+                   type=int, default=1)
+    p.add_argument('plaintext_file', help="File with plaintext content for encrypting, or - to read from stdin", type=argparse.FileType('rb'))
 
     args = parser.parse_args()
+    if getattr(getattr(args, 'output', None), 'name', None) == '<stdout>':
+        sys.stdout = sys.stderr  # keep messages out of the output data
     print('espsecure.py v%s' % esptool.__version__)
     if args.operation is None:
         parser.print_help()
         parser.exit(1)
 
+    select_aes_backend(args.aes_backend)
+
     # each 'operation' is a module-level function of the same name
     operation_func = globals()[args.operation]
     operation_func(args)
@@ -21,10 +21,14 @@ from __future__ import division, print_function
 import argparse
 import base64
 import binascii
+import collections
 import copy
+import functools
 import hashlib
 import inspect
-import io
+import json
+import math
+import mmap
 import os
 import shlex
 import struct
@@ -117,6 +121,21 @@ def stub_and_esp32_function_only(func):
     return check_supported_function(func, lambda o: o.IS_STUB or o.CHIP_NAME == "ESP32")
 
 
+def metrics_phase(phase):
+    """ Attribute for an ESPLoader function whose run time is recorded as a session phase, if metrics are enabled """
+    def decorator(func):
+        @functools.wraps(func)
+        def inner(*args, **kwargs):
+            obj = args[0]
+            t = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                obj.record_phase(phase, time.time() - t)
+        return inner
+    return decorator
+
+
 PYTHON2 = sys.version_info[0] < 3  # True if on pre-Python 3
 
 # Function to return nth byte of a bitstring
@@ -128,6 +147,14 @@ else:
     def byte(bitstr, index):
         return bitstr[index]
 
+# Function to return the value of a bitstring as a (big endian) integer
+if PYTHON2:
+    def bytes_to_int(bitstr):
+        return int(binascii.hexlify(bitstr), 16) if len(bitstr) > 0 else 0
+else:
+    def bytes_to_int(bitstr):
+        return int.from_bytes(bitstr, 'big')
+
 # Provide a 'basestring' class on Python 3
 try:
     basestring
@@ -185,6 +212,13 @@ class ESPLoader(object):
 
     FLASH_WRITE_SIZE = 0x400
 
+    # Number of ESP_READ_REG requests which can be in flight at once (see read_regs),
+    # also used by the stub loaders as their command buffering is not documented
+    READ_REG_PIPELINE_DEPTH = 8
+
+    # Registers holding the chip's identity (MAC, chip type, features), see read_identity_reg()
+    IDENTITY_REGS = []
+
     # Default baudrate. The ROM auto-bauds, so we can use more or less whatever we want.
     ESP_ROM_BAUD    = 115200
 
@@ -194,6 +228,9 @@ class ESPLoader(object):
     # Initial state for the checksum routine
     ESP_CHECKSUM_MAGIC = 0xef
 
+    # Large blobs are checksummed in chunks of this size, see checksum()
+    CHECKSUM_CHUNK_SIZE = 0x1000
+
     # Flash sector size, minimum unit of erase.
     FLASH_SECTOR_SIZE = 0x1000
 
@@ -206,7 +243,7 @@ class ESPLoader(object):
     # The number of bytes in the UART response that signify command status
     STATUS_BYTES_LENGTH = 2
 
-    def __init__(self, port=DEFAULT_PORT, baud=ESP_ROM_BAUD, trace_enabled=False):
+    def __init__(self, port=DEFAULT_PORT, baud=ESP_ROM_BAUD, trace_enabled=False, trace_capture=None, metrics=None, timeouts=None):
         """Base constructor for ESPLoader bootloader interaction
 
         Don't call this constructor, either instantiate ESP8266ROM
@@ -217,18 +254,30 @@ class ESPLoader(object):
         loaders. Subclasses replace the functions they don't support
         with ones which throw NotImplementedInROMError().
 
+        If trace_capture is set, it is a TraceCapture which records
+        all raw serial traffic.
+
+        If metrics is set, it is a SessionMetrics which records command
+        counts, latencies & phase timings.
+
+        timeouts is an AdaptiveTimeouts which learns timeouts for slow
+        operations (a new one, with no learned timeouts, by default).
         """
         if isinstance(port, basestring):
             self._port = serial.serial_for_url(port)
         else:
             self._port = port
-        self._slip_reader = slip_reader(self._port, self.trace)
+        self._trace_enabled = trace_enabled
+        self._trace_capture = trace_capture
+        self._metrics = metrics
+        self._timeouts = timeouts if timeouts is not None else AdaptiveTimeouts()
+        self._identity = None
+        self._slip_reader = slip_reader(self._port, self.trace if trace_enabled else None, trace_capture)
         # setting baud rate in a separate step is a workaround for
         # CH341 driver on some Linux versions (this opens at 9600 then
         # sets), shouldn't matter for other platforms/drivers. See
         # https://github.com/espressif/esptool/issues/44#issuecomment-107094446
         self._set_port_baudrate(baud)
-        self._trace_enabled = trace_enabled
         # set write timeout, to prevent esptool blocked at write forever.
         try:
             self._port.write_timeout = DEFAULT_SERIAL_WRITE_TIMEOUT
@@ -244,7 +293,8 @@ class ESPLoader(object):
             raise FatalError("Failed to set baud rate %d. The driver may not support this rate." % baud)
 
     @staticmethod
-    def detect_chip(port=DEFAULT_PORT, baud=ESP_ROM_BAUD, connect_mode='default_reset', trace_enabled=False):
+    def detect_chip(port=DEFAULT_PORT, baud=ESP_ROM_BAUD, connect_mode='default_reset', trace_enabled=False, trace_capture=None,
+                    metrics=None, timeouts=None):
         """ Use serial access to detect the chip type.
 
         We use the UART's datecode register for this, it's mapped at
@@ -255,7 +305,7 @@ class ESPLoader(object):
         This routine automatically performs ESPLoader.connect() (passing
         connect_mode parameter) as part of querying the chip.
         """
-        detect_port = ESPLoader(port, baud, trace_enabled=trace_enabled)
+        detect_port = ESPLoader(port, baud, trace_enabled=trace_enabled, trace_capture=trace_capture, metrics=metrics, timeouts=timeouts)
         detect_port.connect(connect_mode)
         try:
             print('Detecting chip type...', end='')
@@ -265,7 +315,8 @@ class ESPLoader(object):
             for cls in [ESP8266ROM, ESP32ROM]:
                 if date_reg == cls.DATE_REG_VALUE:
                     # don't connect a second time
-                    inst = cls(detect_port._port, baud, trace_enabled=trace_enabled)
+                    inst = cls(detect_port._port, baud, trace_enabled=trace_enabled, trace_capture=trace_capture, metrics=metrics,
+                               timeouts=detect_port._timeouts)
                     print(' %s' % inst.CHIP_NAME, end='')
                     return inst
         finally:
@@ -276,13 +327,31 @@ class ESPLoader(object):
     def read(self):
         return next(self._slip_reader)
 
-    """ Write bytes to the serial port while performing SLIP escaping """
+    """ Write bytes to the serial port while performing SLIP escaping
+
+    'packet' can also be a tuple of byte strings, which are framed back-to-back
+    as one SLIP packet. This avoids concatenating large data blocks to their headers.
+
+    Returns the number of bytes written, after framing.
+    """
     def write(self, packet):
-        buf = b'\xc0' \
-              + (packet.replace(b'\xdb',b'\xdb\xdd').replace(b'\xc0',b'\xdb\xdc')) \
-              + b'\xc0'
-        self.trace("Write %d bytes: %s", len(buf), HexFormatter(buf))
+        if not isinstance(packet, tuple):
+            packet = (packet,)
+        buf = bytearray(b'\xc0')
+        for part in packet:
+            buf += part.replace(b'\xdb',b'\xdb\xdd').replace(b'\xc0',b'\xdb\xdc')
+        buf += b'\xc0'
+        if self._trace_capture is not None:
+            self._trace_capture.record(TraceCapture.DIR_WRITE, buf)
+        if self._trace_enabled:
+            self.trace("Write %d bytes: %s", len(buf), HexFormatter(buf))
         self._port.write(buf)
+        return len(buf)
+
+    def record_phase(self, phase, seconds):
+        """ Record time spent in a phase of the session (connect, erase, write, etc.), if metrics are enabled """
+        if self._metrics is not None:
+            self._metrics.record_phase(phase, seconds)
 
     def trace(self, message, *format_args):
         if self._trace_enabled:
@@ -296,18 +365,38 @@ class ESPLoader(object):
             prefix = "TRACE +%.3f " % delta
             print(prefix + (message % format_args))
 
-    """ Calculate checksum of a blob, as it is defined by the ROM """
+    """ Calculate checksum of a blob, as it is defined by the ROM
+
+    The XOR of all bytes is calculated by loading the blob as one big integer
+    and folding it in half until only one byte is left, instead of looping over
+    every byte in Python. Large blobs are first XORed together in chunks of
+    CHECKSUM_CHUNK_SIZE bytes, as folding one multi-megabyte integer is slow.
+    """
     @staticmethod
     def checksum(data, state=ESP_CHECKSUM_MAGIC):
-        for b in data:
-            if type(b) is int:  # python 2/3 compat
-                state ^= b
-            else:
-                state ^= ord(b)
-
-        return state
-
-    """ Send a request and read the response """
+        chunk_size = ESPLoader.CHECKSUM_CHUNK_SIZE
+        if len(data) > chunk_size * 16:
+            if not PYTHON2:
+                data = memoryview(data)  # slice without copying
+            value = 0
+            for offs in range(0, len(data), chunk_size):
+                value ^= bytes_to_int(data[offs:offs + chunk_size])
+            value_len = chunk_size
+        else:
+            value = bytes_to_int(data)
+            value_len = len(data)
+        width = 8
+        while width < value_len * 8:
+            width *= 2
+        while width > 8:
+            width //= 2
+            value = (value >> width) ^ (value & ((1 << width) - 1))
+        return state ^ value
+
+    """ Send a request and read the response
+
+    'data' can be a tuple of byte strings, see write().
+    """
     def command(self, op=None, data=b"", chk=0, wait_response=True, timeout=DEFAULT_TIMEOUT):
         saved_timeout = self._port.timeout
         new_timeout = min(timeout, MAX_TIMEOUT)
@@ -316,32 +405,55 @@ class ESPLoader(object):
 
         try:
             if op is not None:
-                self.trace("command op=0x%02x data len=%s wait_response=%d timeout=%.3f data=%s",
-                           op, len(data), 1 if wait_response else 0, timeout, HexFormatter(data))
-                pkt = struct.pack(b'<BBHI', 0x00, op, len(data), chk) + data
-                self.write(pkt)
+                if not isinstance(data, tuple):
+                    data = (data,)
+                data_len = sum(len(part) for part in data)
+                if self._trace_enabled:
+                    self.trace("command op=0x%02x data len=%s wait_response=%d timeout=%.3f data=%s",
+                               op, data_len, 1 if wait_response else 0, timeout, HexFormatter(data))
+                start = time.time() if self._metrics is not None else None
+                written = self.write((struct.pack(b'<BBHI', 0x00, op, data_len, chk),) + data)
+                if self._metrics is not None:
+                    self._metrics.record_sent(op, written)
+            else:
+                start = None
 
             if not wait_response:
                 return
 
-            # tries to get a response until that response has the
-            # same operation as the request or a retries limit has
-            # exceeded. This is needed for some esp8266s that
-            # reply with more sync responses than expected.
-            for retry in range(100):
-                p = self.read()
-                if len(p) < 8:
-                    continue
-                (resp, op_ret, len_ret, val) = struct.unpack('<BBHI', p[:8])
-                if resp != 1:
-                    continue
-                data = p[8:]
-                if op is None or op_ret == op:
-                    return val, data
+            return self._read_response(op, start)
         finally:
             if new_timeout != saved_timeout:
                 self._port.timeout = saved_timeout
 
+    def _read_response(self, op=None, start=None):
+        """ Read the response to a previously sent command, returns (val, data)
+
+        If op is set, responses for any other operation are skipped.
+        'start' is the time the command was sent, for metrics.
+        """
+        # tries to get a response until that response has the
+        # same operation as the request or a retries limit has
+        # exceeded. This is needed for some esp8266s that
+        # reply with more sync responses than expected.
+        for retry in range(100):
+            try:
+                p = self.read()
+            except PacketTimeoutError:
+                if self._metrics is not None:
+                    self._metrics.record_timeout(op)
+                raise
+            if len(p) < 8:
+                continue
+            (resp, op_ret, len_ret, val) = struct.unpack('<BBHI', p[:8])
+            if resp != 1:
+                continue
+            data = p[8:]
+            if op is None or op_ret == op:
+                if self._metrics is not None:
+                    self._metrics.record_response(op_ret, len(p), retry, None if start is None else time.time() - start)
+                return val, data
+
         raise FatalError("Response doesn't match request")
 
     def check_command(self, op_description, op=None, data=b'', chk=0, timeout=DEFAULT_TIMEOUT):
@@ -361,6 +473,8 @@ class ESPLoader(object):
         status_bytes = data[-self.STATUS_BYTES_LENGTH:]
         # we only care if the first one is non-zero. If it is, the second byte is a reason.
         if byte(status_bytes, 0) != 0:
+            if self._metrics is not None:
+                self._metrics.record_error(op)
             raise FatalError.WithResult('Failed to %s' % op_description, status_bytes)
 
         # if we had more data than just the status bytes, return it as the result
@@ -370,9 +484,36 @@ class ESPLoader(object):
         else:  # otherwise, just return the 'val' field which comes from the reply header (this is used by read_reg)
             return val
 
+    def learned_timeout(self, operation, size, default_timeout):
+        """ Timeout for an operation whose duration depends on 'size' (in bytes, or None for a fixed size operation)
+
+        Uses the timeout learned from earlier runs of this operation on this type of device if there
+        are enough of them, otherwise default_timeout.
+        """
+        timeout = self._timeouts.timeout(self._timeout_key(operation), size, default_timeout)
+        if self._trace_enabled and timeout != default_timeout:
+            self.trace("Learned timeout for %s of %s bytes: %.3fs (default %.3fs)", operation, size, timeout, default_timeout)
+        return timeout
+
+    def record_duration(self, operation, size, seconds):
+        """ Record how long a successful run of a size-dependent operation took, see learned_timeout() """
+        self._timeouts.record(self._timeout_key(operation), size, seconds)
+
+    def _timeout_key(self, operation):
+        # ROM & stub loaders handle erasing and writing differently, so are learned separately
+        return "%s_%s" % (operation, "stub" if self.IS_STUB else "rom")
+
+    def _check_command_timed(self, operation, size, default_timeout, op_description, op=None, data=b'', chk=0):
+        """ check_command() for a size-dependent operation, with a learned timeout (see learned_timeout()) """
+        timeout = self.learned_timeout(operation, size, default_timeout)
+        t = time.time()
+        result = self.check_command(op_description, op, data, chk, timeout=timeout)
+        self.record_duration(operation, size, time.time() - t)
+        return result
+
     def flush_input(self):
         self._port.flushInput()
-        self._slip_reader = slip_reader(self._port, self.trace)
+        self._slip_reader = slip_reader(self._port, self.trace if self._trace_enabled else None, self._trace_capture)
 
     def sync(self):
         self.command(self.ESP_SYNC, b'\x07\x07\x12\x20' + 32 * b'\x55',
@@ -449,11 +590,13 @@ class ESPLoader(object):
                 last_error = e
         return last_error
 
+    @metrics_phase("connect")
     def connect(self, mode='default_reset'):
         """ Try connecting repeatedly until successful, or giving up """
         print('Connecting...', end='')
         sys.stdout.flush()
         last_error = None
+        self._identity = None
 
         try:
             for _ in range(7):
@@ -477,6 +620,56 @@ class ESPLoader(object):
             raise FatalError.WithResult("Failed to read register address %08x" % addr, data)
         return val
 
+    def read_regs(self, addrs):
+        """ Read a sequence of memory addresses in target, returns a list of values.
+
+        Up to READ_REG_PIPELINE_DEPTH requests are sent back-to-back before
+        any response is read, so the serial round trip is paid once per batch
+        instead of once per word.
+        """
+        values = []
+        depth = self.READ_REG_PIPELINE_DEPTH
+        saved_timeout = self._port.timeout
+        self._port.timeout = DEFAULT_TIMEOUT
+        try:
+            for i in range(0, len(addrs), depth):
+                batch = addrs[i:i + depth]
+                start = time.time() if self._metrics is not None else None
+                for addr in batch:
+                    self.command(self.ESP_READ_REG, struct.pack('<I', addr), wait_response=False)
+                for n, addr in enumerate(batch):
+                    val, data = self._read_response(self.ESP_READ_REG, start)
+                    if byte(data, 0) != 0:
+                        # read the rest of the batch's responses, so they aren't mistaken for responses to later commands
+                        try:
+                            for _ in batch[n + 1:]:
+                                self._read_response(self.ESP_READ_REG)
+                        except FatalError:
+                            self.flush_input()
+                        raise FatalError.WithResult("Failed to read register address %08x" % addr, data)
+                    values.append(val)
+        finally:
+            self._port.timeout = saved_timeout
+        return values
+
+    def read_identity_reg(self, addr):
+        """ Read one of the IDENTITY_REGS
+
+        The first call reads all of IDENTITY_REGS in one batch, they are then
+        cached for the rest of the session (until invalidate_identity() is called)
+        as each is needed several times at startup (chip description, features, MAC).
+        """
+        if self._identity is None:
+            self._identity = dict(zip(self.IDENTITY_REGS, self.read_regs(self.IDENTITY_REGS)))
+        try:
+            return self._identity[addr]
+        except KeyError:
+            return self.read_reg(addr)
+
+    def invalidate_identity(self):
+        """ Discard the cached IDENTITY_REGS, ie after burning efuses """
+        self._identity = None
+
     """ Write to memory address in target """
     def write_reg(self, addr, value, mask=0xFFFFFFFF, delay_us=0):
         return self.check_command("write target memory", self.ESP_WRITE_REG,
@@ -502,7 +695,7 @@ class ESPLoader(object):
     """ Send a block of an image to RAM """
     def mem_block(self, data, seq):
         return self.check_command("write to target RAM", self.ESP_MEM_DATA,
-                                  struct.pack('<IIII', len(data), seq, 0, 0) + data,
+                                  (struct.pack('<IIII', len(data), seq, 0, 0), data),
                                   self.checksum(data))
 
     """ Leave download mode and run the application """
@@ -525,18 +718,19 @@ class ESPLoader(object):
 
     Returns number of blocks (of size self.FLASH_WRITE_SIZE) to write.
     """
+    @metrics_phase("erase")
     def flash_begin(self, size, offset):
         num_blocks = (size + self.FLASH_WRITE_SIZE - 1) // self.FLASH_WRITE_SIZE
         erase_size = self.get_erase_size(offset, size)
 
         t = time.time()
         if self.IS_STUB:
-            timeout = DEFAULT_TIMEOUT
-        else:
-            timeout = timeout_per_mb(ERASE_REGION_TIMEOUT_PER_MB, size)  # ROM performs the erase up front
-        self.check_command("enter Flash download mode", self.ESP_FLASH_BEGIN,
-                           struct.pack('<IIII', erase_size, num_blocks, self.FLASH_WRITE_SIZE, offset),
-                           timeout=timeout)
+            self.check_command("enter Flash download mode", self.ESP_FLASH_BEGIN,
+                               struct.pack('<IIII', erase_size, num_blocks, self.FLASH_WRITE_SIZE, offset))
+        else:  # ROM performs the erase up front
+            self._check_command_timed("erase", size, timeout_per_mb(ERASE_REGION_TIMEOUT_PER_MB, size),
+                                      "enter Flash download mode", self.ESP_FLASH_BEGIN,
+                                      struct.pack('<IIII', erase_size, num_blocks, self.FLASH_WRITE_SIZE, offset))
         if size != 0 and not self.IS_STUB:
             print("Took %.2fs to erase flash block" % (time.time() - t))
         return num_blocks
@@ -545,7 +739,7 @@ class ESPLoader(object):
     def flash_block(self, data, seq, timeout=DEFAULT_TIMEOUT):
         self.check_command("write to target Flash after seq %d" % seq,
                            self.ESP_FLASH_DATA,
-                           struct.pack('<IIII', len(data), seq, 0, 0) + data,
+                           (struct.pack('<IIII', len(data), seq, 0, 0), data),
                            self.checksum(data),
                            timeout=timeout)
 
@@ -573,6 +767,7 @@ class ESPLoader(object):
             raise FatalError("Flash size '%s' is not supported by this chip type. Supported sizes: %s"
                              % (arg, ", ".join(self.FLASH_SIZES.keys())))
 
+    @metrics_phase("stub_upload")
     def run_stub(self, stub=None):
         if stub is None:
             if self.IS_STUB:
@@ -601,6 +796,7 @@ class ESPLoader(object):
         return self.STUB_CLASS(self)
 
     @stub_and_esp32_function_only
+    @metrics_phase("erase")
     def flash_defl_begin(self, size, compsize, offset):
         """ Start downloading compressed data to Flash (performs an erase)
 
@@ -612,14 +808,15 @@ class ESPLoader(object):
         t = time.time()
         if self.IS_STUB:
             write_size = size  # stub expects number of bytes here, manages erasing internally
-            timeout = DEFAULT_TIMEOUT
         else:
             write_size = erase_blocks * self.FLASH_WRITE_SIZE  # ROM expects rounded up to erase block size
-            timeout = timeout_per_mb(ERASE_REGION_TIMEOUT_PER_MB, write_size)  # ROM performs the erase up front
         print("Compressed %d bytes to %d..." % (size, compsize))
-        self.check_command("enter compressed flash mode", self.ESP_FLASH_DEFL_BEGIN,
-                           struct.pack('<IIII', write_size, num_blocks, self.FLASH_WRITE_SIZE, offset),
-                           timeout=timeout)
+        pkt = struct.pack('<IIII', write_size, num_blocks, self.FLASH_WRITE_SIZE, offset)
+        if self.IS_STUB:
+            self.check_command("enter compressed flash mode", self.ESP_FLASH_DEFL_BEGIN, pkt)
+        else:  # ROM performs the erase up front
+            self._check_command_timed("erase", write_size, timeout_per_mb(ERASE_REGION_TIMEOUT_PER_MB, write_size),
+                                      "enter compressed flash mode", self.ESP_FLASH_DEFL_BEGIN, pkt)
         if size != 0 and not self.IS_STUB:
             # (stub erases as it writes, but ROM loaders erase on begin)
             print("Took %.2fs to erase flash block" % (time.time() - t))
@@ -629,7 +826,7 @@ class ESPLoader(object):
     @stub_and_esp32_function_only
     def flash_defl_block(self, data, seq, timeout=DEFAULT_TIMEOUT):
         self.check_command("write compressed data to flash after seq %d" % seq,
-                           self.ESP_FLASH_DEFL_DATA, struct.pack('<IIII', len(data), seq, 0, 0) + data, self.checksum(data), timeout=timeout)
+                           self.ESP_FLASH_DEFL_DATA, (struct.pack('<IIII', len(data), seq, 0, 0), data), self.checksum(data), timeout=timeout)
 
     """ Leave compressed flash mode and run/reboot """
     @stub_and_esp32_function_only
@@ -643,12 +840,12 @@ class ESPLoader(object):
         self.in_bootloader = False
 
     @stub_and_esp32_function_only
+    @metrics_phase("md5_verify")
     def flash_md5sum(self, addr, size):
         # the MD5 command returns additional bytes in the standard
         # command reply slot
-        timeout = timeout_per_mb(MD5_TIMEOUT_PER_MB, size)
-        res = self.check_command('calculate md5sum', self.ESP_SPI_FLASH_MD5, struct.pack('<IIII', addr, size, 0, 0),
-                                 timeout=timeout)
+        res = self._check_command_timed("md5", size, timeout_per_mb(MD5_TIMEOUT_PER_MB, size),
+                                        'calculate md5sum', self.ESP_SPI_FLASH_MD5, struct.pack('<IIII', addr, size, 0, 0))
 
         if len(res) == 32:
             return res.decode("utf-8")  # already hex formatted
@@ -658,6 +855,7 @@ class ESPLoader(object):
             raise FatalError("MD5Sum command returned unexpected result: %r" % res)
 
     @stub_and_esp32_function_only
+    @metrics_phase("baud_change")
     def change_baud(self, baud):
         print("Changing baud rate to %d" % baud)
         # stub takes the new baud rate and the old one
@@ -669,21 +867,23 @@ class ESPLoader(object):
         self.flush_input()
 
     @stub_function_only
+    @metrics_phase("erase")
     def erase_flash(self):
         # depending on flash chip model the erase may take this long (maybe longer!)
-        self.check_command("erase flash", self.ESP_ERASE_FLASH,
-                           timeout=CHIP_ERASE_TIMEOUT)
+        self._check_command_timed("erase_chip", None, CHIP_ERASE_TIMEOUT, "erase flash", self.ESP_ERASE_FLASH)
 
     @stub_function_only
+    @metrics_phase("erase")
     def erase_region(self, offset, size):
         if offset % self.FLASH_SECTOR_SIZE != 0:
             raise FatalError("Offset to erase from must be a multiple of 4096")
         if size % self.FLASH_SECTOR_SIZE != 0:
             raise FatalError("Size of data to erase must be a multiple of 4096")
-        timeout = timeout_per_mb(ERASE_REGION_TIMEOUT_PER_MB, size)
-        self.check_command("erase region", self.ESP_ERASE_REGION, struct.pack('<II', offset, size), timeout=timeout)
+        self._check_command_timed("erase", size, timeout_per_mb(ERASE_REGION_TIMEOUT_PER_MB, size),
+                                  "erase region", self.ESP_ERASE_REGION, struct.pack('<II', offset, size))
 
     @stub_function_only
+    @metrics_phase("read")
     def read_flash(self, offset, length, progress_fn=None):
         # issue a standard bootloader command to trigger the read
         self.check_command("read flash", self.ESP_READ_FLASH,
@@ -939,6 +1139,8 @@ class ESP8266ROM(ESPLoader):
     ESP_OTP_MAC1    = 0x3ff00054
     ESP_OTP_MAC3    = 0x3ff0005c
 
+    IDENTITY_REGS = [0x3ff00050, 0x3ff00054, 0x3ff00058, 0x3ff0005c]  # all 128 bits of efuse
+
     SPI_REG_BASE    = 0x60000200
     SPI_W0_OFFS     = 0x40
     SPI_HAS_MOSI_DLEN_REG = False
@@ -959,10 +1161,10 @@ class ESP8266ROM(ESPLoader):
 
     def get_efuses(self):
         # Return the 128 bits of ESP8266 efuse as a single Python integer
-        return (self.read_reg(0x3ff0005c) << 96 |
-                self.read_reg(0x3ff00058) << 64 |
-                self.read_reg(0x3ff00054) << 32 |
-                self.read_reg(0x3ff00050))
+        return (self.read_identity_reg(0x3ff0005c) << 96 |
+                self.read_identity_reg(0x3ff00058) << 64 |
+                self.read_identity_reg(0x3ff00054) << 32 |
+                self.read_identity_reg(0x3ff00050))
 
     def get_chip_description(self):
         efuses = self.get_efuses()
@@ -990,15 +1192,15 @@ class ESP8266ROM(ESPLoader):
 
     def chip_id(self):
         """ Read Chip ID from efuse - the equivalent of the SDK system_get_chip_id() function """
-        id0 = self.read_reg(self.ESP_OTP_MAC0)
-        id1 = self.read_reg(self.ESP_OTP_MAC1)
+        id0 = self.read_identity_reg(self.ESP_OTP_MAC0)
+        id1 = self.read_identity_reg(self.ESP_OTP_MAC1)
         return (id0 >> 24) | ((id1 & MAX_UINT24) << 8)
 
     def read_mac(self):
         """ Read MAC from OTP ROM """
-        mac0 = self.read_reg(self.ESP_OTP_MAC0)
-        mac1 = self.read_reg(self.ESP_OTP_MAC1)
-        mac3 = self.read_reg(self.ESP_OTP_MAC3)
+        mac0 = self.read_identity_reg(self.ESP_OTP_MAC0)
+        mac1 = self.read_identity_reg(self.ESP_OTP_MAC1)
+        mac3 = self.read_identity_reg(self.ESP_OTP_MAC3)
         if (mac3 != 0):
             oui = ((mac3 >> 16) & 0xff, (mac3 >> 8) & 0xff, mac3 & 0xff)
         elif ((mac1 >> 16) & 0xff) == 0:
@@ -1041,6 +1243,10 @@ class ESP8266StubLoader(ESP8266ROM):
     def __init__(self, rom_loader):
         self._port = rom_loader._port
         self._trace_enabled = rom_loader._trace_enabled
+        self._trace_capture = rom_loader._trace_capture
+        self._metrics = rom_loader._metrics
+        self._timeouts = rom_loader._timeouts
+        self._identity = rom_loader._identity
         self.flush_input()  # resets _slip_reader
 
     def get_erase_size(self, offset, size):
@@ -1070,6 +1276,9 @@ class ESP32ROM(ESPLoader):
     SPI_REG_BASE   = 0x60002000
     EFUSE_REG_BASE = 0x6001a000
 
+    # efuse words 1 & 2 (MAC), 3 (package, revision & features), 4 (VRef) and 6 (coding scheme)
+    IDENTITY_REGS = [0x6001a004, 0x6001a008, 0x6001a00c, 0x6001a010, 0x6001a018]
+
     SPI_W0_OFFS = 0x80
     SPI_HAS_MOSI_DLEN_REG = True
 
@@ -1150,7 +1359,11 @@ class ESP32ROM(ESPLoader):
 
     def read_efuse(self, n):
         """ Read the nth word of the ESP3x EFUSE region. """
-        return self.read_reg(self.EFUSE_REG_BASE + (4 * n))
+        return self.read_identity_reg(self.EFUSE_REG_BASE + (4 * n))
+
+    def read_efuses(self, words):
+        """ Read a list of words of the ESP3x EFUSE region, in one pipelined batch (see read_regs). """
+        return self.read_regs([self.EFUSE_REG_BASE + (4 * n) for n in words])
 
     def chip_id(self):
         raise NotSupportedError(self, "chip_id")
@@ -1201,6 +1414,10 @@ class ESP32StubLoader(ESP32ROM):
     def __init__(self, rom_loader):
         self._port = rom_loader._port
         self._trace_enabled = rom_loader._trace_enabled
+        self._trace_capture = rom_loader._trace_capture
+        self._metrics = rom_loader._metrics
+        self._timeouts = rom_loader._timeouts
+        self._identity = rom_loader._identity
         self.flush_input()  # resets _slip_reader
 
 
@@ -1222,19 +1439,136 @@ def LoadFirmwareImage(chip, filename):
         original ROM firmware images (ESP8266ROMFirmwareImage) or "v2" OTA bootloader images.
 
         Returns a BaseFirmwareImage subclass, either ESP8266ROMFirmwareImage (v1) or ESP8266V2FirmwareImage (v2).
+
+        Where possible the file is memory mapped, so segment data is only read from disk when it's used.
+        The mapping is released by calling close() on the image, once the segment data has been used.
     """
-    with open(filename, 'rb') as f:
-        if chip.lower() == 'esp32':
-            return ESP32FirmwareImage(f)
-        else:  # Otherwise, ESP8266 so look at magic to determine the image type
-            magic = ord(f.read(1))
-            f.seek(0)
-            if magic == ESPLoader.ESP_IMAGE_MAGIC:
-                return ESP8266ROMFirmwareImage(f)
-            elif magic == ESPBOOTLOADER.IMAGE_V2_MAGIC:
-                return ESP8266V2FirmwareImage(f)
-            else:
-                raise FatalError("Invalid image magic number: %d" % magic)
+    with open(filename, 'rb') as load_file:
+        f = map_file(load_file)
+        try:
+            if chip.lower() == 'esp32':
+                image = ESP32FirmwareImage(f)
+            else:  # Otherwise, ESP8266 so look at magic to determine the image type
+                magic = ord(f.read(1))
+                f.seek(0)
+                if magic == ESPLoader.ESP_IMAGE_MAGIC:
+                    image = ESP8266ROMFirmwareImage(f)
+                elif magic == ESPBOOTLOADER.IMAGE_V2_MAGIC:
+                    image = ESP8266V2FirmwareImage(f)
+                else:
+                    raise FatalError("Invalid image magic number: %d" % magic)
+        except Exception:
+            f.close()
+            raise
+    image._mapped_file = f if isinstance(f, MappedFile) else None
+    return image
+
+
+def map_file(f):
+    """ Return a MappedFile for the open file f, or f itself if it can't be memory mapped """
+    try:
+        return MappedFile(f)
+    except (ValueError, TypeError, EnvironmentError):
+        return f  # empty file, not a regular file, or mmap has no buffer interface (Python 2)
+
+
+def close_mapped_file(f, segments):
+    """ If f is a MappedFile, release the views of it held as data by segments, then close it """
+    if isinstance(f, MappedFile):
+        for s in segments:
+            if isinstance(s.data, memoryview):
+                s.data.release()
+        f.close()
+
+
+class MappedFile(object):
+    """ Read-only file object over a memory mapped file.
+
+    read() returns bytes as usual, for the headers. read_view() returns
+    a memoryview into the mapping instead, so segment or section data isn't
+    copied (or even paged in) until something uses it.
+
+    close() releases the mapping, but it stays open until every view of it
+    has also been released (or garbage collected).
+    """
+    def __init__(self, f):
+        self.name = f.name
+        self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._view = memoryview(self._mmap)
+        except TypeError:
+            self._mmap.close()
+            raise
+        self._pos = 0
+
+    def close(self):
+        if self._mmap is None:
+            return
+        self._view.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass  # views are still exported, the mapping is closed when they go away
+        self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def read(self, size=-1):
+        return self.read_view(size).tobytes()
+
+    def read_view(self, size=-1):
+        start = min(self._pos, len(self._view))
+        end = len(self._view) if size < 0 else min(start + size, len(self._view))
+        self._pos = end
+        return self._view[start:end]
+
+    def view(self, start, end):
+        """ Return a memoryview of the mapping, without moving the file position """
+        return self._view[start:end]
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += len(self._view)
+        if offset < 0:
+            raise ValueError("Negative seek position %d" % offset)
+        self._pos = offset
+        return self._pos
+
+
+class DigestWriter(object):
+    """ Write-only file wrapper, which calculates the SHA-256 digest of everything
+    written through it. Seeking forwards writes zero bytes, seeking backwards isn't possible. """
+    def __init__(self, f):
+        self._f = f
+        self._pos = 0
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.sha256.update(data)
+        self._f.write(data)
+        self._pos += len(data)
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            offset -= self._pos
+        elif whence != os.SEEK_CUR:
+            raise ValueError("DigestWriter only supports SEEK_SET and SEEK_CUR")
+        if offset < 0:
+            raise ValueError("DigestWriter can't seek backwards")
+        self.write(b'\x00' * offset)
+        return self._pos
 
 
 class ImageSegment(object):
@@ -1296,6 +1630,12 @@ class BaseFirmwareImage(object):
         self.entrypoint = 0
         self.elf_sha256 = None
         self.elf_sha256_offset = 0
+        self._mapped_file = None  # set by LoadFirmwareImage
+
+    def close(self):
+        """ Release the memory mapped file the image was loaded from, if any. Segment data can't be used afterwards. """
+        close_mapped_file(self._mapped_file, self.segments)
+        self._mapped_file = None
 
     def load_common_header(self, load_file, expected_magic):
             (magic, segments, self.flash_mode, self.flash_size_freq, self.entrypoint) = struct.unpack('<BBBBI', load_file.read(8))
@@ -1313,7 +1653,7 @@ class BaseFirmwareImage(object):
         file_offs = f.tell()
         (offset, size) = struct.unpack('<II', f.read(8))
         self.warn_if_unusual_segment(offset, size, is_irom_segment)
-        segment_data = f.read(size)
+        segment_data = f.read_view(size) if isinstance(f, MappedFile) else f.read(size)
         if len(segment_data) < size:
             raise FatalError('End of file reading segment 0x%x, length %d (actual length %d)' % (offset, size, len(segment_data)))
         segment = ImageSegment(offset, segment_data, file_offs)
@@ -1325,10 +1665,9 @@ class BaseFirmwareImage(object):
             if offset > 0x40200000 or offset < 0x3ffe0000 or size > 65536:
                 print('WARNING: Suspicious segment 0x%x, length %d' % (offset, size))
 
-    def maybe_patch_segment_data(self, f, segment_data):
-        """If SHA256 digest of the ELF file needs to be inserted into this segment, do so. Returns segment data."""
-        segment_len = len(segment_data)
-        file_pos = f.tell()
+    def get_elf_sha256_patch_offset(self, file_pos, segment_len):
+        """ If the SHA256 digest of the ELF file goes in the segment written at file_pos, return
+        the offset of the digest inside the segment data. Otherwise returns None. """
         if self.elf_sha256_offset >= file_pos and self.elf_sha256_offset < file_pos + segment_len:
             # SHA256 digest needs to be patched into this segment,
             # calculate offset of the digest inside the segment.
@@ -1338,11 +1677,17 @@ class BaseFirmwareImage(object):
                 raise FatalError('Can not place SHA256 digest on segment boundary' +
                                  '(elf_sha256_offset=%d, file_pos=%d, segment_size=%d)' %
                                  (self.elf_sha256_offset, file_pos, segment_len))
-            assert(len(self.elf_sha256) == self.SHA256_DIGEST_LEN)
             # offset relative to the data part
-            patch_offset -= self.SEG_HEADER_LEN
-            segment_data = segment_data[0:patch_offset] + self.elf_sha256 + \
-                segment_data[patch_offset + self.SHA256_DIGEST_LEN:]
+            return patch_offset - self.SEG_HEADER_LEN
+        return None
+
+    def maybe_patch_segment_data(self, f, segment_data):
+        """If SHA256 digest of the ELF file needs to be inserted into this segment, do so. Returns segment data."""
+        patch_offset = self.get_elf_sha256_patch_offset(f.tell(), len(segment_data))
+        if patch_offset is not None:
+            assert(len(self.elf_sha256) == self.SHA256_DIGEST_LEN)
+            segment_data = b''.join([segment_data[0:patch_offset], self.elf_sha256,
+                                     segment_data[patch_offset + self.SHA256_DIGEST_LEN:]])
         return segment_data
 
     def save_segment(self, f, segment, checksum=None):
@@ -1423,21 +1768,28 @@ class ESP8266ROMFirmwareImage(BaseFirmwareImage):
         return input_file + '-'
 
     def save(self, basename):
-        """ Save a set of V1 images for flashing. Parameter is a base filename. """
+        """ Save a set of V1 images for flashing. Parameter is a base filename.
+
+        Returns the list of files written. """
+        output_files = []
+
         # IROM data goes in its own plain binary file
         irom_segment = self.get_irom_segment()
         if irom_segment is not None:
-            with open("%s0x%05x.bin" % (basename, irom_segment.addr - ESP8266ROM.IROM_MAP_START), "wb") as f:
+            output_files.append("%s0x%05x.bin" % (basename, irom_segment.addr - ESP8266ROM.IROM_MAP_START))
+            with open(output_files[-1], "wb") as f:
                 f.write(irom_segment.data)
 
         # everything but IROM goes at 0x00000 in an image file
         normal_segments = self.get_non_irom_segments()
-        with open("%s0x00000.bin" % basename, 'wb') as f:
+        output_files.append("%s0x00000.bin" % basename)
+        with open(output_files[-1], 'wb') as f:
             self.write_common_header(f, normal_segments)
             checksum = ESPLoader.ESP_CHECKSUM_MAGIC
             for segment in normal_segments:
                 checksum = self.save_segment(f, segment, checksum)
             self.append_checksum(f, checksum)
+        return output_files
 
 
 class ESP8266V2FirmwareImage(BaseFirmwareImage):
@@ -1525,6 +1877,7 @@ class ESP8266V2FirmwareImage(BaseFirmwareImage):
             crc = esp8266_crc32(f.read())
         with open(filename, 'ab') as f:
             f.write(struct.pack(b'<I', crc))
+        return [filename]
 
 
 # Backwards compatibility for previous API, remove in esptool.py V3
@@ -1562,6 +1915,12 @@ class ESP32FirmwareImage(BaseFirmwareImage):
 
     IROM_ALIGN = 65536
 
+    # common header & extended header
+    HEADER_LEN = 8 + 16
+
+    # after the checksum: SHA-256 digest + (to be added by signing process) version, signature + 12 trailing bytes due to alignment
+    SECURE_PAD_SPACE_AFTER_CHECKSUM = 32 + 4 + 64 + 12
+
     def __init__(self, load_file=None):
         super(ESP32FirmwareImage, self).__init__()
         self.secure_pad = False
@@ -1592,9 +1951,12 @@ class ESP32FirmwareImage(BaseFirmwareImage):
             if self.append_digest:
                 end = load_file.tell()
                 self.stored_digest = load_file.read(32)
-                load_file.seek(start)
                 calc_digest = hashlib.sha256()
-                calc_digest.update(load_file.read(end - start))
+                if isinstance(load_file, MappedFile):
+                    calc_digest.update(load_file.view(start, end))
+                else:
+                    load_file.seek(start)
+                    calc_digest.update(load_file.read(end - start))
                 self.calc_digest = calc_digest.digest()  # TODO: decide what to do here?
 
             self.verify()
@@ -1611,126 +1973,141 @@ class ESP32FirmwareImage(BaseFirmwareImage):
         pass  # TODO: add warnings for ESP32 segment offset/size combinations that are wrong
 
     def save(self, filename):
-        total_segments = 0
-        with io.BytesIO() as f:  # write file to memory first
-            self.write_common_header(f, self.segments)
+        segments = self.get_save_segments()
+        # the image is written to a temporary file, so an existing image is only replaced by a complete one
+        tmp_filename = filename + ".tmp"
+        try:
+            with open(tmp_filename, 'wb') as real_file:
+                # checksum & SHA-256 digest are calculated as the image is written out
+                f = DigestWriter(real_file)
+                self.write_common_header(f, segments)
+
+                # first 4 bytes of header are read by ROM bootloader for SPI
+                # config, but currently unused
+                self.save_extended_header(f)
+
+                checksum = ESPLoader.ESP_CHECKSUM_MAGIC
+                for segment in segments:
+                    checksum = self.save_segment(f, segment, checksum)
+
+                # done writing segments
+                self.append_checksum(f, checksum)
+
+                if self.secure_pad:
+                    assert ((f.tell() + self.SECURE_PAD_SPACE_AFTER_CHECKSUM) % self.IROM_ALIGN) == 0
+
+                if self.append_digest:
+                    # SHA256 of the whole file is appended
+                    real_file.write(f.sha256.digest())
+            replace_file(tmp_filename, filename)
+        except BaseException:
+            try:
+                os.remove(tmp_filename)
+            except OSError:
+                pass
+            raise
+        return [filename]
 
-            # first 4 bytes of header are read by ROM bootloader for SPI
-            # config, but currently unused
-            self.save_extended_header(f)
+    def get_save_segments(self):
+        """ Return the list of segments to write to the image file, in file order.
 
-            checksum = ESPLoader.ESP_CHECKSUM_MAGIC
+        Includes the padding segments needed to place each flash segment at a 64KB
+        aligned offset. Segments in the list share their data with this image's
+        segments (as memoryviews on Python 3), so nothing large is copied.
+        """
+        def view_of(segment):
+            result = copy.copy(segment)
+            if not PYTHON2:
+                result.data = memoryview(segment.data)
+            return result
 
-            # split segments into flash-mapped vs ram-loaded, and take copies so we can mutate them
-            flash_segments = [copy.deepcopy(s) for s in sorted(self.segments, key=lambda s:s.addr) if self.is_flash_addr(s.addr)]
-            ram_segments = [copy.deepcopy(s) for s in sorted(self.segments, key=lambda s:s.addr) if not self.is_flash_addr(s.addr)]
-
-            # check for multiple ELF sections that are mapped in the same flash mapping region.
-            # this is usually a sign of a broken linker script, but if you have a legitimate
-            # use case then let us know (we can merge segments here, but as a rule you probably
-            # want to merge them in your linker script.)
-            if len(flash_segments) > 0:
-                last_addr = flash_segments[0].addr
-                for segment in flash_segments[1:]:
-                    if segment.addr // self.IROM_ALIGN == last_addr // self.IROM_ALIGN:
-                        raise FatalError(("Segment loaded at 0x%08x lands in same 64KB flash mapping as segment loaded at 0x%08x. " +
-                                          "Can't generate binary. Suggest changing linker script or ELF to merge sections.") %
-                                         (segment.addr, last_addr))
-                    last_addr = segment.addr
-
-            def get_alignment_data_needed(segment):
-                # Actual alignment (in data bytes) required for a segment header: positioned so that
-                # after we write the next 8 byte header, file_offs % IROM_ALIGN == segment.addr % IROM_ALIGN
-                #
-                # (this is because the segment's vaddr may not be IROM_ALIGNed, more likely is aligned
-                # IROM_ALIGN+0x18 to account for the binary file header
-                align_past = (segment.addr % self.IROM_ALIGN) - self.SEG_HEADER_LEN
-                pad_len = (self.IROM_ALIGN - (f.tell() % self.IROM_ALIGN)) + align_past
-                if pad_len == 0 or pad_len == self.IROM_ALIGN:
-                    return 0  # already aligned
-
-                # subtract SEG_HEADER_LEN a second time, as the padding block has a header as well
-                pad_len -= self.SEG_HEADER_LEN
-                if pad_len < 0:
-                    pad_len += self.IROM_ALIGN
-                return pad_len
-
-            # try to fit each flash segment on a 64kB aligned boundary
-            # by padding with parts of the non-flash segments...
-            while len(flash_segments) > 0:
-                segment = flash_segments[0]
-                pad_len = get_alignment_data_needed(segment)
-                if pad_len > 0:  # need to pad
-                    if len(ram_segments) > 0 and pad_len > self.SEG_HEADER_LEN:
-                        pad_segment = ram_segments[0].split_image(pad_len)
-                        if len(ram_segments[0].data) == 0:
-                            ram_segments.pop(0)
-                    else:
-                        pad_segment = ImageSegment(0, b'\x00' * pad_len, f.tell())
-                    checksum = self.save_segment(f, pad_segment, checksum)
-                    total_segments += 1
+        # split segments into flash-mapped vs ram-loaded, and take copies so we can mutate them
+        sorted_segments = sorted(self.segments, key=lambda s:s.addr)
+        flash_segments = [view_of(s) for s in sorted_segments if self.is_flash_addr(s.addr)]
+        ram_segments = [view_of(s) for s in sorted_segments if not self.is_flash_addr(s.addr)]
+
+        # check for multiple ELF sections that are mapped in the same flash mapping region.
+        # this is usually a sign of a broken linker script, but if you have a legitimate
+        # use case then let us know (we can merge segments here, but as a rule you probably
+        # want to merge them in your linker script.)
+        if len(flash_segments) > 0:
+            last_addr = flash_segments[0].addr
+            for segment in flash_segments[1:]:
+                if segment.addr // self.IROM_ALIGN == last_addr // self.IROM_ALIGN:
+                    raise FatalError(("Segment loaded at 0x%08x lands in same 64KB flash mapping as segment loaded at 0x%08x. " +
+                                      "Can't generate binary. Suggest changing linker script or ELF to merge sections.") %
+                                     (segment.addr, last_addr))
+                last_addr = segment.addr
+
+        def get_alignment_data_needed(segment, file_pos):
+            # Actual alignment (in data bytes) required for a segment header: positioned so that
+            # after we write the next 8 byte header, file_offs % IROM_ALIGN == segment.addr % IROM_ALIGN
+            #
+            # (this is because the segment's vaddr may not be IROM_ALIGNed, more likely is aligned
+            # IROM_ALIGN+0x18 to account for the binary file header
+            align_past = (segment.addr % self.IROM_ALIGN) - self.SEG_HEADER_LEN
+            pad_len = (self.IROM_ALIGN - (file_pos % self.IROM_ALIGN)) + align_past
+            if pad_len == 0 or pad_len == self.IROM_ALIGN:
+                return 0  # already aligned
+
+            # subtract SEG_HEADER_LEN a second time, as the padding block has a header as well
+            pad_len -= self.SEG_HEADER_LEN
+            if pad_len < 0:
+                pad_len += self.IROM_ALIGN
+            return pad_len
+
+        result = []
+        file_pos = self.HEADER_LEN  # position of the next segment header
+
+        # try to fit each flash segment on a 64kB aligned boundary
+        # by padding with parts of the non-flash segments...
+        while len(flash_segments) > 0:
+            segment = flash_segments[0]
+            pad_len = get_alignment_data_needed(segment, file_pos)
+            if pad_len > 0:  # need to pad
+                if len(ram_segments) > 0 and pad_len > self.SEG_HEADER_LEN:
+                    segment = ram_segments[0].split_image(pad_len)
+                    if len(ram_segments[0].data) == 0:
+                        ram_segments.pop(0)
                 else:
-                    # write the flash segment
-                    assert (f.tell() + 8) % self.IROM_ALIGN == segment.addr % self.IROM_ALIGN
-                    checksum = self.save_flash_segment(f, segment, checksum)
-                    flash_segments.pop(0)
-                    total_segments += 1
-
-            # flash segments all written, so write any remaining RAM segments
-            for segment in ram_segments:
-                checksum = self.save_segment(f, segment, checksum)
-                total_segments += 1
-
-            if self.secure_pad:
-                # pad the image so that after signing it will end on a a 64KB boundary.
-                # This ensures all mapped flash content will be verified.
-                if not self.append_digest:
-                    raise FatalError("secure_pad only applies if a SHA-256 digest is also appended to the image")
-                align_past = (f.tell() + self.SEG_HEADER_LEN) % self.IROM_ALIGN
-                # 16 byte aligned checksum (force the alignment to simplify calculations)
-                checksum_space = 16
-                # after checksum: SHA-256 digest + (to be added by signing process) version, signature + 12 trailing bytes due to alignment
-                space_after_checksum = 32 + 4 + 64 + 12
-                pad_len = (self.IROM_ALIGN - align_past - checksum_space - space_after_checksum) % self.IROM_ALIGN
-                pad_segment = ImageSegment(0, b'\x00' * pad_len, f.tell())
-
-                checksum = self.save_segment(f, pad_segment, checksum)
-                total_segments += 1
-
-            # done writing segments
-            self.append_checksum(f, checksum)
-            image_length = f.tell()
-
-            if self.secure_pad:
-                assert ((image_length + space_after_checksum) % self.IROM_ALIGN) == 0
-
-            # kinda hacky: go back to the initial header and write the new segment count
-            # that includes padding segments. This header is not checksummed
-            f.seek(1)
-            try:
-                f.write(chr(total_segments))
-            except TypeError:  # Python 3
-                f.write(bytes([total_segments]))
-
-            if self.append_digest:
-                # calculate the SHA256 of the whole file and append it
-                f.seek(0)
-                digest = hashlib.sha256()
-                digest.update(f.read(image_length))
-                f.write(digest.digest())
-
-            with open(filename, 'wb') as real_file:
-                real_file.write(f.getvalue())
+                    segment = ImageSegment(0, b'\x00' * pad_len, file_pos)
+            else:
+                # the flash segment goes here
+                assert (file_pos + 8) % self.IROM_ALIGN == segment.addr % self.IROM_ALIGN
+                segment_end_pos = file_pos + len(segment.data) + self.SEG_HEADER_LEN
+                segment_len_remainder = segment_end_pos % self.IROM_ALIGN
+                if segment_len_remainder < 0x24:
+                    # Work around a bug in ESP-IDF 2nd stage bootloader, that it didn't map the
+                    # last MMU page, if an IROM/DROM segment was < 0x24 bytes over the page boundary.
+                    segment.data = b''.join([segment.data, b'\x00' * (0x24 - segment_len_remainder)])
+                flash_segments.pop(0)
+            result.append(segment)
+            file_pos += self.SEG_HEADER_LEN + len(segment.data)
+
+        # flash segments all placed, so add any remaining RAM segments
+        for segment in ram_segments:
+            result.append(segment)
+            file_pos += self.SEG_HEADER_LEN + len(segment.data)
+
+        if self.secure_pad:
+            # pad the image so that after signing it will end on a a 64KB boundary.
+            # This ensures all mapped flash content will be verified.
+            if not self.append_digest:
+                raise FatalError("secure_pad only applies if a SHA-256 digest is also appended to the image")
+            align_past = (file_pos + self.SEG_HEADER_LEN) % self.IROM_ALIGN
+            # 16 byte aligned checksum (force the alignment to simplify calculations)
+            checksum_space = 16
+            pad_len = (self.IROM_ALIGN - align_past - checksum_space - self.SECURE_PAD_SPACE_AFTER_CHECKSUM) % self.IROM_ALIGN
+            result.append(ImageSegment(0, b'\x00' * pad_len, file_pos))
+
+        if self.elf_sha256 is not None:
+            # fail now if the ELF SHA256 can't be placed, rather than part way through writing the file
+            file_pos = self.HEADER_LEN
+            for segment in result:
+                self.get_elf_sha256_patch_offset(file_pos, len(segment.data))
+                file_pos += self.SEG_HEADER_LEN + len(segment.data)
 
-    def save_flash_segment(self, f, segment, checksum=None):
-        """ Save the next segment to the image file, return next checksum value if provided """
-        segment_end_pos = f.tell() + len(segment.data) + self.SEG_HEADER_LEN
-        segment_len_remainder = segment_end_pos % self.IROM_ALIGN
-        if segment_len_remainder < 0x24:
-            # Work around a bug in ESP-IDF 2nd stage bootloader, that it didn't map the
-            # last MMU page, if an IROM/DROM segment was < 0x24 bytes over the page boundary.
-            segment.data += b'\x00' * (0x24 - segment_len_remainder)
-        return self.save_segment(f, segment, checksum)
+        return result
 
     def load_extended_header(self, load_file):
         def split_byte(n):
@@ -1777,17 +2154,41 @@ class ELFFile(object):
 
     LEN_SEC_HEADER = 0x28
 
-    def __init__(self, name):
-        # Load sections from the ELF file
+    # sha256() hashes the file in blocks of this size
+    SHA256_BLOCK_SIZE = 0x100000
+
+    def __init__(self, name, metadata=None):
+        # Load sections from the ELF file. Where possible the file is memory mapped,
+        # and section data is only read from disk when it's used, until close() is called.
+        #
+        # 'metadata' is the result of get_metadata() for a previous version of the file.
+        # If the file's SHA256 still matches, the ELF headers aren't parsed again.
         self.name = name
+        self._sha256 = None
         with open(self.name, 'rb') as f:
-            self._read_elf_file(f)
+            f = map_file(f)
+            self._mapped_file = f if isinstance(f, MappedFile) else None
+            try:
+                if metadata is not None and hexify(self.sha256(), False) == metadata["sha256"]:
+                    self.entrypoint = metadata["entrypoint"]
+                    self._section_table = [tuple(s) for s in metadata["sections"]]
+                else:
+                    self._read_elf_file(f)
+                self._load_sections(f)
+            except Exception:
+                f.close()
+                raise
+
+    def close(self):
+        """ Release the memory mapped ELF file, if it is. Section data can't be used afterwards. """
+        close_mapped_file(self._mapped_file, self.sections)
+        self._mapped_file = None
 
     def get_section(self, section_name):
-        for s in self.sections:
-            if s.name == section_name:
-                return s
-        raise ValueError("No section %s in ELF file" % section_name)
+        try:
+            return self._sections_by_name[section_name]
+        except KeyError:
+            raise ValueError("No section %s in ELF file" % section_name)
 
     def _read_elf_file(self, f):
         # read the ELF file header
@@ -1843,28 +2244,107 @@ class ELFFile(object):
             raw = string_table[offs:]
             return raw[:raw.index(b'\x00')]
 
+        # (name, load address, file offset, size) of each section to load
+        self._section_table = [(lookup_string(n_offs).decode("utf-8"), lma, offs, size) for (n_offs, _type, lma, size, offs) in prog_sections
+                               if lma != 0 and size > 0]
+
+    def _load_sections(self, f):
         def read_data(offs,size):
             f.seek(offs)
-            return f.read(size)
+            return f.read_view(size) if isinstance(f, MappedFile) else f.read(size)
 
-        prog_sections = [ELFSection(lookup_string(n_offs), lma, read_data(offs, size)) for (n_offs, _type, lma, size, offs) in prog_sections
-                         if lma != 0 and size > 0]
-        self.sections = prog_sections
+        self.sections = [ELFSection(name.encode("utf-8"), lma, read_data(offs, size)) for (name, lma, offs, size) in self._section_table]
+        # if names are duplicated, get_section() returns the first
+        self._sections_by_name = dict((s.name, s) for s in reversed(self.sections))
+
+    def get_metadata(self):
+        """ Return the entrypoint, section table & SHA256 of the ELF file as a JSON serializable dict,
+        which can be passed back to the constructor to load the same file again without parsing it. """
+        return {
+            "entrypoint": self.entrypoint,
+            "sections": [list(s) for s in self._section_table],
+            "sha256": hexify(self.sha256(), False),
+        }
 
     def sha256(self):
         # return SHA256 hash of the input ELF file
+        if self._sha256 is None:
+            sha256 = hashlib.sha256()
+            if self._mapped_file is not None:
+                view = self._mapped_file.view(0, None)
+                for offs in range(0, len(view), self.SHA256_BLOCK_SIZE):
+                    sha256.update(view[offs:offs + self.SHA256_BLOCK_SIZE])
+            else:
+                with open(self.name, 'rb') as f:
+                    for block in iter(lambda: f.read(self.SHA256_BLOCK_SIZE), b''):
+                        sha256.update(block)
+            self._sha256 = sha256.digest()
+        return self._sha256
+
+
+class ImageBuildCache(object):
+    """
+    Cache of elf2image results, stored as a JSON file.
+
+    For each ELF file, records its ELFFile metadata (including its SHA256), the
+    options used to build the image and the SHA256 of each output file. Entries
+    are matched on the ELF file's SHA256, not its modification time.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            with open(filename, 'r') as f:
+                self.entries = json.load(f)
+            if not isinstance(self.entries, dict):
+                raise ValueError("not a dict")
+        except (EnvironmentError, ValueError):
+            self.entries = {}  # missing or invalid cache file, start again
+
+    @staticmethod
+    def _file_sha256(filename):
         sha256 = hashlib.sha256()
-        with open(self.name, 'rb') as f:
-            sha256.update(f.read())
-        return sha256.digest()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(ELFFile.SHA256_BLOCK_SIZE), b''):
+                sha256.update(block)
+        return hexify(sha256.digest(), False)
+
+    def get_elf_metadata(self, elf_name):
+        """ Return the cached ELFFile metadata for elf_name, or None. ELFFile only uses it if the SHA256 still matches. """
+        entry = self.entries.get(os.path.abspath(elf_name))
+        return None if entry is None else entry["metadata"]
+
+    def is_up_to_date(self, elf, options):
+        """ Returns True if an image was built from the same ELF contents with the same options,
+        and the output files haven't been changed or removed since. """
+        entry = self.entries.get(os.path.abspath(elf.name))
+        if entry is None or entry["metadata"]["sha256"] != hexify(elf.sha256(), False) or entry["options"] != options:
+            return False
+        try:
+            return all(self._file_sha256(name) == sha256 for (name, sha256) in entry["outputs"].items())
+        except EnvironmentError:
+            return False
 
+    def update(self, elf, options, output_files):
+        self.entries[os.path.abspath(elf.name)] = {
+            "metadata": elf.get_metadata(),
+            "options": options,
+            "outputs": dict((os.path.abspath(name), self._file_sha256(name)) for name in output_files),
+        }
 
-def slip_reader(port, trace_function):
+    def save(self):
+        with open(self.filename, 'w') as f:
+            json.dump(self.entries, f, indent=2, sort_keys=True)
+
+
+def slip_reader(port, trace_function, trace_capture=None):
     """Generator to read SLIP packets from a serial port.
     Yields one full SLIP packet at a time, raises exception on timeout or invalid data.
 
     Designed to avoid too many calls to serial.read(1), which can bog
     down on slow systems.
+
+    trace_function is None if tracing is disabled. If trace_capture is set, all
+    data read from the port is recorded to that TraceCapture.
     """
     partial_packet = None
     in_escape = False
@@ -1873,9 +2353,13 @@ def slip_reader(port, trace_function):
         read_bytes = port.read(1 if waiting == 0 else waiting)
         if read_bytes == b'':
             waiting_for = "header" if partial_packet is None else "content"
-            trace_function("Timed out waiting for packet %s", waiting_for)
-            raise FatalError("Timed out waiting for packet %s" % waiting_for)
-        trace_function("Read %d bytes: %s", len(read_bytes), HexFormatter(read_bytes))
+            if trace_function is not None:
+                trace_function("Timed out waiting for packet %s", waiting_for)
+            raise PacketTimeoutError("Timed out waiting for packet %s" % waiting_for)
+        if trace_capture is not None:
+            trace_capture.record(TraceCapture.DIR_READ, read_bytes)
+        if trace_function is not None:
+            trace_function("Read %d bytes: %s", len(read_bytes), HexFormatter(read_bytes))
         for b in read_bytes:
             if type(b) is int:
                 b = bytes([b])  # python 2/3 compat
@@ -1884,8 +2368,10 @@ def slip_reader(port, trace_function):
                 if b == b'\xc0':
                     partial_packet = b""
                 else:
-                    trace_function("Read invalid data: %s", HexFormatter(read_bytes))
-                    trace_function("Remaining data in serial buffer: %s", HexFormatter(port.read(port.inWaiting())))
+                    remaining = port.read(port.inWaiting())
+                    if trace_function is not None:
+                        trace_function("Read invalid data: %s", HexFormatter(read_bytes))
+                        trace_function("Remaining data in serial buffer: %s", HexFormatter(remaining))
                     raise FatalError('Invalid head of packet (0x%s)' % hexify(b))
             elif in_escape:  # part-way through escape sequence
                 in_escape = False
@@ -1894,13 +2380,16 @@ def slip_reader(port, trace_function):
                 elif b == b'\xdd':
                     partial_packet += b'\xdb'
                 else:
-                    trace_function("Read invalid data: %s", HexFormatter(read_bytes))
-                    trace_function("Remaining data in serial buffer: %s", HexFormatter(port.read(port.inWaiting())))
+                    remaining = port.read(port.inWaiting())
+                    if trace_function is not None:
+                        trace_function("Read invalid data: %s", HexFormatter(read_bytes))
+                        trace_function("Remaining data in serial buffer: %s", HexFormatter(remaining))
                     raise FatalError('Invalid SLIP escape (0xdb, 0x%s)' % (hexify(b)))
             elif b == b'\xdb':  # start of escape sequence
                 in_escape = True
             elif b == b'\xc0':  # end of packet
-                trace_function("Received full packet: %s", HexFormatter(partial_packet))
+                if trace_function is not None:
+                    trace_function("Received full packet: %s", HexFormatter(partial_packet))
                 yield partial_packet
                 partial_packet = None
             else:  # normal byte in packet
@@ -1966,6 +2455,10 @@ class HexFormatter(object):
         self._auto_split = auto_split
 
     def __str__(self):
+        if isinstance(self._s, tuple):  # packet made of several parts, see ESPLoader.write()
+            self._s = b"".join(bytes(part) for part in self._s)
+        else:
+            self._s = bytes(self._s)  # may be a bytearray
         if self._auto_split and len(self._s) > 16:
             result = ""
             s = self._s
@@ -1980,10 +2473,302 @@ class HexFormatter(object):
             return hexify(self._s, False)
 
 
+class TraceCapture(object):
+    """
+    Records timestamped raw serial traffic (as read from & written to the port,
+    ie SLIP framed) in a ring buffer, which can be saved to a compact binary
+    capture file.
+
+    Only the most recent max_bytes of traffic are kept. Capture files
+    can be decoded or replayed with esptrace.py.
+
+    Capture file format: MAGIC, then a header (format version, number of
+    dropped records), then one RECORD_HEADER (timestamp, direction, length)
+    plus raw data for each record.
+    """
+    MAGIC = b'ESPTRACE'
+    FILE_HEADER = struct.Struct('<HI')
+    RECORD_HEADER = struct.Struct('<dBI')
+    VERSION = 1
+
+    DIR_WRITE = 0  # host -> device
+    DIR_READ = 1   # device -> host
+
+    DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.records = collections.deque()
+        self.dropped = 0
+        self._max_bytes = max_bytes
+        self._num_bytes = 0
+
+    def record(self, direction, data):
+        data = bytes(data)
+        self.records.append((time.time(), direction, data))
+        self._num_bytes += len(data)
+        while self._num_bytes > self._max_bytes and len(self.records) > 1:
+            self._num_bytes -= len(self.records.popleft()[2])
+            self.dropped += 1
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(self.MAGIC)
+            f.write(self.FILE_HEADER.pack(self.VERSION, self.dropped))
+            for (timestamp, direction, data) in self.records:
+                f.write(self.RECORD_HEADER.pack(timestamp, direction, len(data)))
+                f.write(data)
+
+    @classmethod
+    def load(cls, filename):
+        """ Load a capture file, returns a new TraceCapture """
+        result = cls(max_bytes=float('inf'))
+        with open(filename, 'rb') as f:
+            if f.read(len(cls.MAGIC)) != cls.MAGIC:
+                raise FatalError("%s is not an esptool trace capture file" % filename)
+            version, result.dropped = cls.FILE_HEADER.unpack(f.read(cls.FILE_HEADER.size))
+            if version != cls.VERSION:
+                raise FatalError("Trace capture file %s has unsupported version %d" % (filename, version))
+            while True:
+                header = f.read(cls.RECORD_HEADER.size)
+                if len(header) == 0:
+                    break
+                if len(header) < cls.RECORD_HEADER.size:
+                    raise FatalError("Trace capture file %s is truncated" % filename)
+                timestamp, direction, length = cls.RECORD_HEADER.unpack(header)
+                data = f.read(length)
+                if len(data) < length:
+                    raise FatalError("Trace capture file %s is truncated" % filename)
+                result.records.append((timestamp, direction, data))
+        return result
+
+
+# Names of the serial protocol commands, for metrics & decoding
+COMMAND_NAMES = dict((getattr(ESPLoader, name), name) for name in [
+    "ESP_FLASH_BEGIN", "ESP_FLASH_DATA", "ESP_FLASH_END",
+    "ESP_MEM_BEGIN", "ESP_MEM_END", "ESP_MEM_DATA",
+    "ESP_SYNC", "ESP_WRITE_REG", "ESP_READ_REG",
+    "ESP_SPI_SET_PARAMS", "ESP_SPI_ATTACH", "ESP_CHANGE_BAUDRATE",
+    "ESP_FLASH_DEFL_BEGIN", "ESP_FLASH_DEFL_DATA", "ESP_FLASH_DEFL_END",
+    "ESP_SPI_FLASH_MD5",
+    "ESP_ERASE_FLASH", "ESP_ERASE_REGION", "ESP_READ_FLASH", "ESP_RUN_USER_CODE",
+])
+
+
+class SessionMetrics(object):
+    """
+    Per-command counters & latency histograms, plus timings for each phase
+    of a session (connect, stub upload, erase, write, etc.)
+
+    Commands are keyed by op. Latency is measured from sending a command to
+    reading its response. Retries are stale responses to other commands which
+    were skipped while waiting for the response.
+
+    Can be exported as JSON or as Prometheus text exposition format.
+    """
+    # Upper bounds (seconds) of the latency histogram buckets
+    LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 120.0, float('inf'))
+
+    FORMATS = ['json', 'prometheus']
+
+    def __init__(self):
+        self.started = time.time()
+        self.labels = {}  # extra information about the session, ie chip & port
+        self.commands = {}
+        self.phases = collections.OrderedDict()
+
+    def _command(self, op):
+        try:
+            return self.commands[op]
+        except KeyError:
+            c = {"count": 0, "responses": 0, "errors": 0, "timeouts": 0, "retries": 0,
+                 "bytes_sent": 0, "bytes_received": 0,
+                 "latency_sum": 0.0, "latency_count": 0, "latency_max": 0.0,
+                 "latency_buckets": [0] * len(self.LATENCY_BUCKETS)}
+            self.commands[op] = c
+            return c
+
+    def record_sent(self, op, num_bytes):
+        c = self._command(op)
+        c["count"] += 1
+        c["bytes_sent"] += num_bytes
+
+    def record_response(self, op, num_bytes, retries, latency=None):
+        c = self._command(op)
+        c["responses"] += 1
+        c["bytes_received"] += num_bytes
+        c["retries"] += retries
+        if latency is not None:
+            c["latency_sum"] += latency
+            c["latency_count"] += 1
+            c["latency_max"] = max(c["latency_max"], latency)
+            for i, bound in enumerate(self.LATENCY_BUCKETS):
+                if latency <= bound:
+                    c["latency_buckets"][i] += 1
+                    break
+
+    def record_timeout(self, op):
+        self._command(op)["timeouts"] += 1
+
+    def record_error(self, op):
+        self._command(op)["errors"] += 1
+
+    def record_phase(self, phase, seconds):
+        p = self.phases.setdefault(phase, {"count": 0, "seconds": 0.0})
+        p["count"] += 1
+        p["seconds"] += seconds
+
+    @staticmethod
+    def command_name(op):
+        if op is None:
+            return "none"
+        return COMMAND_NAMES.get(op, "op_0x%02x" % op)
+
+    def to_json(self):
+        commands = collections.OrderedDict()
+        for op in sorted(self.commands.keys(), key=lambda o: -1 if o is None else o):
+            c = dict(self.commands[op])
+            c["latency_buckets"] = collections.OrderedDict(
+                ("+Inf" if bound == float('inf') else str(bound), count)
+                for (bound, count) in zip(self.LATENCY_BUCKETS, c["latency_buckets"]))
+            commands[self.command_name(op)] = c
+        result = collections.OrderedDict([
+            ("esptool_version", __version__),
+            ("started", self.started),
+            ("duration", time.time() - self.started),
+            ("labels", self.labels),
+            ("commands", commands),
+            ("phases", self.phases),
+        ])
+        return json.dumps(result, indent=2)
+
+    def to_prometheus(self):
+        def escape(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        session_labels = ['%s="%s"' % (k, escape(v)) for (k, v) in sorted(self.labels.items())]
+        lines = []
+
+        def metric(name, metric_type, description, samples):
+            lines.append("# HELP esptool_%s %s" % (name, description))
+            lines.append("# TYPE esptool_%s %s" % (name, metric_type))
+            for (suffix, labels, value) in samples:
+                lines.append("esptool_%s%s{%s} %s" % (name, suffix, ",".join(labels + session_labels), repr(float(value))))
+
+        ops = sorted(self.commands.keys(), key=lambda o: -1 if o is None else o)
+
+        def command_samples(key):
+            return [("", ['op="%s"' % self.command_name(op)], self.commands[op][key]) for op in ops]
+
+        metric("commands_total", "counter", "Commands sent", command_samples("count"))
+        metric("command_errors_total", "counter", "Commands which failed with an error status", command_samples("errors"))
+        metric("command_timeouts_total", "counter", "Timeouts waiting for a command response", command_samples("timeouts"))
+        metric("command_retries_total", "counter", "Stale responses skipped while waiting for a command response", command_samples("retries"))
+        metric("command_sent_bytes_total", "counter", "Bytes sent to the serial port (SLIP framed)", command_samples("bytes_sent"))
+        metric("command_received_bytes_total", "counter", "Bytes of response packets received", command_samples("bytes_received"))
+
+        samples = []
+        for op in ops:
+            c = self.commands[op]
+            op_label = 'op="%s"' % self.command_name(op)
+            cumulative = 0
+            for (bound, count) in zip(self.LATENCY_BUCKETS, c["latency_buckets"]):
+                cumulative += count
+                samples.append(("_bucket", [op_label, 'le="%s"' % ("+Inf" if bound == float('inf') else repr(bound))], cumulative))
+            samples.append(("_sum", [op_label], c["latency_sum"]))
+            samples.append(("_count", [op_label], c["latency_count"]))
+        metric("command_latency_seconds", "histogram", "Time from sending a command to receiving its response", samples)
+
+        metric("phase_seconds_total", "counter", "Time spent in each phase of the session",
+               [("", ['phase="%s"' % name], p["seconds"]) for (name, p) in self.phases.items()])
+        metric("session_seconds", "gauge", "Duration of the session", [("", [], time.time() - self.started)])
+        return "\n".join(lines) + "\n"
+
+    def save(self, filename, metrics_format='json'):
+        with open(filename, 'w') as f:
+            f.write(self.to_prometheus() if metrics_format == 'prometheus' else self.to_json())
+
+
+class AdaptiveTimeouts(object):
+    """
+    Learns timeouts for slow, size-dependent operations (erasing, MD5
+    calculation, writing compressed data via the ROM loader) from how long
+    they actually take.
+
+    The fixed *_TIMEOUT_PER_MB constants have to allow for the slowest flash
+    chip there is, so a hung device takes a long time to detect. Instead, the
+    duration (seconds per MB) of every successful operation is recorded per
+    device (chip type & flash ID). Once there are MIN_SAMPLES of an operation,
+    its timeout is MARGIN times the PERCENTILE rate, plus DEFAULT_TIMEOUT
+    to cover fixed overheads. Until then, the fixed default timeout is used.
+
+    If a profile filename is given, samples are loaded from it and saved
+    back to it, so timeouts are learned across sessions.
+    """
+    MIN_SAMPLES = 5
+    MAX_SAMPLES = 100  # per device & operation, older samples are dropped
+    PERCENTILE = 0.99
+    MARGIN = 2.0
+    VERSION = 1
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.device = "unknown"
+        self.samples = {}
+        if filename is not None and os.path.exists(filename):
+            try:
+                with open(filename, 'r') as f:
+                    profile = json.load(f)
+                if profile.get("version") != self.VERSION:
+                    raise ValueError("unsupported version %r" % profile.get("version"))
+                self.samples = profile["samples"]
+            except (ValueError, KeyError, TypeError) as e:
+                print("WARNING: Ignoring invalid timeout profile %s (%s)" % (filename, e))
+
+    @staticmethod
+    def _units(size):
+        return 1.0 if size is None else size / 1e6
+
+    def _key(self, operation):
+        return "%s/%s" % (self.device, operation)
+
+    def timeout(self, operation, size, default_timeout):
+        """ Return the timeout for an operation on 'size' bytes (or None for a fixed size operation) """
+        samples = self.samples.get(self._key(operation), [])
+        if len(samples) < self.MIN_SAMPLES:
+            return default_timeout
+        ordered = sorted(samples)
+        rate = ordered[min(len(ordered) - 1, int(math.ceil(self.PERCENTILE * len(ordered))) - 1)]
+        return min(rate * self._units(size) * self.MARGIN + DEFAULT_TIMEOUT, MAX_TIMEOUT)
+
+    def record(self, operation, size, seconds):
+        """ Record the duration of a successful operation on 'size' bytes (or None for a fixed size operation) """
+        if size == 0:
+            return
+        samples = self.samples.setdefault(self._key(operation), [])
+        samples.append(seconds / self._units(size))
+        del samples[:-self.MAX_SAMPLES]
+
+    def save(self):
+        with open(self.filename, 'w') as f:
+            json.dump({"version": self.VERSION, "samples": self.samples}, f, indent=1, sort_keys=True)
+
+
+def replace_file(src, dst):
+    """ Rename src to dst, replacing dst if it exists """
+    try:
+        os.replace(src, dst)
+    except AttributeError:  # Python 2, where rename replaces dst except on Windows
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
 def pad_to(data, alignment, pad_character=b'\xFF'):
     """ Pad to the next alignment boundary """
     pad_mod = len(data) % alignment
     if pad_mod != 0:
+        if isinstance(data, memoryview):
+            data = data.tobytes()
         data += pad_character * (alignment - pad_mod)
     return data
 
@@ -2006,6 +2791,14 @@ class FatalError(RuntimeError):
         return FatalError(message)
 
 
+class PacketTimeoutError(FatalError):
+    """
+    Wrapper class for the error thrown when the ESP doesn't send a
+    (complete) response packet before the serial read times out.
+    """
+    pass
+
+
 class NotImplementedInROMError(FatalError):
     """
     Wrapper class for the error thrown when a particular ESP bootloader function
@@ -2037,10 +2830,11 @@ def load_ram(esp, args):
 
         seq = 0
         while len(seg.data) > 0:
-            esp.mem_block(seg.data[0:esp.ESP_RAM_BLOCK], seq)
+            esp.mem_block(bytes(seg.data[0:esp.ESP_RAM_BLOCK]), seq)
             seg.data = seg.data[esp.ESP_RAM_BLOCK:]
             seq += 1
         print('done!')
+    image.close()
 
     print('All segments done, executing at %08x' % image.entrypoint)
     esp.mem_finish(image.entrypoint)
@@ -2056,19 +2850,22 @@ def write_mem(esp, args):
 
 
 def dump_mem(esp, args):
+    DUMP_CHUNK_SIZE = 1024  # bytes read (and written to file) per progress update
     with open(args.filename, 'wb') as f:
-        for i in range(args.size // 4):
-            d = esp.read_reg(args.address + (i * 4))
-            f.write(struct.pack(b'<I', d))
-            if f.tell() % 1024 == 0:
-                print('\r%d bytes read... (%d %%)' % (f.tell(),
-                                                      f.tell() * 100 // args.size),
-                      end=' ')
+        for offs in range(0, args.size - args.size % 4, DUMP_CHUNK_SIZE):
+            words = min(DUMP_CHUNK_SIZE, args.size - offs) // 4
+            values = esp.read_regs([args.address + offs + (i * 4) for i in range(words)])
+            f.write(struct.pack(b'<%dI' % len(values), *values))
+            print('\r%d bytes read... (%d %%)' % (f.tell(),
+                                                  f.tell() * 100 // args.size),
+                  end=' ')
             sys.stdout.flush()
     print('Done!')
 
 
 def detect_flash_size(esp, args):
+    """ Detect the flash size if args.flash_size is 'detect'. Returns the flash ID if it was read, otherwise None. """
+    flash_id = None
     if args.flash_size == 'detect':
         flash_id = esp.flash_id()
         size_id = flash_id >> 16
@@ -2078,6 +2875,7 @@ def detect_flash_size(esp, args):
             args.flash_size = '4MB'
         else:
             print('Auto-detected Flash size:', args.flash_size)
+    return flash_id
 
 
 def _update_image_flash_params(esp, address, args, image):
@@ -2155,7 +2953,17 @@ def write_flash(esp, args):
             sys.stdout.flush()
             block = image[0:esp.FLASH_WRITE_SIZE]
             if args.compress:
-                esp.flash_defl_block(block, seq, timeout=DEFAULT_TIMEOUT * ratio * 2)
+                # a compressed block may take much longer to write than its size suggests
+                block_timeout = DEFAULT_TIMEOUT * ratio * 2
+                if esp.IS_STUB:
+                    # the stub replies before it writes each block, while the next one is sent, so
+                    # the reply time mostly measures the UART transfer and isn't learned from
+                    esp.flash_defl_block(block, seq, timeout=block_timeout)
+                else:
+                    block_size = int(len(block) * ratio)
+                    block_t = time.time()
+                    esp.flash_defl_block(block, seq, timeout=esp.learned_timeout("write", block_size, block_timeout))
+                    esp.record_duration("write", block_size, time.time() - block_t)
             else:
                 # Pad the last block
                 block = block + b'\xff' * (esp.FLASH_WRITE_SIZE - len(block))
@@ -2164,6 +2972,7 @@ def write_flash(esp, args):
             seq += 1
             written += len(block)
         t = time.time() - t
+        esp.record_phase("write", t)
         speed_msg = ""
         if args.compress:
             if t > 0.0:
@@ -2224,6 +3033,7 @@ def image_info(args):
             print('Validation Hash: %s' % digest_msg)
     except AttributeError:
         pass  # ESP8266 image has no append_digest field
+    image.close()
 
 
 def make_image(args):
@@ -2241,11 +3051,33 @@ def make_image(args):
 
 
 def elf2image(args):
-    e = ELFFile(args.input)
     if args.chip == 'auto':  # Default to ESP8266 for backwards compatibility
         print("Creating image for ESP8266...")
         args.chip = 'esp8266'
 
+    cache = None
+    if args.cache is not None:
+        # everything that affects the contents of the output file(s)
+        options = {
+            "esptool_version": __version__,
+            "chip": args.chip,
+            "version": args.version,
+            "flash_mode": args.flash_mode,
+            "flash_size": args.flash_size,
+            "flash_freq": args.flash_freq,
+            "secure_pad": args.secure_pad,
+            "elf_sha256_offset": args.elf_sha256_offset,
+            "output": None if args.output is None else os.path.abspath(args.output),
+        }
+        cache = ImageBuildCache(args.cache)
+        e = ELFFile(args.input, cache.get_elf_metadata(args.input))
+        if cache.is_up_to_date(e, options):
+            e.close()
+            print("Image for %s is up to date." % args.input)
+            return
+    else:
+        e = ELFFile(args.input)
+
     if args.chip == 'esp32':
         image = ESP32FirmwareImage()
         image.secure_pad = args.secure_pad
@@ -2267,7 +3099,12 @@ def elf2image(args):
 
     if args.output is None:
         args.output = image.default_output_name(args.input)
-    image.save(args.output)
+    output_files = image.save(args.output)
+    e.close()
+
+    if cache is not None:
+        cache.update(e, options, output_files)
+        cache.save()
 
 
 def read_mac(esp, args):
@@ -2392,12 +3229,14 @@ def version(args):
 #
 
 
-def main(custom_commandline=None):
+def main(custom_commandline=None, port=None):
     """
     Main function for esptool
 
     custom_commandline - Optional override for default arguments parsing (that uses sys.argv), can be a list of custom arguments
     as strings.
+
+    port - Optional already-open serial port object, used instead of the --port argument.
     """
     parser = argparse.ArgumentParser(description='esptool.py v%s - ESP8266 ROM Bootloader Utility' % __version__, prog='esptool')
 
@@ -2439,6 +3278,30 @@ def main(custom_commandline=None):
         help="Enable trace-level output of esptool.py interactions.",
         action='store_true')
 
+    parser.add_argument(
+        '--trace-capture',
+        help="Record raw serial traffic (most recent %dMB) to a binary capture file when esptool.py exits. "
+        "Captures can be decoded or replayed with esptrace.py." % (TraceCapture.DEFAULT_MAX_BYTES // (1024 * 1024)),
+        metavar='FILENAME')
+
+    parser.add_argument(
+        '--metrics',
+        help="Record per-command counts, latencies and phase timings, and write them to a file when esptool.py exits.",
+        metavar='FILENAME')
+
+    parser.add_argument(
+        '--metrics-format',
+        help="Format of the --metrics file (default: json)",
+        choices=SessionMetrics.FORMATS,
+        default='json')
+
+    parser.add_argument(
+        '--timeout-profile',
+        help="Learn timeouts for erasing, MD5 calculation and (with the ROM loader) compressed writes from how long they take on this type of device, "
+        "and keep them in this file across sessions.",
+        metavar='FILENAME',
+        default=os.environ.get('ESPTOOL_TIMEOUT_PROFILE', None))
+
     parser.add_argument(
         '--override-vddsdio',
         help="Override ESP32 VDDSDIO internal voltage regulator (use with care)",
@@ -2537,6 +3400,8 @@ def main(custom_commandline=None):
     parser_elf2image.add_argument('--secure-pad', action='store_true', help='Pad image so once signed it will end on a 64KB boundary. For ESP32 images only.')
     parser_elf2image.add_argument('--elf-sha256-offset', help='If set, insert SHA256 hash (32 bytes) of the input ELF file at specified offset in the binary.',
                                   type=arg_auto_int, default=None)
+    parser_elf2image.add_argument('--cache', help='JSON file to cache build results in. If the ELF file and options are the same as ' +
+                                  'a previous build and its output is intact, the image is not generated again.', default=None)
 
     add_spi_flash_subparsers(parser_elf2image, is_elf2image=True)
 
@@ -2628,98 +3493,128 @@ def main(custom_commandline=None):
         operation_args = inspect.getfullargspec(operation_func).args
 
     if operation_args[0] == 'esp':  # operation function takes an ESPLoader connection object
-        if args.before != "no_reset_no_sync":
-            initial_baud = min(ESPLoader.ESP_ROM_BAUD, args.baud)  # don't sync faster than the default baud rate
-        else:
-            initial_baud = args.baud
-
-        if args.port is None:
-            ser_list = sorted(ports.device for ports in list_ports.comports())
-            print("Found %d serial ports" % len(ser_list))
-        else:
-            ser_list = [args.port]
-        esp = None
-        for each_port in reversed(ser_list):
-            print("Serial port %s" % each_port)
-            try:
-                if args.chip == 'auto':
-                    esp = ESPLoader.detect_chip(each_port, initial_baud, args.before, args.trace)
-                else:
-                    chip_class = {
-                        'esp8266': ESP8266ROM,
-                        'esp32': ESP32ROM,
-                    }[args.chip]
-                    esp = chip_class(each_port, initial_baud, args.trace)
-                    esp.connect(args.before)
-                break
-            except (FatalError, OSError) as err:
-                if args.port is not None:
-                    raise
-                print("%s failed to connect: %s" % (each_port, err))
-                esp = None
-        if esp is None:
-            raise FatalError("All of the %d available serial ports could not connect to a Espressif device." % len(ser_list))
-
-        print("Chip is %s" % (esp.get_chip_description()))
-
-        print("Features: %s" % ", ".join(esp.get_chip_features()))
-
-        read_mac(esp, args)
-
-        if not args.no_stub:
-            esp = esp.run_stub()
+        trace_capture = TraceCapture() if args.trace_capture is not None else None
+        metrics = SessionMetrics() if args.metrics is not None else None
+        timeouts = AdaptiveTimeouts(args.timeout_profile)
+        try:
+            if args.before != "no_reset_no_sync":
+                initial_baud = min(ESPLoader.ESP_ROM_BAUD, args.baud)  # don't sync faster than the default baud rate
+            else:
+                initial_baud = args.baud
 
-        if args.override_vddsdio:
-            esp.override_vddsdio(args.override_vddsdio)
+            if port is not None:
+                ser_list = [port]
+            elif args.port is None:
+                ser_list = sorted(ports.device for ports in list_ports.comports())
+                print("Found %d serial ports" % len(ser_list))
+            else:
+                ser_list = [args.port]
+            esp = None
+            for each_port in reversed(ser_list):
+                print("Serial port %s" % each_port)
+                try:
+                    if args.chip == 'auto':
+                        esp = ESPLoader.detect_chip(each_port, initial_baud, args.before, args.trace, trace_capture, metrics, timeouts)
+                    else:
+                        chip_class = {
+                            'esp8266': ESP8266ROM,
+                            'esp32': ESP32ROM,
+                        }[args.chip]
+                        esp = chip_class(each_port, initial_baud, args.trace, trace_capture, metrics, timeouts)
+                        esp.connect(args.before)
+                    break
+                except (FatalError, OSError) as err:
+                    if args.port is not None or port is not None:
+                        raise
+                    print("%s failed to connect: %s" % (each_port, err))
+                    esp = None
+            if esp is None:
+                raise FatalError("All of the %d available serial ports could not connect to a Espressif device." % len(ser_list))
+
+            print("Chip is %s" % (esp.get_chip_description()))
+            if metrics is not None:
+                metrics.labels["port"] = str(each_port)
+                metrics.labels["chip"] = esp.CHIP_NAME
+                metrics.labels["baud"] = args.baud
+
+            print("Features: %s" % ", ".join(esp.get_chip_features()))
+
+            read_mac(esp, args)
+
+            if not args.no_stub:
+                esp = esp.run_stub()
+
+            if args.override_vddsdio:
+                esp.override_vddsdio(args.override_vddsdio)
+
+            if args.baud > initial_baud:
+                try:
+                    esp.change_baud(args.baud)
+                except NotImplementedInROMError:
+                    print("WARNING: ROM doesn't support changing baud rate. Keeping initial baud rate %d" % initial_baud)
+
+            # override common SPI flash parameter stuff if configured to do so
+            if hasattr(args, "spi_connection") and args.spi_connection is not None:
+                if esp.CHIP_NAME != "ESP32":
+                    raise FatalError("Chip %s does not support --spi-connection option." % esp.CHIP_NAME)
+                print("Configuring SPI flash mode...")
+                esp.flash_spi_attach(args.spi_connection)
+            elif args.no_stub:
+                print("Enabling default SPI flash mode...")
+                # ROM loader doesn't enable flash unless we explicitly do it
+                esp.flash_spi_attach(0)
+
+            flash_id = None
+            if hasattr(args, "flash_size"):
+                print("Configuring flash size...")
+                flash_id = detect_flash_size(esp, args)
+                esp.flash_set_parameters(flash_size_bytes(args.flash_size))
+
+            if args.timeout_profile is not None and operation_func in (write_flash, verify_flash, erase_flash, erase_region):
+                # timeouts are learned per flash chip model, for the operations which erase, write or MD5 flash
+                if flash_id is None:
+                    flash_id = esp.flash_id()
+                timeouts.device = "%s:%06x" % (esp.CHIP_NAME, flash_id)
 
-        if args.baud > initial_baud:
             try:
-                esp.change_baud(args.baud)
-            except NotImplementedInROMError:
-                print("WARNING: ROM doesn't support changing baud rate. Keeping initial baud rate %d" % initial_baud)
-
-        # override common SPI flash parameter stuff if configured to do so
-        if hasattr(args, "spi_connection") and args.spi_connection is not None:
-            if esp.CHIP_NAME != "ESP32":
-                raise FatalError("Chip %s does not support --spi-connection option." % esp.CHIP_NAME)
-            print("Configuring SPI flash mode...")
-            esp.flash_spi_attach(args.spi_connection)
-        elif args.no_stub:
-            print("Enabling default SPI flash mode...")
-            # ROM loader doesn't enable flash unless we explicitly do it
-            esp.flash_spi_attach(0)
-
-        if hasattr(args, "flash_size"):
-            print("Configuring flash size...")
-            detect_flash_size(esp, args)
-            esp.flash_set_parameters(flash_size_bytes(args.flash_size))
+                operation_func(esp, args)
+            finally:
+                try:  # Clean up AddrFilenamePairAction files
+                    for address, argfile in args.addr_filename:
+                        argfile.close()
+                except AttributeError:
+                    pass
+
+            # Handle post-operation behaviour (reset or other)
+            if operation_func == load_ram:
+                # the ESP is now running the loaded image, so let it run
+                print('Exiting immediately.')
+            elif args.after == 'hard_reset':
+                print('Hard resetting via RTS pin...')
+                esp.hard_reset()
+            elif args.after == 'soft_reset':
+                print('Soft resetting...')
+                # flash_finish will trigger a soft reset
+                esp.soft_reset(False)
+            else:
+                print('Staying in bootloader.')
+                if esp.IS_STUB:
+                    esp.soft_reset(True)  # exit stub back to ROM loader
 
-        try:
-            operation_func(esp, args)
+            esp._port.close()
         finally:
-            try:  # Clean up AddrFilenamePairAction files
-                for address, argfile in args.addr_filename:
-                    argfile.close()
-            except AttributeError:
-                pass
-
-        # Handle post-operation behaviour (reset or other)
-        if operation_func == load_ram:
-            # the ESP is now running the loaded image, so let it run
-            print('Exiting immediately.')
-        elif args.after == 'hard_reset':
-            print('Hard resetting via RTS pin...')
-            esp.hard_reset()
-        elif args.after == 'soft_reset':
-            print('Soft resetting...')
-            # flash_finish will trigger a soft reset
-            esp.soft_reset(False)
-        else:
-            print('Staying in bootloader.')
-            if esp.IS_STUB:
-                esp.soft_reset(True)  # exit stub back to ROM loader
-
-        esp._port.close()
+            if trace_capture is not None:
+                trace_capture.save(args.trace_capture)
+                print("Saved trace capture to %s" % args.trace_capture)
+            if metrics is not None:
+                metrics.save(args.metrics, args.metrics_format)
+                print("Saved metrics to %s" % args.metrics)
+            if args.timeout_profile is not None:
+                try:
+                    timeouts.save()
+                except EnvironmentError as e:
+                    # don't hide any error from the operation itself
+                    print("WARNING: Failed to save timeout profile %s: %s" % (args.timeout_profile, e))
 
     else:
         operation_func(args)
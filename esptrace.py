@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# ESP8266 & ESP32 serial trace capture utility
+# https://github.com/espressif/esptool
+#
+# Decodes and replays the binary capture files written by
+# esptool.py --trace-capture
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51 Franklin
+# Street, Fifth Floor, Boston, MA 02110-1301 USA.
+from __future__ import division, print_function
+
+import argparse
+import collections
+import struct
+import sys
+
+import esptool
+
+
+def slip_frames(data, partial=b""):
+    """ Split a chunk of SLIP framed data into decoded frames
+
+    'partial' is any incomplete frame left over from the previous chunk.
+    Returns (list of complete frames, new partial frame). Bytes outside
+    of a frame are ignored.
+    """
+    frames = []
+    chunks = (partial + data).split(b'\xc0')
+    for chunk in chunks[:-1]:
+        if len(chunk) > 0:
+            frames.append(chunk.replace(b'\xdb\xdc', b'\xc0').replace(b'\xdb\xdd', b'\xdb'))
+    return frames, chunks[-1]
+
+
+def describe_frame(direction, frame):
+    """ Return a one-line human readable description of a decoded frame """
+    if len(frame) < 8:
+        return "%d byte frame: %s" % (len(frame), esptool.hexify(frame, False))
+    (resp, op, length, val) = struct.unpack('<BBHI', frame[:8])
+    name = esptool.COMMAND_NAMES.get(op, "op 0x%02x" % op)
+    if direction == esptool.TraceCapture.DIR_WRITE and resp == 0:
+        msg = "%s len=%d chk=0x%02x" % (name, length, val)
+        if op in [esptool.ESPLoader.ESP_FLASH_DATA, esptool.ESPLoader.ESP_FLASH_DEFL_DATA,
+                  esptool.ESPLoader.ESP_MEM_DATA] and len(frame) >= 16:
+            msg += " seq=%d" % struct.unpack('<I', frame[12:16])
+        elif op == esptool.ESPLoader.ESP_READ_REG and len(frame) >= 12:
+            msg += " addr=0x%08x" % struct.unpack('<I', frame[8:12])
+        return msg
+    elif direction == esptool.TraceCapture.DIR_READ and resp == 1:
+        return "%s response val=0x%08x data=%s" % (name, val, esptool.hexify(frame[8:], False))
+    return "%d byte frame: %s" % (len(frame), esptool.HexFormatter(frame))
+
+
+def decode(args):
+    """ Print the frames in a capture file, with timestamps """
+    capture = esptool.TraceCapture.load(args.capture)
+    if capture.dropped:
+        print("Note: %d records were dropped from the start of this capture" % capture.dropped)
+    partial = {esptool.TraceCapture.DIR_WRITE: b"", esptool.TraceCapture.DIR_READ: b""}
+    start = None
+    for (timestamp, direction, data) in capture.records:
+        if start is None:
+            start = timestamp
+        frames, partial[direction] = slip_frames(data, partial[direction])
+        for frame in frames:
+            print("%10.6f %s %s" % (timestamp - start,
+                                    "->" if direction == esptool.TraceCapture.DIR_WRITE else "<-",
+                                    describe_frame(direction, frame)))
+            if args.raw:
+                print("           %s" % esptool.HexFormatter(frame))
+
+
+class ReplayPort(object):
+    """
+    Simulated serial device, which plays back the device side of a
+    capture to the host.
+
+    Each time the host writes, the data must match the next write
+    recorded in the capture. The reads recorded after that write are
+    then returned to the host in the same chunks they were originally read.
+    A read with nothing left to play back acts as a serial timeout.
+    """
+    def __init__(self, capture):
+        self._records = list(capture.records)
+        self._next = 0
+        self._pending = collections.deque()
+        self.timeout = None
+        self.write_timeout = None
+        self.baudrate = esptool.ESPLoader.ESP_ROM_BAUD
+        self.dtr = False
+        self.rts = False
+
+    def __str__(self):
+        return "replay (%d/%d records)" % (self._next, len(self._records))
+
+    def write(self, data):
+        if self._next >= len(self._records):
+            raise esptool.FatalError("Replay diverged: host wrote %d bytes after the end of the capture" % len(data))
+        (_, direction, expected) = self._records[self._next]
+        if direction != esptool.TraceCapture.DIR_WRITE:
+            raise esptool.FatalError("Replay diverged at record %d: host wrote data, but the capture has the device sending data"
+                                     % self._next)
+        if bytes(data) != expected:
+            raise esptool.FatalError("Replay diverged at record %d: host wrote %s, capture has %s"
+                                     % (self._next, esptool.HexFormatter(bytes(data)), esptool.HexFormatter(expected)))
+        self._next += 1
+        while self._next < len(self._records) and self._records[self._next][1] == esptool.TraceCapture.DIR_READ:
+            self._pending.append(self._records[self._next][2])
+            self._next += 1
+
+    def inWaiting(self):
+        return len(self._pending[0]) if self._pending else 0
+
+    def read(self, size=1):
+        if not self._pending:
+            return b""  # timeout
+        chunk = self._pending.popleft()
+        if len(chunk) > size:
+            self._pending.appendleft(chunk[size:])
+            chunk = chunk[:size]
+        return chunk
+
+    def is_finished(self):
+        return self._next >= len(self._records) and not self._pending
+
+    def flushInput(self):
+        pass  # only data the host actually read is captured, so there is never anything to discard
+
+    def flushOutput(self):
+        pass
+
+    def setDTR(self, state):
+        self.dtr = state
+
+    def setRTS(self, state):
+        self.rts = state
+
+    def close(self):
+        pass
+
+
+def replay(args):
+    """ Re-run an esptool.py command against the device side of a capture """
+    capture = esptool.TraceCapture.load(args.capture)
+    if capture.dropped:
+        raise esptool.FatalError("%d records were dropped from the start of this capture, so it can't be replayed" % capture.dropped)
+    port = ReplayPort(capture)
+    esptool_args = args.esptool_args
+    if len(esptool_args) > 0 and esptool_args[0] == "--":
+        esptool_args = esptool_args[1:]
+    esptool.main(esptool_args, port=port)
+    if not port.is_finished():
+        raise esptool.FatalError("Replay finished early: %s" % port)
+    print("Replay complete, host traffic matched the capture.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='esptrace.py v%s - esptool.py trace capture utility' % esptool.__version__, prog='esptrace')
+
+    subparsers = parser.add_subparsers(
+        dest='operation',
+        help='Run esptrace.py {command} -h for additional help')
+
+    p = subparsers.add_parser('decode',
+                              help='Print the decoded commands and responses in a capture file')
+    p.add_argument('--raw', '-r', help='Also print the raw frame contents in hex', action='store_true')
+    p.add_argument('capture', help='Capture file written by esptool.py --trace-capture')
+
+    p = subparsers.add_parser('replay',
+                              help='Run an esptool.py command against a simulated device which plays back a capture. ' +
+                              'The command must be the same one used to record the capture, the host traffic is checked against it.')
+    p.add_argument('capture', help='Capture file written by esptool.py --trace-capture')
+    p.add_argument('esptool_args', help='esptool.py arguments (without --port or --trace-capture)', nargs=argparse.REMAINDER)
+
+    args = parser.parse_args()
+    print('esptrace.py v%s' % esptool.__version__)
+    if args.operation is None:
+        parser.print_help()
+        parser.exit(1)
+
+    # each 'operation' is a module-level function of the same name
+    operation_func = globals()[args.operation]
+    operation_func(args)
+
+
+def _main():
+    try:
+        main()
+    except esptool.FatalError as e:
+        print('\nA fatal error occurred: %s' % e)
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    _main()
@@ -200,6 +200,10 @@ class AES(object):
                                   self.U3[(tt >>  8) & 0xFF] ^
                                   self.U4[ tt        & 0xFF])
 
+        # Unsigned copies of the round keys, flattened, for the bulk block functions
+        self._Ke_words = [k & 0xFFFFFFFF for rk in self._Ke for k in rk]
+        self._Kd_words = [k & 0xFFFFFFFF for rk in self._Kd for k in rk]
+
     def encrypt(self, plaintext):
         'Encrypt a block of plain text using the AES block cipher.'
 
@@ -268,6 +272,78 @@ class AES(object):
 
         return result
 
+    def encrypt_blocks(self, plaintext):
+        '''Encrypt a bytes-like buffer of plain text, a multiple of 16 bytes
+           long, as independent blocks (ie ECB). Returns bytes.
+
+           Each block is processed as four 32-bit words using the T-tables
+           with the round loop unrolled, so there is no per-block list
+           conversion or function call.'''
+
+        (words, out) = self._block_words(plaintext)
+        (T1, T2, T3, T4, S, K) = (self.T1, self.T2, self.T3, self.T4, self.S, self._Ke_words)
+        last = len(K) - 4
+
+        for b in xrange(0, len(words), 4):
+            s0 = words[b] ^ K[0]
+            s1 = words[b + 1] ^ K[1]
+            s2 = words[b + 2] ^ K[2]
+            s3 = words[b + 3] ^ K[3]
+
+            # Apply round transforms
+            for k in xrange(4, last, 4):
+                (s0, s1, s2, s3) = (
+                    T1[s0 >> 24] ^ T2[(s1 >> 16) & 0xFF] ^ T3[(s2 >> 8) & 0xFF] ^ T4[s3 & 0xFF] ^ K[k],
+                    T1[s1 >> 24] ^ T2[(s2 >> 16) & 0xFF] ^ T3[(s3 >> 8) & 0xFF] ^ T4[s0 & 0xFF] ^ K[k + 1],
+                    T1[s2 >> 24] ^ T2[(s3 >> 16) & 0xFF] ^ T3[(s0 >> 8) & 0xFF] ^ T4[s1 & 0xFF] ^ K[k + 2],
+                    T1[s3 >> 24] ^ T2[(s0 >> 16) & 0xFF] ^ T3[(s1 >> 8) & 0xFF] ^ T4[s2 & 0xFF] ^ K[k + 3])
+
+            # The last round is special
+            out[b] = ((S[s0 >> 24] << 24) | (S[(s1 >> 16) & 0xFF] << 16) | (S[(s2 >> 8) & 0xFF] << 8) | S[s3 & 0xFF]) ^ K[last]
+            out[b + 1] = ((S[s1 >> 24] << 24) | (S[(s2 >> 16) & 0xFF] << 16) | (S[(s3 >> 8) & 0xFF] << 8) | S[s0 & 0xFF]) ^ K[last + 1]
+            out[b + 2] = ((S[s2 >> 24] << 24) | (S[(s3 >> 16) & 0xFF] << 16) | (S[(s0 >> 8) & 0xFF] << 8) | S[s1 & 0xFF]) ^ K[last + 2]
+            out[b + 3] = ((S[s3 >> 24] << 24) | (S[(s0 >> 16) & 0xFF] << 16) | (S[(s1 >> 8) & 0xFF] << 8) | S[s2 & 0xFF]) ^ K[last + 3]
+
+        return struct.pack('>%dI' % len(out), *out)
+
+    def decrypt_blocks(self, ciphertext):
+        '''Decrypt a bytes-like buffer of cipher text, a multiple of 16 bytes
+           long, as independent blocks (ie ECB). Returns bytes.'''
+
+        (words, out) = self._block_words(ciphertext)
+        (T5, T6, T7, T8, Si, K) = (self.T5, self.T6, self.T7, self.T8, self.Si, self._Kd_words)
+        last = len(K) - 4
+
+        for b in xrange(0, len(words), 4):
+            s0 = words[b] ^ K[0]
+            s1 = words[b + 1] ^ K[1]
+            s2 = words[b + 2] ^ K[2]
+            s3 = words[b + 3] ^ K[3]
+
+            # Apply round transforms
+            for k in xrange(4, last, 4):
+                (s0, s1, s2, s3) = (
+                    T5[s0 >> 24] ^ T6[(s3 >> 16) & 0xFF] ^ T7[(s2 >> 8) & 0xFF] ^ T8[s1 & 0xFF] ^ K[k],
+                    T5[s1 >> 24] ^ T6[(s0 >> 16) & 0xFF] ^ T7[(s3 >> 8) & 0xFF] ^ T8[s2 & 0xFF] ^ K[k + 1],
+                    T5[s2 >> 24] ^ T6[(s1 >> 16) & 0xFF] ^ T7[(s0 >> 8) & 0xFF] ^ T8[s3 & 0xFF] ^ K[k + 2],
+                    T5[s3 >> 24] ^ T6[(s2 >> 16) & 0xFF] ^ T7[(s1 >> 8) & 0xFF] ^ T8[s0 & 0xFF] ^ K[k + 3])
+
+            # The last round is special
+            out[b] = ((Si[s0 >> 24] << 24) | (Si[(s3 >> 16) & 0xFF] << 16) | (Si[(s2 >> 8) & 0xFF] << 8) | Si[s1 & 0xFF]) ^ K[last]
+            out[b + 1] = ((Si[s1 >> 24] << 24) | (Si[(s0 >> 16) & 0xFF] << 16) | (Si[(s3 >> 8) & 0xFF] << 8) | Si[s2 & 0xFF]) ^ K[last + 1]
+            out[b + 2] = ((Si[s2 >> 24] << 24) | (Si[(s1 >> 16) & 0xFF] << 16) | (Si[(s0 >> 8) & 0xFF] << 8) | Si[s3 & 0xFF]) ^ K[last + 2]
+            out[b + 3] = ((Si[s3 >> 24] << 24) | (Si[(s2 >> 16) & 0xFF] << 16) | (Si[(s1 >> 8) & 0xFF] << 8) | Si[s0 & 0xFF]) ^ K[last + 3]
+
+        return struct.pack('>%dI' % len(out), *out)
+
+    def _block_words(self, data):
+        'Returns the big-endian words of a multiple-of-16 byte buffer, and a preallocated output list.'
+
+        if len(data) % 16 != 0:
+            raise ValueError('data must be a multiple of 16 bytes')
+
+        word_count = len(data) // 4
+        return (struct.unpack('>%dI' % word_count, data), [0] * word_count)
 
 class Counter(object):
     '''A counter object for the Counter (CTR) mode of operation.
@@ -351,6 +427,16 @@ class AESModeOfOperationECB(AESBlockModeOfOperation):
         ciphertext = _string_to_bytes(ciphertext)
         return _bytes_to_string(self._aes.decrypt(ciphertext))
 
+    def encrypt_blocks(self, plaintext):
+        'Encrypt any number of 16 byte blocks of plain text in one call.'
+
+        return self._aes.encrypt_blocks(plaintext)
+
+    def decrypt_blocks(self, ciphertext):
+        'Decrypt any number of 16 byte blocks of cipher text in one call.'
+
+        return self._aes.decrypt_blocks(ciphertext)
+
 
 
 class AESModeOfOperationCBC(AESBlockModeOfOperation):
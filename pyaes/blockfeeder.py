@@ -21,7 +21,7 @@
 # THE SOFTWARE.
 
 
-from .aes import AESBlockModeOfOperation, AESSegmentModeOfOperation, AESStreamModeOfOperation
+from .aes import AESBlockModeOfOperation, AESModeOfOperationECB, AESSegmentModeOfOperation, AESStreamModeOfOperation
 from .util import append_PKCS7_padding, strip_PKCS7_padding, to_bufferable
 
 
@@ -87,6 +87,13 @@ AESBlockModeOfOperation._can_consume = _block_can_consume
 AESBlockModeOfOperation._final_encrypt = _block_final_encrypt
 AESBlockModeOfOperation._final_decrypt = _block_final_decrypt
 
+# ECB blocks are independent, so any number of them can be processed in one bulk call
+
+def _ecb_can_consume(self, size):
+    return 16 * int(size // 16)
+
+AESModeOfOperationECB._can_consume = _ecb_can_consume
+
 
 
 # CFB is a segment cipher
@@ -187,14 +194,16 @@ class Encrypter(BlockFeeder):
     'Accepts bytes of plaintext and returns encrypted ciphertext.'
 
     def __init__(self, mode, padding = PADDING_DEFAULT):
-        BlockFeeder.__init__(self, mode, mode.encrypt, mode._final_encrypt, padding)
+        feed = getattr(mode, 'encrypt_blocks', mode.encrypt)
+        BlockFeeder.__init__(self, mode, feed, mode._final_encrypt, padding)
 
 
 class Decrypter(BlockFeeder):
     'Accepts bytes of ciphertext and returns decrypted plaintext.'
 
     def __init__(self, mode, padding = PADDING_DEFAULT):
-        BlockFeeder.__init__(self, mode, mode.decrypt, mode._final_decrypt, padding)
+        feed = getattr(mode, 'decrypt_blocks', mode.decrypt)
+        BlockFeeder.__init__(self, mode, feed, mode._final_decrypt, padding)
 
 
 # 8kb blocks
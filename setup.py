@@ -68,17 +68,19 @@ if os.name == "nt":
             'esptool.py=esptool:_main',
             'espsecure.py=espsecure:_main',
             'espefuse.py=espefuse:_main',
+            'esptrace.py=esptrace:_main',
         ],
     }
 else:
     scripts = ['esptool.py',
                'espsecure.py',
-               'espefuse.py']
+               'espefuse.py',
+               'esptrace.py']
     entry_points = None
 
 setup(
     name='esptool',
-    py_modules=['esptool', 'espsecure', 'espefuse'],
+    py_modules=['esptool', 'espsecure', 'espefuse', 'esptrace'],
     version=find_version('esptool.py'),
     description='A serial utility to communicate & flash code to Espressif ESP8266 & ESP32 chips.',
     long_description=long_description,
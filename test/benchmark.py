@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+"""
+Host-side benchmarks for esptool.py, espsecure.py & friends.
+
+These don't need an ESP device attached. Serial traffic is answered by a
+loopback port which acknowledges every command immediately, so the
+numbers are host CPU cost only.
+
+Run all benchmarks:
+
+    python test/benchmark.py
+
+Or name the ones to run:
+
+    python test/benchmark.py framing flash_encryption
+"""
+from __future__ import division, print_function
+
+import os
+import io
+import os.path
+import struct
+import sys
+import time
+
+TEST_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(TEST_DIR, ".."))
+
+import espsecure  # noqa: E402
+import esptool  # noqa: E402
+import pyaes  # noqa: E402
+
+MB = 1024 * 1024
+
+
+class LoopbackPort(object):
+    """ Stand-in for a serial port, replies with a successful response to every SLIP frame written """
+    def __init__(self, status_bytes_length=2):
+        self.timeout = None
+        self.baudrate = esptool.ESPLoader.ESP_ROM_BAUD
+        self.write_timeout = None
+        self._status = b'\x00' * status_bytes_length
+        self._rx = bytearray()
+
+    def write(self, buf):
+        # frame header is at a fixed position (header has no bytes needing SLIP escaping, for any sane op & length)
+        op = buf[2] if not esptool.PYTHON2 else ord(buf[2])
+        self._rx += b'\xc0' + struct.pack('<BBHI', 1, op, len(self._status), 0) + self._status + b'\xc0'
+
+    def inWaiting(self):
+        return len(self._rx)
+
+    def read(self, size=1):
+        result = bytes(self._rx[:size])
+        del self._rx[:size]
+        return result
+
+    def flushInput(self):
+        self._rx = bytearray()
+
+
+def cpu_time():
+    try:
+        return time.process_time()
+    except AttributeError:  # Python 2
+        return time.clock()
+
+
+def report(name, cpu_seconds, num_bytes):
+    print("  %-40s %8.2f ms CPU per MB" % (name, cpu_seconds * 1000 / (num_bytes / MB)))
+
+
+def bench_framing():
+    """ Host CPU spent framing flash_block, flash_defl_block & mem_block commands """
+    esp = esptool.ESP32StubLoader(esptool.ESP32ROM(LoopbackPort()))
+    data = os.urandom(4 * MB)
+
+    def legacy_frame(op, block, seq):
+        # the framing code used before blocks were sent as (header, data) tuples
+        chk = esptool.ESPLoader.ESP_CHECKSUM_MAGIC
+        for b in block:
+            if type(b) is int:
+                chk ^= b
+            else:
+                chk ^= ord(b)
+        payload = struct.pack('<IIII', len(block), seq, 0, 0) + block
+        packet = struct.pack(b'<BBHI', 0x00, op, len(payload), chk) + payload
+        return b'\xc0' + (packet.replace(b'\xdb', b'\xdb\xdd').replace(b'\xc0', b'\xdb\xdc')) + b'\xc0'
+
+    def run(send, block_size):
+        t = cpu_time()
+        for seq, offs in enumerate(range(0, len(data), block_size)):
+            send(data[offs:offs + block_size], seq)
+        return cpu_time() - t
+
+    print("Command framing (%d MB of random data):" % (len(data) // MB))
+    report("legacy framing, 0x4000 blocks", run(lambda block, seq: legacy_frame(esp.ESP_FLASH_DATA, block, seq),
+                                                esp.FLASH_WRITE_SIZE), len(data))
+    report("flash_block, 0x4000 blocks", run(esp.flash_block, esp.FLASH_WRITE_SIZE), len(data))
+    report("flash_defl_block, 0x4000 blocks", run(esp.flash_defl_block, esp.FLASH_WRITE_SIZE), len(data))
+    report("mem_block, 0x1800 blocks", run(esp.mem_block, esp.ESP_RAM_BLOCK), len(data))
+
+
+def bench_checksum():
+    """ Host CPU spent calculating ROM checksums (XOR of all bytes) """
+    def legacy_checksum(data, state=esptool.ESPLoader.ESP_CHECKSUM_MAGIC):
+        # the per-byte loop used before checksums were calculated on big integers
+        for b in data:
+            if type(b) is int:
+                state ^= b
+            else:
+                state ^= ord(b)
+        return state
+
+    def run(checksum, data, iterations):
+        t = cpu_time()
+        for _ in range(iterations):
+            result = checksum(data)
+        return cpu_time() - t, result
+
+    print("Checksums (random data):")
+    for size, iterations in [(esptool.ESP32StubLoader.FLASH_WRITE_SIZE, 256), (4 * MB, 1)]:
+        data = os.urandom(size)
+        legacy_time, legacy_result = run(legacy_checksum, data, iterations)
+        report("per-byte loop, 0x%x bytes" % size, legacy_time, size * iterations)
+        current_time, current_result = run(esptool.ESPLoader.checksum, data, iterations)
+        report("ESPLoader.checksum, 0x%x bytes" % size, current_time, size * iterations)
+        assert legacy_result == current_result
+
+
+def bench_flash_encryption():
+    """ Host CPU spent by espsecure.py encrypting an image for flash encryption """
+    key = os.urandom(32)
+    data = os.urandom(2 * MB)
+
+    def legacy_encrypt(output_file, input_file, flash_address):
+        # the per-block I/O loop used before data was processed in buffers
+        tweak = espsecure.FlashEncryptionTweak(key)
+        aes = None
+        while True:
+            block_offs = flash_address + input_file.tell()
+            block = input_file.read(16)
+            if len(block) == 0:
+                break
+            if (block_offs % 32 == 0) or aes is None:
+                aes = pyaes.AESModeOfOperationECB(tweak.block_key(block_offs))
+            output_file.write(aes.decrypt(block[::-1])[::-1])
+
+    def current_encrypt(output_file, input_file, flash_address):
+        espsecure._flash_encryption_operation(output_file, input_file, flash_address, io.BytesIO(key), 0xF, False)
+
+    def run(encrypt):
+        output_file = io.BytesIO()
+        t = cpu_time()
+        encrypt(output_file, io.BytesIO(data), 0x10000)
+        t = cpu_time() - t
+        return t, output_file.getvalue()
+
+    print("Flash encryption (%d MB of random data):" % (len(data) // MB))
+    legacy_time, legacy_output = run(legacy_encrypt)
+    report("16 byte reads & writes", legacy_time, len(data))
+    current_time, current_output = run(current_encrypt)
+    report("encrypt_flash_data, 0x%x buffers" % espsecure.FLASH_ENCRYPTION_BUFFER_SIZE, current_time, len(data))
+    assert legacy_output == current_output
+
+
+def bench_image_save():
+    """ Host CPU spent by elf2image writing an ESP32 app image, and by image_info loading it again """
+    elf = esptool.ELFFile(os.path.join(TEST_DIR, "elf2image", "esp32-app-template.elf"))
+    image = esptool.ESP32FirmwareImage()
+    image.entrypoint = elf.entrypoint
+    image.segments = elf.sections
+    output = os.path.join(TEST_DIR, "benchmark-image.bin")
+    iterations = 20
+
+    def run(operation):
+        t = cpu_time()
+        for _ in range(iterations):
+            operation()
+        return cpu_time() - t
+
+    def load():
+        loaded = esptool.LoadFirmwareImage("esp32", output)
+        loaded.calculate_checksum()
+
+    try:
+        save_time = run(lambda: image.save(output))
+        num_bytes = os.path.getsize(output) * iterations
+        print("ESP32 app image (%d KB, %d segments):" % (os.path.getsize(output) // 1024, len(image.segments)))
+        report("ESP32FirmwareImage.save", save_time, num_bytes)
+        report("LoadFirmwareImage & checksum", run(load), num_bytes)
+    finally:
+        os.remove(output)
+
+
+BENCHMARKS = {
+    "checksum": bench_checksum,
+    "flash_encryption": bench_flash_encryption,
+    "framing": bench_framing,
+    "image_save": bench_image_save,
+}
+
+
+def main():
+    names = sys.argv[1:] or sorted(BENCHMARKS.keys())
+    for name in names:
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+#
+# Tests for espefuse.py using virtual efuses
+#
+# Doesn't need an attached device (unlike test_espefuse.py)
+import os
+import os.path
+import struct
+import sys
+import tempfile
+import unittest
+
+TEST_DIR = os.path.abspath(os.path.dirname(__file__))
+
+try:
+    import espefuse
+except ImportError:
+    sys.path.insert(0, os.path.join(TEST_DIR, ".."))
+    import espefuse
+
+import esptool
+
+
+class EspEfuseArgs(object):
+    def __init__(self, **kwargs):
+        self.do_not_confirm = True
+        self.no_protect_key = False
+        self.force_write_always = False
+        self.__dict__.update(kwargs)
+
+
+class VirtualEfuseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.esp = espefuse.VirtualEfuseController()
+        self.efuses = espefuse.EspEfuses(self.esp)
+
+
+class BurnTestCase(VirtualEfuseTestCase):
+
+    def test_burn_efuse(self):
+        espefuse.burn_efuse(self.esp, self.efuses, EspEfuseArgs(efuse_name="FLASH_CRYPT_CNT", new_value=None))
+        espefuse.burn_efuse(self.esp, self.efuses, EspEfuseArgs(efuse_name="FLASH_CRYPT_CNT", new_value=None))
+        self.assertEqual(0x3, self.efuses["FLASH_CRYPT_CNT"].get())
+        self.assertEqual(0x00300000, self.esp.blocks[0][0])
+
+    def test_write_protect(self):
+        self.efuses["JTAG_DISABLE"].disable_write()
+        self.assertFalse(self.efuses["JTAG_DISABLE"].is_writeable())
+        self.assertEqual(0, self.efuses["JTAG_DISABLE"].burn(1))
+        # another efuse in the same word isn't protected by the same bit
+        self.assertEqual(1, self.efuses["DISABLE_SDIO_HOST"].burn(1))
+
+    def test_burn_key_protected(self):
+        key = bytes(bytearray(range(1, 33)))
+        with tempfile.TemporaryFile() as keyfile:
+            keyfile.write(key)
+            espefuse.burn_key(self.esp, self.efuses, EspEfuseArgs(block="BLK2", keyfile=keyfile))
+        efuse = self.efuses["BLK2"]
+        self.assertFalse(efuse.is_readable())
+        self.assertFalse(efuse.is_writeable())
+        self.assertEqual(b'\x00' * 32, efuse.get_raw())
+        self.assertEqual(0x01020304, self.esp.blocks[2][7])  # stored reversed, but still burned
+
+    def test_burn_key_34_coding_scheme(self):
+        self.efuses["CODING_SCHEME"].burn(espefuse.CODING_SCHEME_34)
+        self.efuses = espefuse.EspEfuses(self.esp)
+        key = bytes(bytearray(range(1, 25)))
+        self.efuses["BLK1"].burn_key(key)
+        # read back decoded, without the check bytes
+        self.assertEqual(key[::-1], self.efuses["BLK1"].get_raw())
+        self.assertEqual([0, 0], self.esp.blocks[1][6:])
+
+    def test_save_load(self):
+        self.efuses["ABS_DONE_0"].burn(1)
+        for suffix in [".json", ".txt"]:
+            f = tempfile.NamedTemporaryFile(suffix=suffix, delete=False)
+            f.close()
+            try:
+                self.esp.save(f.name)
+                loaded = espefuse.VirtualEfuseController.load(f.name)
+            finally:
+                os.unlink(f.name)
+            self.assertEqual(self.esp.blocks, loaded.blocks)
+            self.assertEqual(1, espefuse.EspEfuses(loaded)["ABS_DONE_0"].get())
+
+    def test_load_invalid(self):
+        f = tempfile.NamedTemporaryFile(mode='w', suffix=".json", delete=False)
+        f.write('{"blocks": [[0, 0]]}')
+        f.close()
+        try:
+            with self.assertRaises(esptool.FatalError):
+                espefuse.VirtualEfuseController.load(f.name)
+        finally:
+            os.unlink(f.name)
+
+
+class TransactionTestCase(VirtualEfuseTestCase):
+
+    def count_program_cycles(self):
+        self.cycles = 0
+        write_reg = self.esp.write_reg
+
+        def counting_write_reg(addr, value, mask=0xFFFFFFFF, delay_us=0):
+            if addr == espefuse.EFUSE_REG_CMD and value == espefuse.EFUSE_CMD_WRITE:
+                self.cycles += 1
+            write_reg(addr, value, mask, delay_us)
+        self.esp.write_reg = counting_write_reg
+
+    def test_one_cycle(self):
+        self.count_program_cycles()
+        transaction = self.efuses.transaction()
+        transaction.burn("JTAG_DISABLE", 1)
+        transaction.burn("ABS_DONE_0", 1)  # same register word as JTAG_DISABLE
+        transaction.burn("FLASH_CRYPT_CNT", 1)
+        self.assertEqual([], transaction.commit())
+        self.assertEqual(1, self.cycles)
+        self.assertEqual(1, self.efuses["JTAG_DISABLE"].get())
+        self.assertEqual(1, self.efuses["ABS_DONE_0"].get())
+        self.assertEqual(1, self.efuses["FLASH_CRYPT_CNT"].get())
+
+    def test_protect_after_data(self):
+        self.count_program_cycles()
+        key = bytes(bytearray(range(32)))
+        transaction = self.efuses.transaction()
+        transaction.burn_key("BLK1", key)
+        transaction.burn("FLASH_CRYPT_CONFIG", 0xF)
+        transaction.disable_write("BLK1")
+        transaction.disable_read("BLK1")
+        transaction.disable_write("FLASH_CRYPT_CONFIG")
+        self.assertEqual([], transaction.commit())
+        self.assertEqual(2, self.cycles)
+        self.assertEqual(0xF, self.efuses["FLASH_CRYPT_CONFIG"].get())
+        self.assertFalse(self.efuses["FLASH_CRYPT_CONFIG"].is_writeable())
+        self.assertFalse(self.efuses["BLK1"].is_readable())
+        self.assertEqual(key[::-1], struct.pack("<8I", *self.esp.blocks[1]))
+
+    def test_conflicts(self):
+        self.efuses["JTAG_DISABLE"].disable_write()
+        transaction = self.efuses.transaction()
+        transaction.burn("JTAG_DISABLE", 1)
+        with self.assertRaises(esptool.FatalError):
+            transaction.check()
+        transaction = self.efuses.transaction()
+        transaction.burn("ABS_DONE_0", 1)
+        transaction.burn("ABS_DONE_0", 1)
+        with self.assertRaises(esptool.FatalError):
+            transaction.check()
+        with self.assertRaises(esptool.FatalError):
+            self.efuses.transaction().burn("FLASH_CRYPT_CONFIG", 0x10)
+
+    def test_34_coding_scheme(self):
+        self.efuses["CODING_SCHEME"].burn(espefuse.CODING_SCHEME_34)
+        self.efuses = espefuse.EspEfuses(self.esp)
+        key = bytes(bytearray(range(24)))
+        self.efuses["BLK3"].burn_words(self.efuses["BLK3"].apply_34_encoding(b'\x00' * 18 + b'\x01' * 6))
+        transaction = self.efuses.transaction()
+        transaction.burn_key("BLK2", key)
+        transaction.burn("BLK3", b'\x02' * 18 + b'\x00' * 6)  # last group already burned
+        self.assertEqual([], transaction.check())
+        self.assertEqual([], transaction.commit())
+        self.assertEqual(key[::-1], self.efuses["BLK2"].get_raw())
+        self.assertEqual(b'\x02' * 18 + b'\x01' * 6, self.efuses["BLK3"].get_raw())
+
+    def test_34_coding_scheme_conflict(self):
+        self.efuses["CODING_SCHEME"].burn(espefuse.CODING_SCHEME_34)
+        self.efuses = espefuse.EspEfuses(self.esp)
+        self.efuses["BLK3"].burn_words(self.efuses["BLK3"].apply_34_encoding(b'\x01' * 6))
+        transaction = self.efuses.transaction()
+        transaction.burn_key("BLK3", b'\x02' * 24)
+        with self.assertRaises(esptool.FatalError):
+            transaction.check()
+
+
+if __name__ == '__main__':
+    unittest.main(buffer=True)
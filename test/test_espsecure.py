@@ -8,6 +8,8 @@ import subprocess
 import os
 import os.path
 import io
+import json
+import shutil
 import sys
 import tempfile
 import zlib
@@ -23,6 +25,7 @@ except ImportError:
     import espsecure
 
 import esptool
+import pyaes
 
 class EspSecureTestCase(unittest.TestCase):
 
@@ -113,6 +116,40 @@ class ECDSASigningTests(EspSecureTestCase):
         finally:
             os.unlink(output_file.name)
 
+    def test_sign_data_in_place(self):
+        SignArgs = namedtuple('sign_data_args', ['keyfile', 'output', 'datafile'])
+        datafile = tempfile.NamedTemporaryFile(delete=False)
+        old_buffer_size = espsecure.SIGNING_BUFFER_SIZE
+        try:
+            datafile.write(self._open('bootloader.bin').read())
+            datafile.close()
+            espsecure.SIGNING_BUFFER_SIZE = 1000  # data is hashed in many chunks
+            espsecure.sign_data(SignArgs(self._open('ecdsa_secure_boot_signing_key.pem'), None,
+                                         open(datafile.name, 'rb')))
+            with open(datafile.name, 'rb') as f:
+                self.assertEqual(self._open('bootloader_signed.bin').read(), f.read())
+        finally:
+            espsecure.SIGNING_BUFFER_SIZE = old_buffer_size
+            os.unlink(datafile.name)
+
+    def test_sign_data_linked_output(self):
+        # output is a hard link to the data file, so the signature is appended
+        SignArgs = namedtuple('sign_data_args', ['keyfile', 'output', 'datafile'])
+        datafile = tempfile.NamedTemporaryFile(delete=False)
+        link = datafile.name + ".link"
+        try:
+            datafile.write(self._open('bootloader.bin').read())
+            datafile.close()
+            os.link(datafile.name, link)
+            espsecure.sign_data(SignArgs(self._open('ecdsa_secure_boot_signing_key.pem'), link,
+                                         open(datafile.name, 'rb')))
+            with open(datafile.name, 'rb') as f:
+                self.assertEqual(self._open('bootloader_signed.bin').read(), f.read())
+        finally:
+            os.unlink(datafile.name)
+            if os.path.exists(link):
+                os.unlink(link)
+
     def test_verify_signature_signing_key(self):
         # correct key
         args = self.VerifyArgs(self._open('ecdsa_secure_boot_signing_key.pem'),
@@ -171,9 +208,67 @@ class ECDSASigningTests(EspSecureTestCase):
             os.unlink(pub_keyfile.name)
             os.unlink(pub_keyfile2.name)
 
+    def test_sign_verify_batch(self):
+        BatchArgs = namedtuple('batch_args', ['keyfile', 'output_dir', 'manifest', 'jobs', 'results', 'datafiles'])
+        tempdir = tempfile.mkdtemp()
+        try:
+            datafiles = []
+            for name in ['app1.bin', 'app2.bin', 'app3.bin']:
+                datafiles.append(os.path.join(tempdir, name))
+                with open(datafiles[-1], 'wb') as f:
+                    f.write(self._open('bootloader.bin').read())
+            output_dir = os.path.join(tempdir, 'signed')
+            os.mkdir(output_dir)
+            # one file listed in a manifest, with an explicit output filename
+            with open(os.path.join(tempdir, 'manifest.json'), 'w') as f:
+                f.write('[{"datafile": "app3.bin", "output": "app3-signed.bin"}]')
+            with open(os.path.join(tempdir, 'manifest.json'), 'r') as manifest:
+                espsecure.sign_data_batch(BatchArgs(self._open('ecdsa_secure_boot_signing_key.pem'), output_dir,
+                                                    manifest, 2, None, datafiles[:2]))
+
+            signed = [os.path.join(output_dir, 'app1.bin'), os.path.join(output_dir, 'app2.bin'),
+                      os.path.join(tempdir, 'app3-signed.bin')]
+            for name in signed:
+                with open(name, 'rb') as f:
+                    self.assertEqual(self._open('bootloader_signed.bin').read(), f.read())
+
+            results = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+            results.name = 'results'
+            espsecure.verify_signature_batch(BatchArgs(self._open('ecdsa_secure_boot_signing_pubkey.pem'), None,
+                                                       None, 1, results, signed))
+            self.assertEqual(['valid'] * 3, [r['status'] for r in json.loads(results.getvalue())])
+
+            # unsigned data and wrong key both fail
+            with self.assertRaises(esptool.FatalError):
+                espsecure.verify_signature_batch(BatchArgs(self._open('ecdsa_secure_boot_signing_pubkey2.pem'), None,
+                                                           None, 2, None, signed))
+            with self.assertRaises(esptool.FatalError):
+                espsecure.verify_signature_batch(BatchArgs(self._open('ecdsa_secure_boot_signing_pubkey.pem'), None,
+                                                           None, 1, None, signed + [datafiles[0]]))
+        finally:
+            shutil.rmtree(tempdir)
+
 
 class ESP32FlashEncryptionTests(EspSecureTestCase):
 
+    def test_tweak_key(self):
+        def reference_tweak_key(key, offset, flash_crypt_conf):
+            # bit-by-bit tweak, as described in the ESP32 Technical Reference Manual
+            key = bytearray(key)
+            for bit in espsecure._flash_encryption_tweak_range(flash_crypt_conf):
+                if offset & (1 << espsecure._FLASH_ENCRYPTION_TWEAK_PATTERN[bit]):
+                    key[bit // 8] ^= 1 << (7 - (bit % 8))
+            return bytes(key)
+
+        key = self._open('256bit_key.bin').read()
+        for flash_crypt_conf in [0x0, 0x1, 0x6, 0xF]:
+            tweak = espsecure.FlashEncryptionTweak(key, flash_crypt_conf)
+            for offset in [0x0, 0x20, 0x1000, 0x1230, 0xABCDE0, 0xFFFFE0]:
+                expected = reference_tweak_key(key, offset, flash_crypt_conf)
+                self.assertEqual(expected, tweak.block_key(offset))
+                self.assertEqual(expected, espsecure._flash_encryption_tweak_key(
+                    key, offset, espsecure._flash_encryption_tweak_range(flash_crypt_conf)))
+
     def test_encrypt_decrypt(self):
         EncryptArgs = namedtuple('encrypt_flash_data_args',
                                  [ 'keyfile',
@@ -220,6 +315,102 @@ class ESP32FlashEncryptionTests(EspSecureTestCase):
         original_plaintext.seek(0)
         self.assertEqual(original_plaintext.read(), plaintext.getvalue())
 
+    def test_encrypt_decrypt_parallel(self):
+        FlashArgs = namedtuple('flash_data_args',
+                               ['keyfile',
+                                'output',
+                                'address',
+                                'flash_crypt_conf',
+                                'plaintext_file',
+                                'encrypted_file',
+                                'jobs'
+                                ])
+
+        # odd length, so the final block is padded
+        original_plaintext = self._open('bootloader.bin').read() + b'\x01\x02\x03'
+        key = self._open('256bit_key.bin').read()
+
+        def run(operation, input_data, jobs):
+            """ Run 'operation' using temporary files, return the output """
+            files = [tempfile.NamedTemporaryFile(delete=False) for _ in range(2)]
+            try:
+                files[0].write(input_data)
+                files[0].close()
+                files[1].close()
+                with open(files[0].name, 'rb') as input_file:
+                    with open(files[1].name, 'wb') as output_file:
+                        operation(FlashArgs(io.BytesIO(key), output_file, 0x10010, 0xF,
+                                            input_file, input_file, jobs))
+                with open(files[1].name, 'rb') as f:
+                    return f.read()
+            finally:
+                for f in files:
+                    os.unlink(f.name)
+
+        old_chunk_size = espsecure.PARALLEL_CHUNK_SIZE
+        espsecure.PARALLEL_CHUNK_SIZE = 0x1000  # test multiple chunks
+        try:
+            serial = run(espsecure.encrypt_flash_data, original_plaintext, 1)
+            parallel = run(espsecure.encrypt_flash_data, original_plaintext, 2)
+            self.assertEqual(len(serial), len(parallel))
+            self.assertEqual(serial[:-16], parallel[:-16])  # last block has random padding
+
+            for ciphertext in [serial, parallel]:
+                plaintext = run(espsecure.decrypt_flash_data, ciphertext, 2)
+                self.assertEqual(original_plaintext, plaintext[:len(original_plaintext)])
+                self.assertEqual(plaintext, run(espsecure.decrypt_flash_data, ciphertext, 1))
+        finally:
+            espsecure.PARALLEL_CHUNK_SIZE = old_chunk_size
+
+
+class AESBackendTests(EspSecureTestCase):
+
+    def tearDown(self):
+        espsecure.select_aes_backend()
+        super(AESBackendTests, self).tearDown()
+
+    def test_backends_identical(self):
+        """ Every installed AES backend produces the same output as the reference test images """
+        DBArgs = namedtuple('digest_bootloader_args', ['keyfile', 'output', 'iv', 'image'])
+        FlashArgs = namedtuple('flash_data_args', ['keyfile', 'output', 'address', 'flash_crypt_conf', 'plaintext_file'])
+        plaintext = self._open('bootloader.bin').read()
+        ciphertexts = {}
+        for backend in espsecure.AES_BACKENDS:
+            if not backend.is_available():
+                continue
+            espsecure.select_aes_backend(backend.NAME)
+
+            output_file = tempfile.NamedTemporaryFile(delete=False)
+            output_file.close()
+            try:
+                espsecure.digest_secure_bootloader(DBArgs(self._open('256bit_key.bin'), output_file.name,
+                                                          self._open('256bit_iv.bin'), self._open('bootloader.bin')))
+                with open(output_file.name, 'rb') as of:
+                    self.assertEqual(self._open('bootloader_digested.bin').read(), of.read())
+            finally:
+                os.unlink(output_file.name)
+
+            ciphertext = io.BytesIO()
+            espsecure.encrypt_flash_data(FlashArgs(self._open('256bit_key.bin'), ciphertext, 0x1010, 0xF, io.BytesIO(plaintext)))
+            ciphertexts[backend.NAME] = ciphertext.getvalue()
+        self.assertIn(espsecure.PyaesBackend.NAME, ciphertexts)
+        for name in ciphertexts:
+            self.assertEqual(ciphertexts[espsecure.PyaesBackend.NAME], ciphertexts[name], name)
+
+    def test_pyaes_blocks(self):
+        """ pyaes bulk ECB functions match the single block functions """
+        data = self._open('bootloader.bin').read()[:16 * 20]
+        for key_len in [16, 24, 32]:
+            aes = pyaes.AESModeOfOperationECB(self._open('256bit_key.bin').read()[:key_len])
+            ciphertext = aes.encrypt_blocks(data)
+            self.assertEqual(b"".join(aes.encrypt(b) for b in espsecure.get_chunks(data, 16)), ciphertext)
+            self.assertEqual(b"".join(aes.decrypt(b) for b in espsecure.get_chunks(data, 16)), aes.decrypt_blocks(data))
+            self.assertEqual(data, aes.decrypt_blocks(bytearray(ciphertext)))
+
+    def test_select_unknown(self):
+        with self.assertRaises(esptool.FatalError):
+            espsecure.select_aes_backend("rot13")
+
 
 if __name__ == '__main__':
     print("Running espsecure tests...")
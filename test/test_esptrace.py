@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+#
+# Tests for esptrace.py and esptool.py trace capture files
+#
+# Doesn't need an attached device, traffic is synthesised
+import os
+import os.path
+import struct
+import sys
+import tempfile
+import unittest
+
+TEST_DIR = os.path.abspath(os.path.dirname(__file__))
+
+try:
+    import esptrace
+except ImportError:
+    sys.path.insert(0, os.path.join(TEST_DIR, ".."))
+    import esptrace
+
+import esptool
+
+
+def slip(packet):
+    return b'\xc0' + packet.replace(b'\xdb', b'\xdb\xdd').replace(b'\xc0', b'\xdb\xdc') + b'\xc0'
+
+
+def read_reg_exchange(addr, value, status=0):
+    """ Return the (request, response) frames of a READ_REG command to the ESP32 ROM """
+    request = slip(struct.pack('<BBHI', 0, esptool.ESPLoader.ESP_READ_REG, 4, 0) + struct.pack('<I', addr))
+    response = slip(struct.pack('<BBHI', 1, esptool.ESPLoader.ESP_READ_REG, 4, value) + struct.pack('B', status) + b'\x00' * 3)
+    return request, response
+
+
+class TraceCaptureTests(unittest.TestCase):
+
+    def test_save_load(self):
+        capture = esptool.TraceCapture()
+        capture.record(esptool.TraceCapture.DIR_WRITE, b'\xc0\x01\xc0')
+        capture.record(esptool.TraceCapture.DIR_READ, bytearray(b'\xc0\x02'))
+        f = tempfile.NamedTemporaryFile(delete=False)
+        f.close()
+        try:
+            capture.save(f.name)
+            loaded = esptool.TraceCapture.load(f.name)
+        finally:
+            os.unlink(f.name)
+        self.assertEqual(0, loaded.dropped)
+        self.assertEqual(list(capture.records), list(loaded.records))
+
+    def test_ring_buffer(self):
+        capture = esptool.TraceCapture(max_bytes=10)
+        for i in range(5):
+            capture.record(esptool.TraceCapture.DIR_WRITE, b'x' * 4)
+        self.assertEqual(2, len(capture.records))
+        self.assertEqual(3, capture.dropped)
+
+
+class ReplayTests(unittest.TestCase):
+
+    def make_capture(self):
+        capture = esptool.TraceCapture()
+        request, response = read_reg_exchange(0x3ff00050, 0x12345678)
+        capture.record(esptool.TraceCapture.DIR_WRITE, request)
+        # device response arrives in two chunks
+        capture.record(esptool.TraceCapture.DIR_READ, response[:5])
+        capture.record(esptool.TraceCapture.DIR_READ, response[5:])
+        return capture
+
+    def test_replay(self):
+        port = esptrace.ReplayPort(self.make_capture())
+        esp = esptool.ESP32ROM(port)
+        self.assertEqual(0x12345678, esp.read_reg(0x3ff00050))
+        self.assertTrue(port.is_finished())
+
+    def test_replay_metrics(self):
+        metrics = esptool.SessionMetrics()
+        esp = esptool.ESP32ROM(esptrace.ReplayPort(self.make_capture()), metrics=metrics)
+        esp.read_reg(0x3ff00050)
+        c = metrics.commands[esptool.ESPLoader.ESP_READ_REG]
+        self.assertEqual((1, 1, 1), (c["count"], c["responses"], c["latency_count"]))
+        self.assertEqual(1, sum(c["latency_buckets"]))
+        self.assertIn('esptool_commands_total{op="ESP_READ_REG"} 1.0', metrics.to_prometheus())
+
+    def test_read_regs_error(self):
+        # after a failed read in a pipelined batch, the rest of the batch's responses are discarded
+        capture = esptool.TraceCapture()
+        exchanges = [read_reg_exchange(0x3ff00050, 0, status=1),
+                     read_reg_exchange(0x3ff00054, 0x11111111)]
+        for request, _ in exchanges:
+            capture.record(esptool.TraceCapture.DIR_WRITE, request)
+        for _, response in exchanges:
+            capture.record(esptool.TraceCapture.DIR_READ, response)
+        request, response = read_reg_exchange(0x3ff00058, 0x22222222)
+        capture.record(esptool.TraceCapture.DIR_WRITE, request)
+        capture.record(esptool.TraceCapture.DIR_READ, response)
+
+        port = esptrace.ReplayPort(capture)
+        esp = esptool.ESP32ROM(port)
+        with self.assertRaises(esptool.FatalError):
+            esp.read_regs([0x3ff00050, 0x3ff00054])
+        self.assertEqual(0x22222222, esp.read_reg(0x3ff00058))
+        self.assertTrue(port.is_finished())
+
+    def test_replay_diverged(self):
+        port = esptrace.ReplayPort(self.make_capture())
+        esp = esptool.ESP32ROM(port)
+        with self.assertRaises(esptool.FatalError) as cm:
+            esp.read_reg(0x3ff00054)
+        self.assertIn("diverged", str(cm.exception))
+
+    def test_decode_frames(self):
+        request, response = read_reg_exchange(0x3ff00050, 0x12345678)
+        frames, partial = esptrace.slip_frames(response[:5])
+        self.assertEqual([], frames)
+        frames, partial = esptrace.slip_frames(response[5:], partial)
+        self.assertEqual(1, len(frames))
+        self.assertIn("ESP_READ_REG response val=0x12345678",
+                      esptrace.describe_frame(esptool.TraceCapture.DIR_READ, frames[0]))
+
+
+if __name__ == '__main__':
+    unittest.main(buffer=True)
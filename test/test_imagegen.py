@@ -5,6 +5,7 @@ import subprocess
 import struct
 import sys
 import unittest
+import weakref
 import hashlib
 
 from elftools.elf.elffile import ELFFile
@@ -108,6 +109,7 @@ class BaseTestCase(unittest.TestCase):
         except subprocess.CalledProcessError as e:
             print(e.output)
             raise
+        return output
 
 class ESP8266V1ImageTests(BaseTestCase):
     ELF="esp8266-nonosssdk20-iotdemo.elf"
@@ -228,6 +230,89 @@ class ESP32ImageTests(BaseTestCase):
                          ".flash.text" ]:
             self.assertImageContainsSection(image, ELF, section)
 
+    def test_mapped_image(self):
+        ELF="esp32-app-template.elf"
+        BIN="esp32-app-template.bin"
+        try:
+            self.run_elf2image("esp32", ELF)
+            mapped = esptool.LoadFirmwareImage("esp32", BIN)
+            with open(BIN, "rb") as f:
+                image = esptool.ESP32FirmwareImage(f)
+            self.assertEqual(len(image.segments), len(mapped.segments))
+            for seg, mapped_seg in zip(image.segments, mapped.segments):
+                self.assertIsInstance(mapped_seg.data, memoryview)
+                self.assertEqual((seg.addr, seg.file_offs), (mapped_seg.addr, mapped_seg.file_offs))
+                self.assertEqual(seg.data, mapped_seg.data.tobytes())
+            self.assertEqual(image.calc_digest, mapped.calc_digest)
+            self.assertEqual(mapped.stored_digest, mapped.calc_digest)
+            self.assertEqual(image.calculate_checksum(), mapped.calculate_checksum())
+            mapping = mapped._mapped_file._mmap
+            mapped.close()
+            self.assertTrue(mapping.closed)
+        finally:
+            try_delete(BIN)
+
+    def test_mapped_file_close(self):
+        # the mapping stays open until views of it are released
+        with open("esp32-app-template.elf", "rb") as f:
+            mapped = esptool.MappedFile(f)
+        mapping = weakref.ref(mapped._mmap)
+        with mapped:
+            view = mapped.read_view(4)
+        self.assertFalse(mapping().closed)
+        self.assertEqual(b"\x7fELF", view.tobytes())
+        view.release()
+        self.assertIsNone(mapping())
+
+    def test_build_cache(self):
+        ELF="esp32-app-template.elf"
+        BIN="esp32-app-template.bin"
+        CACHE="esp32-app-template-cache.json"
+        try:
+            self.assertNotIn("up to date", self.run_elf2image("esp32", ELF, extra_args=["--cache", CACHE]))
+            with open(BIN, "rb") as f:
+                image = f.read()
+            self.assertIn("up to date", self.run_elf2image("esp32", ELF, extra_args=["--cache", CACHE]))
+            # changed options or a modified output file mean the image is built again
+            self.assertNotIn("up to date", self.run_elf2image("esp32", ELF, extra_args=["--cache", CACHE, "--flash_mode", "dio"]))
+            with open(BIN, "ab") as f:
+                f.write(b"\x00")
+            self.assertNotIn("up to date", self.run_elf2image("esp32", ELF, extra_args=["--cache", CACHE]))
+            with open(BIN, "rb") as f:
+                self.assertEqual(image, f.read())
+        finally:
+            try_delete(BIN)
+            try_delete(CACHE)
+
+    def test_build_cache_same_mtime(self):
+        # an ELF file which changed without its mtime changing (ie copied with cp -p) is still rebuilt
+        ELF="esp32-app-template-copy.elf"
+        BIN="esp32-app-template-copy.bin"
+        CACHE="esp32-app-template-copy-cache.json"
+        try:
+            with open("esp32-app-template.elf", "rb") as f:
+                elf = bytearray(f.read())
+            with open(ELF, "wb") as f:
+                f.write(elf)
+            self.run_elf2image("esp32", ELF, extra_args=["--cache", CACHE])
+            st = os.stat(ELF)
+            with open(ELF, "rb") as f:
+                offs = ELFFile(f).get_section_by_name(".iram0.vectors").header.sh_offset
+            elf[offs] ^= 0xFF
+            with open(ELF, "wb") as f:
+                f.write(elf)
+            os.utime(ELF, (st.st_atime, st.st_mtime))
+            self.assertNotIn("up to date", self.run_elf2image("esp32", ELF, extra_args=["--cache", CACHE]))
+            with open(BIN, "rb") as f:
+                cached_build = f.read()
+            self.run_elf2image("esp32", ELF)
+            with open(BIN, "rb") as f:
+                self.assertEqual(f.read(), cached_build)
+        finally:
+            try_delete(ELF)
+            try_delete(BIN)
+            try_delete(CACHE)
+
     def test_too_many_sections(self):
         ELF="esp32-too-many-sections.elf"
         BIN="esp32-too-many-sections.bin"
@@ -286,6 +371,16 @@ class ELFSHA256Tests(BaseTestCase):
 
         self.assertSequenceEqual(expected_sha256, observed_sha256)
 
+    def test_elf_file(self):
+        e = esptool.ELFFile(self.ELF)
+        with open(self.ELF, "rb") as f:
+            self.assertEqual(hashlib.sha256(f.read()).digest(), e.sha256())
+            f.seek(0)
+            section = ELFFile(f).get_section_by_name(".flash.rodata")
+            self.assertEqual(section.data(), e.get_section(".flash.rodata").data)
+        with self.assertRaises(ValueError):
+            e.get_section(".no_such_section")
+
 
 if __name__ == '__main__':
     print("Running image generation tests...")